@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+
+"""Admission control of the requests computing simulations
+
+At most ``max_concurrency`` requests compute at the same time. The following ones wait, in a queue of at most
+``max_queue_size`` requests, for at most ``queue_timeout`` seconds. Requests arriving when the queue is full, or
+waiting longer than the timeout, are rejected with a "503 Service Unavailable" error and a ``Retry-After`` header.
+"""
+
+
+import collections
+import functools
+import math
+import threading
+import time
+
+from . import contexts, wsgihelpers
+
+
+# Initialized in environment module
+controller = None
+
+
+class AdmissionController(object):
+    """A semaphore with a bounded wait queue and statistics
+
+    >>> controller = AdmissionController(max_concurrency = 1, max_queue_size = 0, queue_timeout = 1)
+    >>> controller.acquire()
+    True
+    >>> controller.acquire()
+    False
+    >>> controller.release()
+    >>> controller.acquire()
+    True
+    >>> controller.to_json()['rejected']
+    1
+    """
+
+    def __init__(self, max_concurrency, max_queue_size, queue_timeout):
+        self.admitted = 0
+        self.condition = threading.Condition(threading.Lock())
+        self.in_flight = 0
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.max_wait_time = 0.0
+        self.queue_size = 0
+        self.queue_timeout = queue_timeout
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait_time = 0.0
+
+    def acquire(self):
+        """Wait for a free slot and return True, or return False when the queue is full or the wait is too long."""
+        with self.condition:
+            if self.in_flight < self.max_concurrency and self.queue_size == 0:
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+            if self.queue_size >= self.max_queue_size:
+                self.rejected += 1
+                return False
+            self.queue_size += 1
+            start_time = time.time()
+            deadline = start_time + self.queue_timeout
+            try:
+                while self.in_flight >= self.max_concurrency:
+                    remaining_time = deadline - time.time()
+                    if remaining_time <= 0:
+                        self.timed_out += 1
+                        return False
+                    self.condition.wait(remaining_time)
+            finally:
+                self.queue_size -= 1
+                wait_time = time.time() - start_time
+                self.total_wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def get_retry_after(self):
+        """Return an estimation of the number of seconds before a request can be admitted."""
+        if self.admitted == 0:
+            return 1
+        return max(int(math.ceil(self.total_wait_time / self.admitted)), 1)
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def to_json(self):
+        return collections.OrderedDict([
+            ('admitted', self.admitted),
+            ('in_flight', self.in_flight),
+            ('max_concurrency', self.max_concurrency),
+            ('max_queue_size', self.max_queue_size),
+            ('max_wait_time', self.max_wait_time),
+            ('mean_wait_time', self.total_wait_time / self.admitted if self.admitted else 0.0),
+            ('queue_size', self.queue_size),
+            ('queue_timeout', self.queue_timeout),
+            ('rejected', self.rejected),
+            ('timed_out', self.timed_out),
+            ])
+
+
+class ReleasingIterator(object):
+    """Iterate over the body of a streamed response, releasing the admission when done"""
+
+    def __init__(self, app_iter, release):
+        self.app_iter = app_iter
+        self.release = release
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            close = getattr(self.app_iter, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.release()
+
+
+def admit(func):
+    """Decorate a controller computing simulations, so that it is run only once admitted.
+
+    Responses whose body is streamed keep their slot until their body is fully sent.
+    """
+    @functools.wraps(func)
+    def admitted_func(req, *args, **kwargs):
+        if controller is None:
+            return func(req, *args, **kwargs)
+        if not controller.acquire():
+            ctx = contexts.Ctx(req)
+            headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
+            headers.append(('Retry-After', str(controller.get_retry_after())))
+            return wsgihelpers.respond_json(ctx,
+                collections.OrderedDict(sorted(dict(
+                    apiVersion = 1,
+                    error = collections.OrderedDict(sorted(dict(
+                        code = 503,  # Service Unavailable
+                        message = ctx._(u'Server is overloaded, retry later'),
+                        ).iteritems())),
+                    method = req.script_name,
+                    url = req.url.decode('utf-8'),
+                    ).iteritems())),
+                headers = headers,
+                )
+        streamed = False
+        try:
+            response = func(req, *args, **kwargs)
+            if response is not None and response.content_length is None:
+                response.app_iter = ReleasingIterator(response.app_iter, controller.release)
+                streamed = True
+            return response
+        finally:
+            if not streamed:
+                controller.release()
+    return admitted_func
@@ -15,7 +15,7 @@ except ImportError:
 import weberror.errormiddleware
 from webob.dec import wsgify
 
-from . import conf, controllers, environment, urls
+from . import binary, conf, controllers, environment, urls
 
 log = logging.getLogger(__name__)
 
@@ -44,7 +44,8 @@ def ensure_json_content_type(req, app):
     Here we force it to be application/json.
     """
     res = req.get_response(app, catch_exc_info=True)
-    res.content_type = 'application/json; charset=utf-8'
+    if res.content_type != 'application/x-ndjson' and res.content_type not in binary.media_types:
+        res.content_type = 'application/json; charset=utf-8'
     return res
 
 
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+
+"""Batched execution of several scenarios in a single simulation
+
+Compatible scenarios (same tax-benefit system, same period, test cases without axes and inputs given for the same
+variables and periods) are merged into one simulation whose entities are the concatenation of the entities of each
+scenario. Each variable is then computed once for the whole batch, and results are sliced back per scenario.
+"""
+
+
+def group_scenarios(scenarios):
+    """Return the lists of indexes of the scenarios that can be computed in the same simulation.
+
+    Groups are ordered by the index of their first scenario. A scenario that can't be merged is alone in its group.
+    """
+    groups = []
+    group_by_signature = {}
+    for scenario_index, scenario in enumerate(scenarios):
+        signature = get_scenario_signature(scenario)
+        if signature is None:
+            groups.append([scenario_index])
+            continue
+        group = group_by_signature.get(signature)
+        if group is None:
+            group = group_by_signature[signature] = []
+            groups.append(group)
+        group.append(scenario_index)
+    return groups
+
+
+def get_scenario_signature(scenario):
+    """Return a key shared by the scenarios that can be merged into the same simulation, or None."""
+    test_case = scenario.test_case
+    if test_case is None or scenario.axes is not None:
+        return None
+    tax_benefit_system = scenario.tax_benefit_system
+    variables = tax_benefit_system.variables
+    simulation_period = scenario.period
+    # Scenarios must set their inputs for the same periods, otherwise set_input (which dispatches or divides values
+    # between sub-periods that are not already known) would behave differently in the merged simulation.
+    input_periods = set()
+    for entity in tax_benefit_system.entities:
+        for entity_member in test_case.get(entity.plural) or []:
+            for variable_name, cell in entity_member.iteritems():
+                if cell is None or variable_name not in variables:
+                    continue
+                if isinstance(cell, dict):
+                    if any(value is not None for value in cell.itervalues()):
+                        input_periods.update(
+                            (variable_name, variable_period)
+                            for variable_period in cell.iterkeys()
+                            )
+                else:
+                    input_periods.add((variable_name, simulation_period))
+    return (id(tax_benefit_system), simulation_period, frozenset(input_periods))
+
+
+def merge_scenarios(scenarios):
+    """Return a new scenario whose test case is the concatenation of the test cases of the given scenarios."""
+    first_scenario = scenarios[0]
+    tax_benefit_system = first_scenario.tax_benefit_system
+    test_case = {}
+    for entity in tax_benefit_system.entities:
+        merged_entity_members = test_case[entity.plural] = []
+        for scenario_index, scenario in enumerate(scenarios):
+            for entity_member in scenario.test_case.get(entity.plural) or []:
+                merged_entity_member = entity_member.copy()
+                merged_entity_member['id'] = merge_id(scenario_index, entity_member['id'])
+                if not entity.is_person:
+                    for role in entity.roles:
+                        role_key = role.plural or role.key
+                        person_id_or_ids = entity_member.get(role_key)
+                        if isinstance(person_id_or_ids, list):
+                            merged_entity_member[role_key] = [
+                                merge_id(scenario_index, person_id)
+                                for person_id in person_id_or_ids
+                                ]
+                        elif person_id_or_ids is not None:
+                            merged_entity_member[role_key] = merge_id(scenario_index, person_id_or_ids)
+                merged_entity_members.append(merged_entity_member)
+    merged_scenario = tax_benefit_system.new_scenario()
+    merged_scenario.period = first_scenario.period
+    merged_scenario.test_case = test_case
+    return merged_scenario
+
+
+def merge_id(scenario_index, entity_id):
+    return u'{}/{}'.format(scenario_index, entity_id)
+
+
+def slice_value_json(value_json, start, stop):
+    """Extract the cells of entities ``start`` to ``stop`` from the result of ``holder.to_value_json()``."""
+    if value_json is None:
+        return None
+    if isinstance(value_json, list):
+        return value_json[start:stop]
+    return {
+        period: slice_value_json(array_or_dict_json, start, stop)
+        for period, array_or_dict_json in value_json.iteritems()
+        }
+
+
+class SimulationBatch(object):
+    """A simulation computing several scenarios at once"""
+
+    def __init__(self, scenarios, trace = False):
+        self.scenarios = scenarios
+        self.simulation = merge_scenarios(scenarios).new_simulation(trace = trace)
+        self.bounds_by_entity_key = {}
+        for entity in self.simulation.entities.itervalues():
+            bounds = []
+            start = 0
+            for scenario in scenarios:
+                stop = start + len(scenario.test_case.get(entity.plural) or [])
+                bounds.append((start, stop))
+                start = stop
+            self.bounds_by_entity_key[entity.key] = bounds
+        self.scenario_simulations = [
+            ScenarioSimulation(self, scenario_index)
+            for scenario_index in range(len(scenarios))
+            ]
+        self._value_json_by_holder_key = {}
+
+    def get_value_json(self, holder, use_label = False):
+        # Convert the whole holder only once for all the scenarios of the batch.
+        key = (holder.variable.name, use_label)
+        if key not in self._value_json_by_holder_key:
+            self._value_json_by_holder_key[key] = holder.to_value_json(use_label = use_label)
+        return self._value_json_by_holder_key[key]
+
+
+class ScenarioSimulation(object):
+    """The part of a batched simulation belonging to one of its scenarios
+
+    It exposes the subset of the simulation API used to build the output of the calculate controller.
+    """
+
+    def __init__(self, batch, scenario_index):
+        self.batch = batch
+        self.scenario_index = scenario_index
+        self._holder_by_variable_name = {}
+
+    @property
+    def period(self):
+        return self.batch.simulation.period
+
+    @property
+    def tracer(self):
+        return self.batch.simulation.tracer
+
+    def get_holder(self, variable_name):
+        holder = self._holder_by_variable_name.get(variable_name)
+        if holder is None:
+            holder = self._holder_by_variable_name[variable_name] = ScenarioHolder(
+                self,
+                self.batch.simulation.get_holder(variable_name),
+                )
+        return holder
+
+
+class ScenarioHolder(object):
+    """The cells of a holder of a batched simulation belonging to one of its scenarios"""
+
+    def __init__(self, scenario_simulation, holder):
+        self.holder = holder
+        self.scenario_simulation = scenario_simulation
+        self.start, self.stop = scenario_simulation.batch.bounds_by_entity_key[holder.entity.key][
+            scenario_simulation.scenario_index]
+
+    @property
+    def entity(self):
+        return self.holder.entity
+
+    @property
+    def variable(self):
+        return self.holder.variable
+
+    def get_array(self, period):
+        array = self.holder.get_array(period)
+        if array is None:
+            return None
+        return array[self.start:self.stop]
+
+    def get_known_periods(self):
+        return self.holder.get_known_periods()
+
+    def to_value_json(self, use_label = False):
+        value_json = self.scenario_simulation.batch.get_value_json(self.holder, use_label = use_label)
+        return slice_value_json(value_json, self.start, self.stop)
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+
+"""Binary encodings of responses containing NumPy arrays
+
+Instead of converting each cell of an array to a JSON number, arrays are sent as contiguous little-endian buffers.
+The rest of the response (the "header") is kept as is, each array being replaced by a ``{"$array": <index>}``
+reference, and the ``$arrays`` item of the header describes the buffers: NumPy type string (``dtype``), ``shape``,
+``offset`` and ``length`` (in bytes).
+
+Two media types are available:
+
+``application/vnd.openfisca.arrays``
+    The magic string ``OFA1``, the length of the header (unsigned 32 bits little-endian integer), the header (UTF-8
+    JSON), then the buffers. Offsets are relative to the end of the header and are multiples of 8.
+
+``application/x-msgpack`` (only when the optional ``msgpack`` package is installed)
+    A msgpack map with a ``header`` item and a ``buffers`` item (a list of binary strings).
+
+:func:`decode` is the reference decoder.
+"""
+
+
+import collections
+import json
+import struct
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+MAGIC = 'OFA1'
+MSGPACK_MEDIA_TYPE = 'application/x-msgpack'
+RAW_MEDIA_TYPE = 'application/vnd.openfisca.arrays'
+
+media_types = [RAW_MEDIA_TYPE]
+if msgpack is not None:
+    media_types.append(MSGPACK_MEDIA_TYPE)
+
+
+def decode(body, media_type = RAW_MEDIA_TYPE):
+    """Decode a binary response body and return its data, with NumPy arrays.
+
+    Arrays decoded from the raw encoding are read-only views of ``body``.
+
+    >>> data = decode(''.join(encode({'value': np.array([1.5, 2.5], dtype = np.float32), 'period': u'2014'})))
+    >>> data['period'], data['value'].dtype, data['value'].tolist()
+    (u'2014', dtype('float32'), [1.5, 2.5])
+    """
+    if media_type == MSGPACK_MEDIA_TYPE:
+        assert msgpack is not None, u'msgpack is not installed'
+        message = msgpack.unpackb(body, raw = False)
+        header = message['header']
+        arrays = [
+            np.frombuffer(buffer_, dtype = np.dtype(array_json['dtype'])).reshape(array_json['shape'])
+            for array_json, buffer_ in zip(header['$arrays'], message['buffers'])
+            ]
+    else:
+        assert media_type == RAW_MEDIA_TYPE, media_type
+        if body[:len(MAGIC)] != MAGIC:
+            raise ValueError(u'Invalid binary response: wrong magic string')
+        header_start = len(MAGIC) + 4
+        header_length, = struct.unpack('<I', body[len(MAGIC):header_start])
+        buffers_start = header_start + header_length
+        header = json.loads(body[header_start:buffers_start])
+        arrays = []
+        for array_json in header['$arrays']:
+            dtype = np.dtype(str(array_json['dtype']))
+            arrays.append(np.frombuffer(
+                body,
+                count = array_json['length'] // dtype.itemsize,
+                dtype = dtype,
+                offset = buffers_start + array_json['offset'],
+                ).reshape(array_json['shape']))
+    del header['$arrays']
+    return replace_references_by_arrays(header, arrays)
+
+
+def encode(data, media_type = RAW_MEDIA_TYPE, json_dumps_default = None):
+    """Encode data containing NumPy arrays and return the list of the chunks of the body.
+
+    ``json_dumps_default`` converts the values of the header that can't be serialized otherwise.
+    """
+    arrays = []
+    header = replace_arrays_by_references(data, arrays)
+    header['$arrays'] = arrays_json = []
+    buffers = []
+    offset = 0
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype = array.dtype.newbyteorder('<'))
+        buffer_ = array.tostring()
+        arrays_json.append(collections.OrderedDict([
+            ('dtype', array.dtype.str),
+            ('length', len(buffer_)),
+            ('offset', offset),
+            ('shape', list(array.shape)),
+            ]))
+        buffers.append(buffer_)
+        offset += len(buffer_)
+        padding = -offset % 8
+        if padding and media_type == RAW_MEDIA_TYPE:
+            buffers.append('\0' * padding)
+            offset += padding
+    if media_type == MSGPACK_MEDIA_TYPE:
+        assert msgpack is not None, u'msgpack is not installed'
+        return [msgpack.packb(dict(buffers = buffers, header = header), default = json_dumps_default,
+            use_bin_type = True)]
+    assert media_type == RAW_MEDIA_TYPE, media_type
+    header_text = json.dumps(header, default = json_dumps_default)
+    return [MAGIC, struct.pack('<I', len(header_text)), header_text] + buffers
+
+
+def get_media_type(req):
+    """Return the binary media type accepted by the client, or None when JSON is preferred."""
+    media_type = req.accept.best_match(['application/json'] + media_types)
+    return media_type if media_type in media_types else None
+
+
+def replace_arrays_by_references(value, arrays):
+    if isinstance(value, np.ndarray):
+        arrays.append(value)
+        return {'$array': len(arrays) - 1}
+    if isinstance(value, collections.Mapping):
+        return type(value)(
+            (key, replace_arrays_by_references(item, arrays))
+            for key, item in value.iteritems()
+            )
+    if isinstance(value, (list, tuple)):
+        return [
+            replace_arrays_by_references(item, arrays)
+            for item in value
+            ]
+    return value
+
+
+def replace_references_by_arrays(value, arrays):
+    if isinstance(value, dict):
+        if len(value) == 1 and '$array' in value:
+            return arrays[value['$array']]
+        return {
+            key: replace_references_by_arrays(item, arrays)
+            for key, item in value.iteritems()
+            }
+    if isinstance(value, list):
+        return [
+            replace_references_by_arrays(item, arrays)
+            for item in value
+            ]
+    return value
+
+
+def respond(ctx, data, media_type, headers = [], json_dumps_default = None):
+    """Return a binary response. None properties of ``data`` are removed, like in JSON responses."""
+    data = type(data)(
+        (name, value)
+        for name, value in data.iteritems()
+        if value is not None
+        )
+    response = ctx.req.response
+    response.content_type = media_type
+    response.headers.update(headers)
+    response.app_iter = encode(data, media_type, json_dumps_default = json_dumps_default)
+    return response
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+
+"""Bounded caches"""
+
+
+import collections
+import hashlib
+import json
+import threading
+import time
+
+
+def canonical_digest(value):
+    """Return a digest of a JSON-like value, independent of the order of its dicts and sets.
+
+    >>> canonical_digest({'a': 1, 'b': [1, 2]}) == canonical_digest(collections.OrderedDict([('b', [1, 2]), ('a', 1)]))
+    True
+    >>> canonical_digest({'variables': set(['b', 'a'])}) == canonical_digest({'variables': ['a', 'b']})
+    True
+    """
+    text = json.dumps(value, default = jsonify_set, separators = (',', ':'), sort_keys = True)
+    return hashlib.sha1(text).hexdigest()
+
+
+def jsonify_set(value):
+    if isinstance(value, (frozenset, set)):
+        return sorted(value)
+    raise TypeError(repr(value) + ' is not JSON serializable')
+
+
+class LRUCache(object):
+    """A thread-safe mapping which evicts its least recently used entries
+
+    The cache is bounded by a number of entries and, optionally, by the sum of the sizes of its entries (as given to
+    :meth:`set`). Entries older than ``ttl`` seconds are considered missing.
+
+    >>> cache = LRUCache(max_entries = 2)
+    >>> cache.set('a', 1)
+    >>> cache.set('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.set('c', 3)
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.to_json().iteritems())  # doctest: +NORMALIZE_WHITESPACE
+    [('entries', 2), ('hit_ratio', 0.5), ('hits', 1), ('max_bytes', None), ('max_entries', 2), ('misses', 1), ('size', 0),
+     ('ttl', None)]
+    """
+    def __init__(self, max_entries, max_bytes = None, ttl = None):
+        self.hits = 0
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.misses = 0
+        self.size = 0
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # key: (value, size, expiration time)
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self._entries.get(key)
+            return entry is not None and (entry[2] is None or entry[2] > time.time())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+            self.size = 0
+
+    def delete(self, key):
+        with self.lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def get(self, key, default = None):
+        with self.lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[2] is not None and entry[2] <= time.time():
+                self.size -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries[key] = entry  # Move entry to the most recently used end.
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size = 0):
+        """Store a value, or remove the entry of its key when the value is larger than ``max_bytes``.
+
+        >>> cache = LRUCache(max_entries = 2, max_bytes = 10)
+        >>> cache.set('a', 1, size = 5)
+        >>> cache.set('a', 2, size = 20)
+        >>> 'a' in cache
+        False
+        """
+        if self.max_entries <= 0 or self.max_bytes is not None and size > self.max_bytes:
+            # Don't serve an older value instead.
+            self.delete(key)
+            return
+        with self.lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+            self._entries[key] = (value, size, time.time() + self.ttl if self.ttl else None)
+            self.size += size
+            while len(self._entries) > self.max_entries or self.max_bytes is not None and self.size > self.max_bytes:
+                evicted_key, evicted_entry = self._entries.popitem(last = False)
+                self.size -= evicted_entry[1]
+
+    def to_json(self):
+        return dict(
+            entries = len(self._entries),
+            hit_ratio = float(self.hits) / (self.hits + self.misses) if self.hits or self.misses else None,
+            hits = self.hits,
+            max_bytes = self.max_bytes,
+            max_entries = self.max_entries,
+            misses = self.misses,
+            size = self.size,
+            ttl = self.ttl,
+            )
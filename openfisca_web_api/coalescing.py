@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+
+"""Coalescing of identical concurrent requests ("single flight")
+
+When a request arrives while an identical one (same route, body, query, negotiated headers and extensions, ``context``
+excepted) is being computed, it waits for the first one to finish and gets a copy of its response, with its own
+``context`` and CORS headers.
+
+Only successful responses are shared: when the first request fails, the waiting ones are computed again.
+
+Requests are coalesced between the threads of a process and, when a directory is given, between processes: the first
+process to lock the file of a request computes it and writes its response in the directory, as JSON, for the processes
+waiting for the lock.
+
+Coalescing is disabled by default: every request then pays for the digest of its body, and for the pickling of its
+response when a directory is given.
+"""
+
+
+import base64
+import collections
+import fcntl
+import functools
+import json
+import os
+import threading
+import time
+
+import webob
+
+from . import caches, contexts, wsgihelpers
+
+
+# Initialized in environment module
+single_flight = None
+
+
+class Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.succeeded = False
+        self.value = None
+
+
+class SingleFlight(object):
+    """Run a function only once for concurrent calls with the same key
+
+    A ``None`` value is not shared: the waiting calls then run the function themselves. Across processes, values are
+    exchanged as JSON.
+
+    >>> single_flight = SingleFlight()
+    >>> single_flight.do('key', lambda: 1)
+    (1, False)
+    """
+
+    cleanup_period = 100  # Number of calls between two removals of expired files
+    files_ttl = 60  # in seconds
+
+    def __init__(self, dir = None):
+        self.calls = {}
+        self.calls_count = 0
+        self.coalesced = 0
+        self.dir = dir
+        self.lock = threading.Lock()
+        if dir is not None and not os.path.isdir(dir):
+            os.makedirs(dir)
+
+    def do(self, key, function):
+        """Return the value of ``function()`` and whether it was computed by another call."""
+        with self.lock:
+            self.calls_count += 1
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        if not leader:
+            call.done.wait()
+            if call.succeeded and call.value is not None:
+                with self.lock:
+                    self.coalesced += 1
+                return call.value, True
+            # The first call failed, or can't be shared: compute without it.
+            return function(), False
+        try:
+            if self.dir is None:
+                value, coalesced = function(), False
+            else:
+                value, coalesced = self.do_across_processes(key, function)
+            call.value = value
+            call.succeeded = True
+            if coalesced:
+                with self.lock:
+                    self.coalesced += 1
+            return value, coalesced
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def do_across_processes(self, key, function):
+        if self.calls_count % self.cleanup_period == 0:
+            self.remove_expired_files()
+        start_time = time.time()
+        lock_file_path = os.path.join(self.dir, key + '.lock')
+        result_file_path = os.path.join(self.dir, key + '.result')
+        with open(lock_file_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    # A result written while waiting for the lock is the one of an identical request.
+                    if os.path.getmtime(result_file_path) >= start_time:
+                        with open(result_file_path) as result_file:
+                            return json.load(result_file), True
+                except (IOError, OSError, ValueError):
+                    pass
+                value = function()
+                if value is not None:
+                    temporary_file_path = '{}.{}.tmp'.format(result_file_path, os.getpid())
+                    with open(temporary_file_path, 'w') as result_file:
+                        json.dump(value, result_file)
+                    os.rename(temporary_file_path, result_file_path)
+                return value, False
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def remove_expired_files(self):
+        expiration_time = time.time() - self.files_ttl
+        for file_name in os.listdir(self.dir):
+            file_path = os.path.join(self.dir, file_name)
+            try:
+                if os.path.getmtime(file_path) < expiration_time:
+                    os.remove(file_path)
+            except OSError:
+                pass
+
+    def to_json(self):
+        return collections.OrderedDict([
+            ('calls', self.calls_count),
+            ('coalesced', self.coalesced),
+            ('dir', self.dir),
+            ('in_flight', len(self.calls)),
+            ])
+
+
+def coalesce(func):
+    """Decorate a controller, so that identical concurrent requests share the response of the first one."""
+    @functools.wraps(func)
+    def coalesced_func(req, *args, **kwargs):
+        if single_flight is None:
+            return func(req, *args, **kwargs)
+        key, context = get_request_key_and_context(req)
+        if key is None:
+            return func(req, *args, **kwargs)
+
+        leader_responses = []
+
+        def compute():
+            try:
+                response = func(req, *args, **kwargs)
+            except webob.exc.HTTPException as response:
+                pass
+            leader_responses.append(response)
+            if not 200 <= response.status_int < 300:
+                return None  # Errors (bad parameters, overload...) are specific to the request.
+            if response.content_length is None:
+                return None  # Streamed and binary responses can't be shared.
+            return dict(
+                body = base64.b64encode(response.body),
+                context = context,
+                headerlist = response.headerlist,
+                status = response.status,
+                )
+
+        value, coalesced = single_flight.do(key, compute)
+        if leader_responses:
+            return leader_responses[0]
+        return make_coalesced_response(req, value, context)
+    return coalesced_func
+
+
+def get_request_key_and_context(req):
+    """Return the coalescing key of a request and its context, or ``(None, None)`` when it can't be coalesced."""
+    inputs = None
+    context = None
+    if req.body:
+        try:
+            inputs = json.loads(req.body, object_pairs_hook = collections.OrderedDict)
+        except ValueError:
+            return None, None
+        if isinstance(inputs, dict):
+            context = inputs.pop('context', None)
+    key_json = dict(
+        accept = req.headers.get('Accept'),
+        accept_language = req.headers.get('Accept-Language'),
+        content_type = req.content_type,
+        extensions = req.headers.get('X-Openfisca-Extensions'),  # Reforms of /api/2/formula
+        inputs = inputs,
+        method = req.method,
+        path = req.script_name + req.path_info,
+        query = req.query_string,
+        )
+    return caches.canonical_digest(key_json), context
+
+
+def make_coalesced_response(req, value, context):
+    body = base64.b64decode(value['body'])
+    first_context = value['context']
+    ctx = contexts.Ctx(req)
+    headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
+    headers.append(('Cache-Status', 'openfisca-web-api; hit; detail=coalesced'))
+    response = webob.Response(
+        headerlist = [
+            # Header names and values are unicode strings once read back from JSON.
+            (str(name), header_value.encode('latin-1') if isinstance(header_value, unicode) else header_value)
+            for name, header_value in value['headerlist']
+            if name.lower() not in ('cache-status', 'content-length') and not name.lower().startswith('access-control-')
+            ] + headers,
+        status = str(value['status']),
+        )
+    if context != first_context and response.content_type == 'application/json':
+        data = json.loads(body, object_pairs_hook = collections.OrderedDict)
+        if isinstance(data, dict):
+            for container in (data, data.get('params')):
+                if isinstance(container, dict):
+                    if context is None:
+                        container.pop('context', None)
+                    else:
+                        container['context'] = context
+            body = json.dumps(data)
+    response.body = body
+    return response
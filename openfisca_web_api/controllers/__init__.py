@@ -6,7 +6,8 @@
 
 import collections
 
-from . import calculate, entities, field, formula, parameters, reforms, simulate, swagger, variables
+from . import (calculate, entities, field, formula, jobs, parameters, reforms, sessions, simulate, status, swagger,
+    variables)
 from .. import contexts, urls, wsgihelpers
 
 
@@ -38,10 +39,17 @@ def make_router():
         ('GET', '^/api/2/entities/?$', entities.api2_entities),
         ('GET', '^/api/1/field/?$', field.api1_field),
         ('GET', '^/api/1/formula/(?P<name>[^/]+)/?$', formula.api1_formula),
-        ('GET', '^/api/2/formula/(?:(?P<period>[A-Za-z0-9:-]*)/)?(?P<names>[A-Za-z0-9_+-]+)/?$', formula.api2_formula),
+        (('GET', 'POST'), '^/api/2/formula/(?:(?P<period>[A-Za-z0-9:-]*)/)?(?P<names>[A-Za-z0-9_+-]+)/?$', formula.api2_formula),
+        ('POST', '^/api/1/jobs/?$', jobs.api1_jobs),
+        ('GET', '^/api/1/jobs/(?P<id>[0-9a-f]{32})/?$', jobs.api1_job),
+        ('GET', '^/api/1/jobs/(?P<id>[0-9a-f]{32})/results/?$', jobs.api1_job_results),
         ('GET', '^/api/1/parameters/?$', parameters.api1_parameters),
+        ('GET', '^/api/1/parameters/history/?$', parameters.api1_parameters_history),
         ('GET', '^/api/1/reforms/?$', reforms.api1_reforms),
+        ('POST', '^/api/1/sessions/?$', sessions.api1_sessions),
+        (('DELETE', 'GET', 'PATCH'), '^/api/1/sessions/(?P<id>[0-9a-f]{32})/?$', sessions.api1_session),
         ('POST', '^/api/1/simulate/?$', simulate.api1_simulate),
+        ('GET', '^/api/1/status/?$', status.api1_status),
         ('GET', '^/api/1/swagger$', swagger.api1_swagger),
         ('GET', '^/api/1/variables/?$', variables.api1_variables),
         ]
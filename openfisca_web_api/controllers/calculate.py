@@ -9,19 +9,74 @@ from __future__ import division
 import collections
 import copy
 import itertools
-import os
 import time
 
+import numpy as np
+from openfisca_core import periods
+from openfisca_core.indexed_enums import Enum
 from openfisca_core.parameters import ParameterNotFound
 from openfisca_core.taxbenefitsystems import VariableNotFound
 
-from .. import conf, contexts, conv, environment, model, wsgihelpers
+from .. import (admission, batches, binary, caches, coalescing, contexts, conv, environment, model, profiling,
+    reform_diffs, workers, wsgihelpers)
+
+
+PROFILED_VARIABLES_COUNT = 20  # Number of the most time-consuming variables returned when time is "detailed"
 
 
 def N_(message):
     return message
 
 
+def array_to_json(array, variable, keep_array = False, use_label = False):
+    """Convert a whole NumPy array of values of a variable to a JSON list, without per-cell Python work.
+
+    When ``keep_array`` is true, numeric arrays are returned as (copied) NumPy arrays, for binary encodings.
+    """
+    if variable.value_type == Enum:
+        items_json = np.array([
+            item.value if use_label else item.name
+            for item in variable.possible_values
+            ])
+        return items_json[array].tolist()
+    if array.dtype.kind == 'M':  # datetime64
+        return array.astype(str).tolist()
+    if keep_array and array.dtype.kind in 'biuf':
+        # Copy the array, so that a cached response doesn't retain the arrays of a whole (batched) simulation.
+        return array.copy()
+    return array.tolist()
+
+
+def build_output_columns(intermediate_variables, simulations, use_label, variables, arrays = False):
+    """Return, for each simulation, the arrays of the variables by entity and by period."""
+    output_columns = []
+    for simulation in simulations:
+        if intermediate_variables:
+            variables_name = set(
+                node.split('<', 1)[0]
+                for node in simulation.tracer.trace.iterkeys()
+                )
+        else:
+            variables_name = variables
+        columns_json = {}
+        for variable_name in sorted(variables_name):
+            holder = simulation.get_holder(variable_name)
+            variable = holder.variable
+            if variable.definition_period == periods.ETERNITY:
+                array = holder.get_array(None)
+                column_json = array_to_json(array, variable, keep_array = arrays, use_label = use_label) \
+                    if array is not None else None
+            else:
+                column_json = {
+                    str(period): array_to_json(holder.get_array(period), variable, keep_array = arrays,
+                        use_label = use_label)
+                    for period in holder.get_known_periods()
+                    }
+            columns_json.setdefault(holder.entity.plural, {})[variable_name] = column_json
+        output_columns.append(columns_json)
+    return output_columns
+
+
 def build_output_variables(simulations, use_label, variables):
     return [
         {
@@ -76,108 +131,177 @@ def fill_test_cases_with_values(intermediate_variables, scenarios, simulations,
     return output_test_cases
 
 
-@wsgihelpers.wsgify
-def api1_calculate(req):
-    wsgihelpers.track(req.url.decode('utf-8'))
+def calculate_simulations(scenarios, variables, batch = False, profiler = None, results_reuse = None, trace = False):
+    """Compute the variables for each scenario and return the simulations, in the order of the scenarios.
 
-    def calculate_simulations(scenarios, variables, trace):
-        simulations = []
-        for scenario_index, scenario in enumerate(scenarios):
-            simulation = scenario.new_simulation(trace = trace)
+    When a parameter is missing, the raised ParameterNotFound exception gets a ``scenario_index`` attribute.
+
+    When a :class:`profiling.Profiler` is given, it measures the calculations of every simulation.
+
+    When a :class:`reform_diffs.ResultsReuse` is given, the simulations of the base tax-benefit system are recorded, so
+    that the simulations of the reform, computed next, reuse their untouched values.
+    """
+    simulations = [None] * len(scenarios)
+    if batch:
+        scenarios_index_groups = batches.group_scenarios(scenarios)
+    else:
+        scenarios_index_groups = [[scenario_index] for scenario_index in range(len(scenarios))]
+    for scenarios_index in scenarios_index_groups:
+        scenario_index = scenarios_index[0]
+        if len(scenarios_index) == 1:
+            simulation = scenarios[scenario_index].new_simulation(trace = trace)
+            simulations[scenario_index] = simulation
+        else:
+            batch = batches.SimulationBatch(
+                [scenarios[index] for index in scenarios_index],
+                trace = trace,
+                )
+            simulation = batch.simulation
+            for index, scenario_simulation in itertools.izip(scenarios_index, batch.scenario_simulations):
+                simulations[index] = scenario_simulation
+        if profiler is not None:
+            simulation.trace = True
+            simulation.tracer = profiler.make_tracer()
+        if results_reuse is not None:
+            results_reuse.start(scenario_index, simulation)
+        try:
             for variable_name in variables:
                 try:
                     simulation.calculate_output(variable_name, simulation.period)
                 except ParameterNotFound as exc:
-                    raise wsgihelpers.respond_json(ctx,
-                        collections.OrderedDict(sorted(dict(
-                            apiVersion = 1,
-                            context = inputs.get('context'),
-                            error = collections.OrderedDict(sorted(dict(
-                                code = 500,
-                                errors = [{"scenarios": {scenario_index: exc.to_json()}}],
-                                ).iteritems())),
-                            method = req.script_name,
-                            params = inputs,
-                            url = req.url.decode('utf-8'),
-                            ).iteritems())),
-                        headers = headers,
-                        )
-                except VariableNotFound as exc:
-                    wsgihelpers.handle_error(exc, ctx, headers)
-            simulations.append(simulation)
-        return simulations
-
-    total_start_time = time.time()
-
-    ctx = contexts.Ctx(req)
-    headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
-
-    assert req.method == 'POST', req.method
-
-    if conf['load_alert']:
-        try:
-            load_average = os.getloadavg()
-        except (AttributeError, OSError):
-            # When load average is not available, always accept request.
-            pass
-        else:
-            if load_average[0] / environment.cpu_count > 1:
-                return wsgihelpers.respond_json(ctx,
-                    collections.OrderedDict(sorted(dict(
-                        apiVersion = 1,
-                        error = collections.OrderedDict(sorted(dict(
-                            code = 503,  # Service Unavailable
-                            message = ctx._(u'Server is overloaded: {} {} {}').format(*load_average),
-                            ).iteritems())),
-                        method = req.script_name,
-                        url = req.url.decode('utf-8'),
-                        ).iteritems())),
-                    headers = headers,
-                    )
-
-    content_type = req.content_type
-    if content_type is not None:
-        content_type = content_type.split(';', 1)[0].strip()
-    if content_type != 'application/json':
-        return wsgihelpers.respond_json(ctx,
-            collections.OrderedDict(sorted(dict(
-                apiVersion = 1,
-                error = collections.OrderedDict(sorted(dict(
-                    code = 400,  # Bad Request
-                    message = ctx._(u'Bad content-type: {}').format(content_type),
-                    ).iteritems())),
-                method = req.script_name,
-                url = req.url.decode('utf-8'),
-                ).iteritems())),
-            headers = headers,
+                    exc.scenario_index = scenario_index
+                    raise
+        finally:
+            if results_reuse is not None:
+                results_reuse.stop(scenario_index, simulation)
+    return simulations
+
+
+def calculate_values(scenarios, batch, intermediate_variables, output_format, use_label, variables, arrays = False,
+        profiler = None, results_reuse = None):
+    simulations = calculate_simulations(scenarios, variables, batch = batch, profiler = profiler,
+        results_reuse = results_reuse, trace = intermediate_variables)
+    if output_format == 'test_case':
+        return fill_test_cases_with_values(
+            intermediate_variables = intermediate_variables,
+            scenarios = scenarios,
+            simulations = simulations,
+            use_label = use_label,
+            variables = variables,
             )
-
-    inputs, error = conv.pipe(
-        conv.make_input_to_json(object_pairs_hook = collections.OrderedDict),
-        conv.test_isinstance(dict),
-        conv.not_none,
-        )(req.body, state = ctx)
-    if error is not None:
-        return wsgihelpers.respond_json(ctx,
-            collections.OrderedDict(sorted(dict(
-                apiVersion = 1,
-                error = collections.OrderedDict(sorted(dict(
-                    code = 400,  # Bad Request
-                    errors = [conv.jsonify_value(error)],
-                    message = ctx._(u'Invalid JSON in request POST body'),
-                    ).iteritems())),
-                method = req.script_name,
-                params = req.body,
-                url = req.url.decode('utf-8'),
-                ).iteritems())),
-            headers = headers,
+    if output_format == 'columns':
+        return build_output_columns(
+            arrays = arrays,
+            intermediate_variables = intermediate_variables,
+            simulations = simulations,
+            use_label = use_label,
+            variables = variables,
             )
+    assert output_format == 'variables'
+    return build_output_variables(
+        simulations = simulations,
+        use_label = use_label,
+        variables = variables,
+        )
 
-    str_list_to_reforms = conv.make_str_list_to_reforms()
 
-    data, errors = conv.struct(
+def calculate_values_job(job):
+    """Compute in a worker process the values of scenarios given as JSON.
+
+    Return a dict containing either a ``value`` or an ``error``, because OpenFisca exceptions can't be pickled.
+    """
+    ctx = contexts.Ctx()
+    ctx.lang = job['lang']
+    try:
+        tax_benefit_system = workers.get_tax_benefit_system(job['base_reforms'], job['reforms'])
+        scenarios = conv.check(conv.uniform_sequence(
+            tax_benefit_system.Scenario.make_json_to_instance(repair = False, tax_benefit_system = tax_benefit_system),
+            ))(job['scenarios'], state = ctx)
+        return dict(value = calculate_values(scenarios, **job['options']))
+    except ParameterNotFound as exc:
+        return dict(error = dict(
+            code = 500,
+            errors = [{"scenarios": {job['scenarios_index'][exc.scenario_index]: exc.to_json()}}],
+            ))
+    except (ValueError, VariableNotFound) as exc:
+        return dict(error = dict(
+            code = 400,
+            message = u"{}: {}".format(exc.__class__.__name__, exc.message),
+            ))
+
+
+def calculate_values_in_workers(runs, lang, options):
+    """Farm the scenarios of each run out to the worker processes.
+
+    ``runs`` is a list of ``(base_reforms, reforms, scenarios)`` triples. Each run is split into as many jobs as there
+    are workers, so that base and reform runs, and chunks of scenarios, are computed in parallel.
+
+    Return a couple ``(values, error)``, where ``values`` is the list of the values of each run.
+    """
+    jobs = []
+    run_index_by_job_index = []
+    for run_index, (base_reforms, reforms, scenarios) in enumerate(runs):
+        scenarios_json = [scenario.to_json() for scenario in scenarios]
+        for start, stop in workers.split_indexes(len(scenarios_json), workers.pool_size):
+            jobs.append(dict(
+                base_reforms = base_reforms,
+                lang = lang,
+                options = options,
+                reforms = reforms,
+                scenarios = scenarios_json[start:stop],
+                scenarios_index = range(start, stop),
+                ))
+            run_index_by_job_index.append(run_index)
+    values = [[] for run in runs]
+    for run_index, result in itertools.izip(run_index_by_job_index, workers.map_jobs(calculate_values_job, jobs)):
+        error = result.get('error')
+        if error is not None:
+            return None, error
+        values[run_index].extend(result['value'])
+    return values, None
+
+
+def make_results_reuse(base_scenarios, reform_scenarios, intermediate_variables):
+    """Return the reuse of the results of the base scenarios by the reform scenarios, or None when it's not possible.
+
+    The values of the intermediate variables are those traced by the reform simulation, so they prevent any reuse.
+    """
+    if intermediate_variables:
+        return None
+    base_tax_benefit_system = base_scenarios[0].tax_benefit_system
+    reform_tax_benefit_system = reform_scenarios[0].tax_benefit_system
+    return reform_diffs.ResultsReuse(
+        model.get_cached_reform_diff(base_tax_benefit_system, reform_tax_benefit_system),
+        reform_tax_benefit_system,
+        )
+
+
+def make_scenario_item(scenario_index, values, suggestion = None):
+    """Return the result of a scenario, as streamed in NDJSON lines.
+
+    ``values`` contains the value of the scenario for the base run, then for the reform run (if any).
+    """
+    item = dict(
+        scenario_index = scenario_index,
+        suggestion = suggestion,
+        value = values[-1],
+        )
+    if len(values) > 1:
+        item['base_value'] = values[0]
+    return collections.OrderedDict(sorted(item.iteritems()))
+
+
+def make_inputs_to_data(limit_scenarios = True):
+    """Return a converter validating the parameters of a calculation, before the tax-benefit system is known."""
+    str_list_to_reforms = conv.make_str_list_to_reforms()
+    return conv.struct(
         dict(
             base_reforms = str_list_to_reforms,
+            batch = conv.pipe(  # Compute compatible scenarios together, in a single simulation.
+                conv.test_isinstance((bool, int)),
+                conv.anything_to_bool,
+                conv.default(False),
+                ),
             context = conv.test_isinstance(basestring),  # For asynchronous calls
             intermediate_variables = conv.pipe(
                 conv.test_isinstance((bool, int)),
@@ -191,7 +315,7 @@ def api1_calculate(req):
                 ),
             output_format = conv.pipe(
                 conv.test_isinstance(basestring),
-                conv.test_in(['test_case', 'variables']),
+                conv.test_in(['columns', 'test_case', 'variables']),
                 conv.default('test_case'),
                 ),
             reforms = str_list_to_reforms,
@@ -202,14 +326,22 @@ def api1_calculate(req):
                     ),
                 conv.test(lambda scenarios: len(scenarios) >= 1, error = N_(u'At least one scenario is required')),
                 conv.test(lambda scenarios: len(scenarios) <= 100,
-                    error = N_(u"There can't be more than 100 scenarios")),
+                    error = N_(u"There can't be more than 100 scenarios")) if limit_scenarios else conv.noop,
                 conv.not_none,
                 ),
-            time = conv.pipe(
+            stream = conv.pipe(  # Respond one JSON line per scenario, as soon as it is computed.
                 conv.test_isinstance((bool, int)),
                 conv.anything_to_bool,
                 conv.default(False),
                 ),
+            time = conv.pipe(  # true for the duration of each step, "detailed" to also profile the variables
+                conv.test_isinstance((basestring, bool, int)),
+                conv.first_match(
+                    conv.test_equals(u'detailed'),
+                    conv.anything_to_bool,
+                    ),
+                conv.default(False),
+                ),
             trace = conv.pipe(
                 conv.test_isinstance((bool, int)),
                 conv.anything_to_bool,
@@ -235,7 +367,170 @@ def api1_calculate(req):
                 conv.not_none,
                 ),
             ),
-        )(inputs, state = ctx)
+        )
+
+
+def iter_scenarios_values(runs, lang, options):
+    """Compute the scenarios of each run and yield their values as soon as they are computed.
+
+    ``runs`` is a list of ``(base_reforms, reforms, scenarios)`` triples, whose scenarios come from the same JSON.
+
+    Yield ``(scenario_index, values, error)`` triples, where ``values`` contains the value of the scenario for each
+    run. Iteration stops after the first error.
+    """
+    scenarios = runs[-1][2]
+    if options['batch']:
+        scenarios_index_groups = batches.group_scenarios(scenarios)
+    else:
+        scenarios_index_groups = [[scenario_index] for scenario_index in range(len(scenarios))]
+    if workers.pool is None:
+        results = iter_scenarios_groups_results(runs, scenarios_index_groups, options)
+    else:
+        jobs = [
+            dict(
+                base_reforms = base_reforms,
+                lang = lang,
+                options = options,
+                reforms = reforms,
+                scenarios = [run_scenarios[scenario_index].to_json() for scenario_index in scenarios_index],
+                scenarios_index = scenarios_index,
+                )
+            for scenarios_index in scenarios_index_groups
+            for base_reforms, reforms, run_scenarios in runs
+            ]
+        results = workers.imap_jobs(calculate_values_job, jobs)
+    for scenarios_index in scenarios_index_groups:
+        values_by_run = []
+        for run in runs:
+            result = next(results)
+            error = result.get('error')
+            if error is not None:
+                yield scenarios_index[0], None, error
+                return
+            values_by_run.append(result['value'])
+        for position, scenario_index in enumerate(scenarios_index):
+            yield scenario_index, [values[position] for values in values_by_run], None
+
+
+def iter_scenarios_groups_results(runs, scenarios_index_groups, options):
+    """Compute in the current process the groups of scenarios of each run and yield results like calculate_values_job.
+    """
+    results_reuse = make_results_reuse(runs[0][2], runs[-1][2], options['intermediate_variables']) \
+        if len(runs) > 1 else None
+    for scenarios_index in scenarios_index_groups:
+        for base_reforms, reforms, scenarios in runs:
+            try:
+                value = calculate_values([scenarios[scenario_index] for scenario_index in scenarios_index],
+                    results_reuse = results_reuse, **options)
+            except ParameterNotFound as exc:
+                yield dict(error = dict(
+                    code = 500,
+                    errors = [{"scenarios": {scenarios_index[exc.scenario_index]: exc.to_json()}}],
+                    ))
+            except (ValueError, VariableNotFound) as exc:
+                yield dict(error = dict(
+                    code = 400,
+                    message = u"{}: {}".format(exc.__class__.__name__, exc.message),
+                    ))
+            else:
+                yield dict(value = value)
+
+
+@wsgihelpers.wsgify
+@coalescing.coalesce
+@admission.admit
+def api1_calculate(req):
+    wsgihelpers.track(req.url.decode('utf-8'))
+
+    total_start_time = time.time()
+
+    ctx = contexts.Ctx(req)
+    headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
+
+    assert req.method == 'POST', req.method
+
+    content_type = req.content_type
+    if content_type is not None:
+        content_type = content_type.split(';', 1)[0].strip()
+    if content_type != 'application/json':
+        return wsgihelpers.respond_json(ctx,
+            collections.OrderedDict(sorted(dict(
+                apiVersion = 1,
+                error = collections.OrderedDict(sorted(dict(
+                    code = 400,  # Bad Request
+                    message = ctx._(u'Bad content-type: {}').format(content_type),
+                    ).iteritems())),
+                method = req.script_name,
+                url = req.url.decode('utf-8'),
+                ).iteritems())),
+            headers = headers,
+            )
+
+    inputs, error = conv.pipe(
+        conv.make_input_to_json(object_pairs_hook = collections.OrderedDict),
+        conv.test_isinstance(dict),
+        conv.not_none,
+        )(req.body, state = ctx)
+    if error is not None:
+        return wsgihelpers.respond_json(ctx,
+            collections.OrderedDict(sorted(dict(
+                apiVersion = 1,
+                error = collections.OrderedDict(sorted(dict(
+                    code = 400,  # Bad Request
+                    errors = [conv.jsonify_value(error)],
+                    message = ctx._(u'Invalid JSON in request POST body'),
+                    ).iteritems())),
+                method = req.script_name,
+                params = req.body,
+                url = req.url.decode('utf-8'),
+                ).iteritems())),
+            headers = headers,
+            )
+
+    data, errors = make_inputs_to_data()(inputs, state = ctx)
+
+    media_type = None  # of binary responses
+    if errors is None and not data['stream']:
+        data['stream'] = req.accept.best_match(['application/json', 'application/x-ndjson']) \
+            == 'application/x-ndjson'
+        if not data['stream']:
+            media_type = binary.get_media_type(req)
+            if media_type is not None and inputs.get('output_format') is None:
+                data['output_format'] = 'columns'
+
+    response_cache_key = None
+    if errors is None and model.response_cache is not None and not data['stream'] and not data['validate'] \
+            and data['time'] != 'detailed':
+        response_cache_key = caches.canonical_digest(dict(
+            country_package_version = environment.country_package_version,
+            data = {
+                name: value
+                for name, value in data.iteritems()
+                if name not in ('context', 'time')  # These items don't change the computed values.
+                },
+            lang = ctx.lang,  # Suggestions and messages are localized.
+            media_type = media_type,
+            method = 'calculate',
+            ))
+        cached_response_data = model.response_cache.get(response_cache_key)
+        if cached_response_data is not None:
+            headers.append(('Cache-Status', 'openfisca-web-api; hit'))
+            response_data = collections.OrderedDict(sorted(dict(
+                apiVersion = 1,
+                context = data['context'],
+                method = req.script_name,
+                params = inputs,
+                url = req.url.decode('utf-8'),
+                **cached_response_data
+                ).iteritems()))
+            if data['time']:
+                response_data['time'] = collections.OrderedDict(sorted(dict(
+                    total = time.time() - total_start_time,
+                    ).iteritems()))
+            if media_type is not None:
+                return binary.respond(ctx, response_data, media_type, headers = headers)
+            return wsgihelpers.respond_json(ctx, response_data, headers = headers)
+        headers.append(('Cache-Status', 'openfisca-web-api; fwd=miss'))
 
     if errors is None:
         compose_reforms_start_time = time.time()
@@ -270,13 +565,14 @@ def api1_calculate(req):
 
         if errors is None and data['reforms'] is not None:
             try:
-                reform_scenarios, reform_scenarios_errors = conv.uniform_sequence(
-                    reform_tax_benefit_system.Scenario.make_json_to_cached_or_new_instance(
+                # Bind the base scenarios to the reform, instead of converting them again.
+                reform_scenarios, reform_scenarios_errors = \
+                    reform_tax_benefit_system.Scenario.make_json_list_to_bound_or_cached_instances(
+                        base_scenarios = base_scenarios,
                         ctx = ctx,
                         repair = data['validate'],
                         tax_benefit_system = reform_tax_benefit_system,
-                        )
-                    )(data['scenarios'], state = ctx)
+                        )(data['scenarios'], state = ctx)
             except (ValueError, VariableNotFound) as exc:
                 wsgihelpers.handle_error(exc, ctx, headers)
             errors = {'scenarios': reform_scenarios_errors} if reform_scenarios_errors is not None else None
@@ -330,6 +626,11 @@ def api1_calculate(req):
     if not suggestions:
         suggestions = None
 
+    if data['reforms'] is not None and not data['validate']:
+        # Compute the base run from the same repaired test cases as the reform run.
+        for scenario in base_scenarios:
+            scenario.suggest()
+
     if data['validate']:
         # Only a validation is requested. Don't launch simulation
         total_end_time = time.time()
@@ -359,47 +660,81 @@ def api1_calculate(req):
 
     calculate_simulation_start_time = time.time()
 
-    trace_simulations = data['intermediate_variables']
-
-    try:
-        base_simulations = calculate_simulations(scenarios, data['variables'], trace = trace_simulations)
+    calculate_options = dict(
+        arrays = media_type is not None,
+        batch = data['batch'],
+        intermediate_variables = data['intermediate_variables'],
+        output_format = data['output_format'],
+        use_label = data['labels'],
+        variables = data['variables'],
+        )
+
+    if data['stream']:
+        runs = [(data['base_reforms'], None, base_scenarios)]
         if data['reforms'] is not None:
-            reform_simulations = calculate_simulations(reform_scenarios, data['variables'], trace = trace_simulations)
-    except ValueError as exc:
-        wsgihelpers.handle_error(exc, ctx, headers)
+            runs.append((data['base_reforms'], data['reforms'], reform_scenarios))
+
+        def iter_items():
+            for scenario_index, values, error in iter_scenarios_values(runs, ctx.lang, calculate_options):
+                if error is not None:
+                    yield collections.OrderedDict(sorted(dict(
+                        error = collections.OrderedDict(sorted(error.iteritems())),
+                        scenario_index = scenario_index,
+                        ).iteritems()))
+                    return
+                yield make_scenario_item(
+                    scenario_index,
+                    values,
+                    suggestion = suggestions['scenarios'].get(scenario_index) if suggestions is not None else None,
+                    )
 
-    calculate_simulation_end_time = time.time()
-    calculate_simulation_time = calculate_simulation_end_time - calculate_simulation_start_time
+        return wsgihelpers.respond_ndjson(ctx, iter_items(), headers = headers)
 
-    if data['output_format'] == 'test_case':
-        base_value = fill_test_cases_with_values(
-            intermediate_variables = data['intermediate_variables'],
-            scenarios = base_scenarios,
-            simulations = base_simulations,
-            use_label = data['labels'],
-            variables = data['variables'],
-            )
-        if data['reforms'] is not None:
-            reform_value = fill_test_cases_with_values(
-                intermediate_variables = data['intermediate_variables'],
-                scenarios = reform_scenarios,
-                simulations = reform_simulations,
-                use_label = data['labels'],
-                variables = data['variables'],
+    # Variables can only be profiled when they are computed in this process.
+    profiler = profiling.Profiler() if data['time'] == 'detailed' else None
+    reform_value = None
+    if workers.pool is None or profiler is not None:
+        try:
+            results_reuse = make_results_reuse(base_scenarios, reform_scenarios, data['intermediate_variables']) \
+                if data['reforms'] is not None else None
+            base_value = calculate_values(base_scenarios, profiler = profiler, results_reuse = results_reuse,
+                **calculate_options)
+            if data['reforms'] is not None:
+                reform_value = calculate_values(reform_scenarios, profiler = profiler, results_reuse = results_reuse,
+                    **calculate_options)
+        except ParameterNotFound as exc:
+            error = dict(
+                code = 500,
+                errors = [{"scenarios": {exc.scenario_index: exc.to_json()}}],
                 )
+        except (ValueError, VariableNotFound) as exc:
+            wsgihelpers.handle_error(exc, ctx, headers)
+        else:
+            error = None
     else:
-        assert data['output_format'] == 'variables'
-        base_value = build_output_variables(
-            simulations = base_simulations,
-            use_label = data['labels'],
-            variables = data['variables'],
-            )
+        runs = [(data['base_reforms'], None, base_scenarios)]
         if data['reforms'] is not None:
-            reform_value = build_output_variables(
-                simulations = reform_simulations,
-                use_label = data['labels'],
-                variables = data['variables'],
-                )
+            runs.append((data['base_reforms'], data['reforms'], reform_scenarios))
+        runs_value, error = calculate_values_in_workers(runs, ctx.lang, calculate_options)
+        if error is None:
+            base_value = runs_value[0]
+            if data['reforms'] is not None:
+                reform_value = runs_value[1]
+    if error is not None:
+        return wsgihelpers.respond_json(ctx,
+            collections.OrderedDict(sorted(dict(
+                apiVersion = 1,
+                context = inputs.get('context'),
+                error = collections.OrderedDict(sorted(error.iteritems())),
+                method = req.script_name,
+                params = inputs,
+                url = req.url.decode('utf-8'),
+                ).iteritems())),
+            headers = headers,
+            )
+
+    calculate_simulation_end_time = time.time()
+    calculate_simulation_time = calculate_simulation_end_time - calculate_simulation_start_time
 
     simulations_variables_json = None
     tracebacks_json = None
@@ -428,5 +763,21 @@ def api1_calculate(req):
             calculate_simulation = calculate_simulation_time,
             total = total_time,
             ).iteritems()))
+        if profiler is not None:
+            response_data['time']['variables'] = profiler.to_json(limit = PROFILED_VARIABLES_COUNT)
 
-    return wsgihelpers.respond_json(ctx, response_data, headers = headers)
+    if media_type is not None:
+        response = binary.respond(ctx, response_data, media_type, headers = headers)
+    else:
+        response = wsgihelpers.respond_json(ctx, response_data, headers = headers)
+    if response_cache_key is not None:
+        model.response_cache.set(
+            response_cache_key,
+            dict(
+                base_value = response_data.get('base_value'),
+                suggestions = suggestions,
+                value = response_data['value'],
+                ),
+            size = len(response.body),
+            )
+    return response
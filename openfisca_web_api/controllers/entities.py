@@ -6,10 +6,11 @@
 
 import collections
 
-from .. import contexts, conv, model, wsgihelpers
+from .. import contexts, conv, http_caching, model, wsgihelpers
 
 
 @wsgihelpers.wsgify
+@http_caching.conditional()
 def api2_entities(req):
     wsgihelpers.track(req.url.decode('utf-8'))
     ctx = contexts.Ctx(req)
@@ -8,10 +8,11 @@ import collections
 
 from openfisca_core import columns
 
-from .. import contexts, conv, model, wsgihelpers
+from .. import contexts, conv, http_caching, model, wsgihelpers
 
 
 @wsgihelpers.wsgify
+@http_caching.conditional()
 def api1_field(req):
     wsgihelpers.track(req.url.decode('utf-8'))
     ctx = contexts.Ctx(req)
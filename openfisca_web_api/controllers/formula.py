@@ -5,15 +5,23 @@
 
 
 from datetime import datetime
+import json
+import re
 
 import numpy as np
-from openfisca_core import periods, simulations, columns
+from openfisca_core import periods, simulations
+from openfisca_core.indexed_enums import Enum, EnumArray
 from openfisca_core.taxbenefitsystems import VariableNotFound
 
-from .. import contexts, conv, model, wsgihelpers
+from .. import admission, binary, coalescing, contexts, http_caching, model, wsgihelpers
+
+
+BATCH_MAX_COUNT = 10000  # Maximum number of persons of a batch request, or of values of a sweep
+sweep_re = re.compile(ur'-?\d+(\.\d*)?:-?\d+(\.\d*)?:\d+$')  # start:stop:count
 
 
 @wsgihelpers.wsgify
+@http_caching.conditional(dated = True)
 def api1_formula(req):
     API_VERSION = 1
     wsgihelpers.track(req.url.decode('utf-8'))
@@ -34,6 +42,8 @@ def api1_formula(req):
 
 
 @wsgihelpers.wsgify
+@http_caching.conditional(dated = True)
+@coalescing.coalesce
 def api2_formula(req):
     """
 A simple `GET`-, URL-based API to OpenFisca, making the assumption of computing formulas for a single person.
@@ -50,6 +60,21 @@ Example:
 
 This will compute both `salaire_super_brut` and `salaire_net_a_payer` in a single request.
 
+Sweep
+-----
+
+A numeric parameter can be given as `start:stop:count`, to compute formulas for `count` evenly spaced values of this
+parameter, from `start` to `stop` (included), the other parameters being the same. `start` and `stop` are decimal
+numbers and `count` is an integer; other values containing `:` are not sweeps.
+
+Example:
+```
+/salaire_net_a_payer?salaire_de_base=0:6000:200
+```
+
+This will return the 200 values of `salaire_de_base` in `params`, and the 200 values of `salaire_net_a_payer`, in the
+same order, in `values`.
+
 Reforms
 -----------
 
@@ -70,46 +95,144 @@ If used within the browser, make sure the resulting URL is kept
 for cross-browser compatibility, by splitting combined requests.
 On a server, just test what your library handles.
 """
+    if req.method == 'POST':
+        return api2_formula_batch(req)
+    if any(sweep_re.match(value) for value in req.GET.itervalues()):
+        return api2_formula_sweep(req)
+    return compute_formulas(req)
+
+
+def compute_formulas(req):
     API_VERSION = '2.1.0'
     wsgihelpers.track(req.url.decode('utf-8'))
     params = dict(req.GET)
     data = dict()
+    headers = []
 
     try:
-        extensions_header = req.headers.get('X-Openfisca-Extensions')
+        tax_benefit_system = get_tax_benefit_system(req)
+        sweep_name, sweep_values = parse_sweep(params, tax_benefit_system)
+        params = normalize(params, tax_benefit_system)
+        formula_names = req.urlvars.get('names').split('+')
 
-        tax_benefit_system = model.get_cached_composed_reform(
-            reform_keys = extensions_header.split(','),
-            tax_benefit_system = model.tax_benefit_system,
-            ) if extensions_header is not None else model.tax_benefit_system
+        data['values'] = dict()
+        data['period'] = parse_period(req.urlvars.get('period'))
 
-        params = normalize(params, tax_benefit_system)
+        keep_array = binary.get_media_type(req) is not None
+        formula_cache_key = (
+            getattr(tax_benefit_system, 'full_key', None),
+            str(data['period']),
+            tuple(formula_names),
+            keep_array,
+            tuple(sorted(params.iteritems())),
+            (sweep_name, req.GET[sweep_name]) if sweep_name is not None else None,
+            )
+        cached_values = model.formula_cache.get(formula_cache_key) if model.formula_cache is not None else None
+        if cached_values is not None:
+            headers.append(('Cache-Status', 'openfisca-web-api; hit'))
+            data['values'].update(cached_values)
+        elif sweep_name is not None:
+            # A single simulation, with one person by value of the swept parameter
+            count = len(sweep_values)
+            batch_params = dict(
+                (name, [value] * count)
+                for name, value in params.iteritems()
+                )
+            batch_params[sweep_name] = sweep_values
+            simulation = create_batch_simulation(batch_params, count, data['period'], tax_benefit_system)
+
+            for formula_name in formula_names:
+                column = get_column_from_formula_name(formula_name, tax_benefit_system)
+                data['values'][formula_name] = compute_values(column.name, simulation, keep_array = keep_array)
+        else:
+            simulation = create_simulation(params, data['period'], tax_benefit_system)
+
+            for formula_name in formula_names:
+                column = get_column_from_formula_name(formula_name, tax_benefit_system)
+                data['values'][formula_name] = compute(column.name, simulation, keep_array = keep_array)
+
+        if cached_values is None and model.formula_cache is not None:
+            model.formula_cache.set(formula_cache_key, data['values'].copy(), size = get_values_size(data['values']))
+
+        if sweep_name is not None:
+            params[sweep_name] = sweep_values
+
+    except Exception as error:
+        data['error'] = exception_to_error(error)
+    finally:
+        return respond(req, API_VERSION, data, params, headers = headers)
+
+
+# A sweep computes a simulation of up to BATCH_MAX_COUNT persons, so it waits for admission, like a batch.
+api2_formula_sweep = admission.admit(compute_formulas)
+
+
+@admission.admit
+def api2_formula_batch(req):
+    """
+Compute formulas for many persons at once, each with its own parameters, in a single simulation.
+
+The body of the `POST` request gives the parameters of each person, either as a list of objects (one by person):
+```
+[{"salaire_de_base": 1300}, {"salaire_de_base": 1400}]
+```
+or as an object giving the list of the values of each parameter (one by person):
+```
+{"salaire_de_base": [1300, 1400]}
+```
+Parameters missing for a person take their default value.
+
+Each formula gets the list of its values, in the order of the persons.
+"""
+    API_VERSION = '2.1.0'
+    wsgihelpers.track(req.url.decode('utf-8'))
+    params = None
+    data = dict()
+
+    try:
+        tax_benefit_system = get_tax_benefit_system(req)
+        params, count = parse_batch_params(req.body)
+        params = normalize_batch(params, tax_benefit_system)
         formula_names = req.urlvars.get('names').split('+')
 
         data['values'] = dict()
         data['period'] = parse_period(req.urlvars.get('period'))
 
-        simulation = create_simulation(params, data['period'], tax_benefit_system)
+        simulation = create_batch_simulation(params, count, data['period'], tax_benefit_system)
+        keep_array = binary.get_media_type(req) is not None
 
         for formula_name in formula_names:
             column = get_column_from_formula_name(formula_name, tax_benefit_system)
-            data['values'][formula_name] = compute(column.name, simulation)
+            data['values'][formula_name] = compute_values(column.name, simulation, keep_array = keep_array)
 
     except Exception as error:
-        if isinstance(error.args[0], dict):  # we raised it ourselves, in this controller
-            error = error.args[0]
-        else:
-            error = dict(
-                message = unicode(error),
-                code = 500
-                )
-
-        data['error'] = error
+        data['error'] = exception_to_error(error)
     finally:
         return respond(req, API_VERSION, data, params)
 
 
+def exception_to_error(error):
+    if error.args and isinstance(error.args[0], dict):  # we raised it ourselves, in this controller
+        return error.args[0]
+    return dict(
+        message = unicode(error),
+        code = 500
+        )
+
+
+def get_tax_benefit_system(req):
+    extensions_header = req.headers.get('X-Openfisca-Extensions')
+
+    return model.get_cached_composed_reform(
+        reform_keys = extensions_header.split(','),
+        tax_benefit_system = model.tax_benefit_system,
+        ) if extensions_header is not None else model.tax_benefit_system
+
+
 def get_column_from_formula_name(formula_name, tax_benefit_system):
+    if formula_name in model.get_cached_variables_index(tax_benefit_system).computable_variables_name:
+        return tax_benefit_system.variables[formula_name]
+
     try:
         result = tax_benefit_system.get_variable(formula_name, check_existence = True)
     except VariableNotFound as exc:
@@ -143,12 +266,13 @@ def normalize(params, tax_benefit_system):
 
 
 def normalize_param(name, value, tax_benefit_system):
-    variable = tax_benefit_system.get_variable(name, check_existence = True)
-    column = columns.make_column_from_variable(variable)
+    input_to_dated_python_by_name = model.get_cached_variables_index(tax_benefit_system).input_to_dated_python_by_name
+    if name not in input_to_dated_python_by_name:
+        raise VariableNotFound(name, tax_benefit_system)
+    input_to_dated_python = input_to_dated_python_by_name[name]
 
-    result, error = conv.pipe(
-        column.input_to_dated_python  # if column is not a date, this will be None and conv.pipe will be pass-through
-        )(value)
+    # if column is not a date, this will be None and the value is kept as is
+    result, error = input_to_dated_python(value) if input_to_dated_python is not None else (value, None)
 
     if error is not None:
         raise Exception(dict(
@@ -159,6 +283,118 @@ def normalize_param(name, value, tax_benefit_system):
     return result
 
 
+def parse_batch_params(body):
+    """Return the lists of values of the parameters given in the body of a batch request, and the number of persons.
+
+    >>> parse_batch_params('[{"a": 1}, {"a": 2, "b": 3}]')
+    ({u'a': [1, 2], u'b': [None, 3]}, 2)
+    >>> parse_batch_params('{"a": [1, 2]}')
+    ({u'a': [1, 2]}, 2)
+    """
+    try:
+        inputs = json.loads(body)
+    except ValueError:
+        raise Exception(dict(
+            code = 400,
+            message = u"The body of the request could not be parsed as JSON"
+            ))
+
+    if isinstance(inputs, list) and all(isinstance(row, dict) for row in inputs):
+        count = len(inputs)
+        names = set(name for row in inputs for name in row)
+        result = dict(
+            (name, [row.get(name) for row in inputs])
+            for name in names
+            )
+    elif isinstance(inputs, dict) and inputs and all(isinstance(values, list) for values in inputs.itervalues()):
+        counts = set(len(values) for values in inputs.itervalues())
+        if len(counts) != 1:
+            raise Exception(dict(
+                code = 400,
+                message = u"The lists of values of the parameters don't have the same length"
+                ))
+        count = counts.pop()
+        result = inputs
+    else:
+        raise Exception(dict(
+            code = 400,
+            message = u"The body of the request must be a list of parameters objects, or an object of parameters lists"
+            ))
+
+    if not 1 <= count <= BATCH_MAX_COUNT:
+        raise Exception(dict(
+            code = 400,
+            message = u"The number of persons must be between 1 and {}".format(BATCH_MAX_COUNT)
+            ))
+
+    return result, count
+
+
+def normalize_batch(params, tax_benefit_system):
+    result = dict()
+
+    try:
+        for param_name, values in params.iteritems():
+            result[param_name] = [
+                # JSON numbers are normalized like the strings of a query.
+                normalize_param(param_name, value if isinstance(value, (basestring, bool)) or value is None
+                    else unicode(value), tax_benefit_system)
+                for value in values
+                ]
+    except VariableNotFound as exc:
+        raise Exception(dict(
+            code = 400,
+            message = exc.message
+            ))
+    return result
+
+
+def parse_sweep(params, tax_benefit_system):
+    """Remove the swept parameter (given as ``start:stop:count``) from the query parameters.
+
+    Return its name and its values, or ``(None, None)`` when no parameter is swept.
+    """
+    swept_names = [
+        name
+        for name, value in params.iteritems()
+        if sweep_re.match(value)
+        ]
+    if not swept_names:
+        return None, None
+    if len(swept_names) > 1:
+        raise Exception(dict(
+            code = 400,
+            message = u"Only one parameter can be swept, but {} are".format(u', '.join(sorted(swept_names)))
+            ))
+    name = swept_names[0]
+
+    try:
+        variable = tax_benefit_system.get_variable(name, check_existence = True)
+    except VariableNotFound as exc:
+        raise Exception(dict(
+            code = 400,
+            message = exc.message
+            ))
+    if variable.value_type not in (float, int):
+        raise Exception(dict(
+            code = 400,
+            message = u"Parameter '{}' can't be swept, because it is not numeric".format(name)
+            ))
+
+    start, stop, count = params[name].split(':')
+    start = float(start)
+    stop = float(stop)
+    count = int(count)
+    if not 1 <= count <= BATCH_MAX_COUNT:
+        raise Exception(dict(
+            code = 400,
+            message = u"The number of values of a sweep must be between 1 and {}".format(BATCH_MAX_COUNT)
+            ))
+
+    del params[name]
+    return name, np.linspace(start, stop, count).astype(variable.dtype).tolist()
+
+
 def parse_period(period_descriptor):
     period_descriptor = period_descriptor or default_period()
 
@@ -190,62 +426,179 @@ def default_period():
 # data: dict. Will be transformed to JSON and added to the response root.
 #       `data` will be mutated. Currently considered acceptable because responding marks process end.
 # params: dict. Parsed parameters. Will be echoed in the "params" key.
-def respond(req, version, data, params):
+# headers: list. Headers added to the response.
+def respond(req, version, data, params, headers = []):
     data.update(dict(
         apiVersion = version,
         params = params
         ))
 
     ctx = contexts.Ctx(req)
+    headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx) + headers
+
+    media_type = binary.get_media_type(req)
+    if media_type is not None and 'error' not in data:
+        return binary.respond(
+            ctx,
+            data,
+            media_type,
+            headers = headers,
+            json_dumps_default = wsgihelpers.convert_date_to_json,
+            )
 
     return wsgihelpers.respond_json(
         ctx,
         data,
-        headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx),
+        headers = headers,
         json_dumps_default = wsgihelpers.convert_date_to_json,
         )
 
 
-def compute(formula_name, simulation):
+def compute(formula_name, simulation, keep_array = False):
+    values = compute_values(formula_name, simulation, keep_array = keep_array)
+    if isinstance(values, np.ndarray):
+        return values  # A one-cell array, for binary encodings
+    return values[0]
+
+
+def compute_values(formula_name, simulation, keep_array = False):
+    """Return the values of a formula for every person of the simulation, as an array or as a JSON list."""
     array = simulation.calculate(formula_name, simulation.period)
-    column = columns.make_column_from_variable(simulation.tax_benefit_system.get_variable(formula_name))
-    transform_dated_value_to_json = column.transform_dated_value_to_json
-    return transform_dated_value_to_json(array.tolist()[0])
+    if keep_array and array.dtype.kind in 'biuf' and not isinstance(array, EnumArray):
+        return array
+    transform_dated_value_to_json = model.get_cached_variables_index(
+        simulation.tax_benefit_system).transform_dated_value_to_json_by_name[formula_name]
+    return [
+        transform_dated_value_to_json(value)
+        for value in array.tolist()
+        ]
+
+
+def get_values_size(values):
+    """Return the approximate size, in bytes, of the values computed by a request.
+
+    >>> get_values_size(dict(a = 1.5, b = np.array([1.5])))
+    13
+    """
+    return sum(
+        len(name) + (value.nbytes if isinstance(value, np.ndarray) else len(repr(value)))
+        for name, value in values.iteritems()
+        )
 
 
 def create_simulation(data, period, tax_benefit_system):
-    result = simulations.Simulation(
+    key = (getattr(tax_benefit_system, 'full_key', None), str(period))
+    simulation_template = model.simulation_template_by_key.get(key)
+    if simulation_template is None:
+        simulation_template = SimulationTemplate(period, tax_benefit_system)
+        model.simulation_template_by_key.set(key, simulation_template)
+    return simulation_template.new_simulation(data)
+
+
+class SimulationTemplate(object):
+    """A simulation of a single person, without any value, to clone for each request"""
+
+    def __init__(self, period, tax_benefit_system):
+        self.simulation = new_persons_simulation(1, period, tax_benefit_system)
+        self.input_periods = get_input_periods(period)
+
+    def new_simulation(self, data):
+        simulation = self.simulation.clone()
+        # Not reset by clone()
+        simulation.requested_periods_by_variable_name = {}
+        for entity in simulation.entities.itervalues():
+            if not entity.is_person:
+                entity.members = simulation.persons
+
+        # Inject all variables from query string into arrays.
+        dtype_by_name = model.get_cached_variables_index(simulation.tax_benefit_system).dtype_by_name
+        for column_name, value in data.iteritems():
+            holder = simulation.get_holder(column_name)
+            # The same array is shared by every period, because cached arrays are never modified.
+            try:
+                array = np.array([value], dtype = dtype_by_name[column_name])
+            except (TypeError, ValueError):
+                raise Exception(dict(
+                    code = 400,
+                    message = u"Parameter '{}' could not be converted: {!r}".format(column_name, value)
+                    ))
+            for input_period in self.input_periods:
+                holder.put_in_cache(array, input_period)
+
+        return simulation
+
+
+def create_batch_simulation(data, count, period, tax_benefit_system):
+    """Return a simulation of ``count`` persons, whose inputs are given as lists of values by name."""
+    simulation = new_persons_simulation(count, period, tax_benefit_system)
+    input_periods = get_input_periods(period)
+
+    dtype_by_name = model.get_cached_variables_index(tax_benefit_system).dtype_by_name
+    for column_name, values in data.iteritems():
+        variable = tax_benefit_system.variables[column_name]
+        default_value = variable.default_value
+        if variable.value_type == Enum:
+            # Encoded from the names of the items, like the parameters of a GET request
+            default_value = default_value.name
+        values = [default_value if value is None else value for value in values]
+        array = values_to_array(column_name, values, dtype_by_name[column_name])
+        holder = simulation.get_holder(column_name)
+        for input_period in input_periods:
+            holder.put_in_cache(array, input_period)
+
+    return simulation
+
+
+def values_to_array(name, values, dtype):
+    """Return the array of the values of a parameter, or raise a 400 error giving the first invalid value.
+
+    >>> values_to_array('a', [u'1', u'2'], np.int32)
+    array([1, 2], dtype=int32)
+    >>> values_to_array('a', [u'1', u'1.5'], np.int32)  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    Exception: {...u"Parameter 'a' of person 1 could not be converted: u'1.5'"...}
+    """
+    try:
+        return np.array(values, dtype = dtype)
+    except (TypeError, ValueError):
+        for index, value in enumerate(values):
+            try:
+                np.array([value], dtype = dtype)
+            except (TypeError, ValueError):
+                raise Exception(dict(
+                    code = 400,
+                    message = u"Parameter '{}' of person {} could not be converted: {!r}".format(name, index, value)
+                    ))
+        raise
+
+
+def get_input_periods(period):
+    """Return the periods for which the inputs of a simulation are given."""
+    if period.unit == 'year':
+        return [period]
+    if period.unit == 'month':
+        # Inject inputs for all months of year
+        return period.this_year.get_subperiods(periods.MONTH)
+    return []
+
+
+def new_persons_simulation(count, period, tax_benefit_system):
+    """Return a simulation of ``count`` persons without values, each person being alone in its own entities."""
+    simulation = simulations.Simulation(
         debug = False,
         period = period,
         tax_benefit_system = tax_benefit_system,
         )
-    # Initialize entities, assuming there is only one person and one of each other entities ("familles",
-    # "foyers fiscaux", etc).
-    for entity in result.entities.itervalues():
-        entity.count = 1
+    # Initialize entities, assuming there is one of each other entities ("familles", "foyers fiscaux", etc) for
+    # each person.
+    for entity in simulation.entities.itervalues():
+        entity.count = count
         entity.roles_count = 1
         entity.step_size = 1
-    # Link person to its entities using ID & role.
-    for entity in result.entities.itervalues():
+    # Link persons to their entities using ID & role.
+    for entity in simulation.entities.itervalues():
         if not entity.is_person:
-            entity.members_entity_id = np.array([0])
-            entity.members_legacy_role = np.array([0])
-            entity.members_role = np.array([0])
-
-    # Inject all variables from query string into arrays.
-    for column_name, value in data.iteritems():
-        column = tax_benefit_system.variables[column_name]
-        holder = result.get_holder(column_name)
-
-        if period.unit == 'year':
-            holder.put_in_cache(np.array([value], dtype = column.dtype), period)
-        elif period.unit == 'month':
-            # Inject inputs for all months of year
-            year = period.start.year
-            month_index = 1
-            while month_index <= 12:
-                month = periods.period('{}-{:02d}'.format(year, month_index))
-                holder.put_in_cache(np.array([value], dtype = column.dtype), month)
-                month_index += 1
-
-    return result
+            entity.members_entity_id = np.arange(count)
+            entity.members_legacy_role = np.zeros(count, dtype = int)
+            entity.members_role = np.zeros(count, dtype = int)
+    return simulation
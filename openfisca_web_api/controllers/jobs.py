@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+
+"""Jobs controller
+
+Asynchronous calculations, without limit on the number of scenarios
+"""
+
+
+import collections
+import json
+
+from . import calculate
+from .. import conf, contexts, conv, jobs, model, urls, wsgihelpers
+
+
+SCENARIOS_CHUNK_SIZE = 100  # Number of scenarios computed between two updates of the progress of a job
+
+
+def make_job_json(ctx, status):
+    job_json = collections.OrderedDict(sorted(status.iteritems()))
+    job_json['results_url'] = urls.get_full_url(ctx, 'api', 1, 'jobs', status['id'], 'results')
+    job_json['url'] = urls.get_full_url(ctx, 'api', 1, 'jobs', status['id'])
+    return job_json
+
+
+def shift_error_scenarios_index(error, start):
+    """Return an error of calculate.iter_scenarios_values, the indexes of its scenarios being shifted by ``start``.
+
+    >>> shift_error_scenarios_index({'code': 500, 'errors': [{'scenarios': {0: 'error'}}]}, 100)
+    {'code': 500, 'errors': [{'scenarios': {100: 'error'}}]}
+    """
+    errors = error.get('errors')
+    if errors is None:
+        return error
+    return dict(error, errors = [
+        dict(error_json, scenarios = {
+            start + int(scenario_index): scenario_error
+            for scenario_index, scenario_error in error_json['scenarios'].iteritems()
+            }) if isinstance(error_json, dict) and 'scenarios' in error_json else error_json
+        for error_json in errors
+        ])
+
+
+def run_calculate_job(job_id):
+    """Compute the scenarios of a job, chunk after chunk, and append their results to the job store."""
+    request_json = jobs.store.load_request(job_id)
+    ctx = contexts.Ctx()
+    ctx.lang = request_json['lang']
+    data = conv.check(calculate.make_inputs_to_data(limit_scenarios = False))(request_json['inputs'], state = ctx)
+
+    base_tax_benefit_system = model.get_cached_composed_reform(
+        reform_keys = data['base_reforms'],
+        tax_benefit_system = model.tax_benefit_system,
+        ) if data['base_reforms'] is not None else model.tax_benefit_system
+    tax_benefit_system_by_reforms = [(None, base_tax_benefit_system)]
+    if data['reforms'] is not None:
+        tax_benefit_system_by_reforms.append((data['reforms'], model.get_cached_composed_reform(
+            reform_keys = data['reforms'],
+            tax_benefit_system = base_tax_benefit_system,
+            )))
+    calculate_options = dict(
+        batch = data['batch'],
+        intermediate_variables = data['intermediate_variables'],
+        output_format = data['output_format'],
+        use_label = data['labels'],
+        variables = data['variables'],
+        )
+
+    scenarios_json = data['scenarios']
+    for start in xrange(0, len(scenarios_json), SCENARIOS_CHUNK_SIZE):
+        chunk_scenarios_json = scenarios_json[start:start + SCENARIOS_CHUNK_SIZE]
+        runs = []
+        suggestion_by_scenario_index = {}
+        for reforms, tax_benefit_system in tax_benefit_system_by_reforms:
+            scenarios, errors = conv.uniform_sequence(
+                tax_benefit_system.Scenario.make_json_to_instance(
+                    repair = False,
+                    tax_benefit_system = tax_benefit_system,
+                    ),
+                )(chunk_scenarios_json, state = ctx)
+            if errors is not None:
+                jobs.store.set_status(job_id,
+                    error = collections.OrderedDict(sorted(dict(
+                        code = 400,  # Bad Request
+                        errors = [conv.jsonify_value({'scenarios': {
+                            start + scenario_index: error
+                            for scenario_index, error in errors.iteritems()
+                            }})],
+                        message = ctx._(u'Bad parameters in request'),
+                        ).iteritems())),
+                    state = 'failed',
+                    )
+                return
+            for scenario_index, scenario in enumerate(scenarios):
+                suggestion = scenario.suggest()  # This modifies scenario.test_case!
+                if suggestion is not None:
+                    suggestion_by_scenario_index[scenario_index] = suggestion
+            runs.append((data['base_reforms'], reforms, scenarios))
+
+        items = []
+        for scenario_index, values, error in calculate.iter_scenarios_values(runs, ctx.lang, calculate_options):
+            if error is not None:
+                jobs.store.set_status(job_id,
+                    error = collections.OrderedDict(sorted(dict(shift_error_scenarios_index(error, start),
+                        scenario_index = start + scenario_index).iteritems())),
+                    state = 'failed',
+                    )
+                return
+            items.append(calculate.make_scenario_item(
+                start + scenario_index,
+                values,
+                suggestion = suggestion_by_scenario_index.get(scenario_index),
+                ))
+        items.sort(key = lambda item: item['scenario_index'])
+        jobs.store.append_results(job_id, items)
+        jobs.store.set_status(job_id, done = start + len(chunk_scenarios_json))
+    jobs.store.set_status(job_id, state = 'done')
+
+
+@wsgihelpers.wsgify
+def api1_job(req):
+    ctx = contexts.Ctx(req)
+    headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
+
+    assert req.method == 'GET', req.method
+    status = jobs.store.get_status(req.urlvars['id'])
+    if status is None:
+        return wsgihelpers.respond_json(ctx,
+            collections.OrderedDict(sorted(dict(
+                apiVersion = 1,
+                error = collections.OrderedDict(sorted(dict(
+                    code = 404,  # Not Found
+                    message = ctx._(u'Job not found (or expired)'),
+                    ).iteritems())),
+                method = req.script_name,
+                url = req.url.decode('utf-8'),
+                ).iteritems())),
+            headers = headers,
+            )
+
+    return wsgihelpers.respond_json(ctx,
+        collections.OrderedDict(sorted(dict(
+            apiVersion = 1,
+            method = req.script_name,
+            url = req.url.decode('utf-8'),
+            value = make_job_json(ctx, status),
+            ).iteritems())),
+        headers = headers,
+        )
+
+
+@wsgihelpers.wsgify
+def api1_job_results(req):
+    ctx = contexts.Ctx(req)
+    headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
+
+    assert req.method == 'GET', req.method
+    params = req.GET
+    inputs = dict(
+        limit = params.get('limit'),
+        offset = params.get('offset'),
+        stream = params.get('stream'),
+        )
+    data, errors = conv.struct(
+        dict(
+            limit = conv.pipe(
+                conv.input_to_int,
+                conv.test_between(1, 1000),
+                conv.default(100),
+                ),
+            offset = conv.pipe(
+                conv.input_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(0),
+                ),
+            stream = conv.pipe(
+                conv.guess_bool,
+                conv.default(False),
+                ),
+            ),
+        )(inputs, state = ctx)
+    if errors is not None:
+        return wsgihelpers.respond_json(ctx,
+            collections.OrderedDict(sorted(dict(
+                apiVersion = 1,
+                error = collections.OrderedDict(sorted(dict(
+                    code = 400,  # Bad Request
+                    errors = [conv.jsonify_value(errors)],
+                    message = ctx._(u'Bad parameters in request'),
+                    ).iteritems())),
+                method = req.script_name,
+                params = inputs,
+                url = req.url.decode('utf-8'),
+                ).iteritems())),
+            headers = headers,
+            )
+
+    job_id = req.urlvars['id']
+    status = jobs.store.get_status(job_id)
+    if status is None:
+        return wsgihelpers.respond_json(ctx,
+            collections.OrderedDict(sorted(dict(
+                apiVersion = 1,
+                error = collections.OrderedDict(sorted(dict(
+                    code = 404,  # Not Found
+                    message = ctx._(u'Job not found (or expired)'),
+                    ).iteritems())),
+                method = req.script_name,
+                url = req.url.decode('utf-8'),
+                ).iteritems())),
+            headers = headers,
+            )
+
+    if data['stream'] or req.accept.best_match(['application/json', 'application/x-ndjson']) \
+            == 'application/x-ndjson':
+        # Stream every available result, without limit.
+        return wsgihelpers.respond_ndjson_lines(ctx,
+            jobs.store.iter_results_lines(job_id, offset = data['offset']),
+            headers = headers,
+            )
+
+    items = [
+        json.loads(line)
+        for line in jobs.store.iter_results_lines(job_id, limit = data['limit'], offset = data['offset'])
+        ]
+    next_offset = data['offset'] + len(items)
+    return wsgihelpers.respond_json(ctx,
+        collections.OrderedDict(sorted(dict(
+            apiVersion = 1,
+            job = make_job_json(ctx, status),
+            method = req.script_name,
+            next_url = urls.get_full_url(ctx, 'api', 1, 'jobs', job_id, 'results', limit = data['limit'],
+                offset = next_offset) if next_offset < status['done'] else None,
+            params = inputs,
+            url = req.url.decode('utf-8'),
+            value = items,
+            ).iteritems())),
+        headers = headers,
+        )
+
+
+@wsgihelpers.wsgify
+def api1_jobs(req):
+    ctx = contexts.Ctx(req)
+    headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
+
+    assert req.method == 'POST', req.method
+
+    content_type = req.content_type
+    if content_type is not None:
+        content_type = content_type.split(';', 1)[0].strip()
+    if content_type != 'application/json':
+        return wsgihelpers.respond_json(ctx,
+            collections.OrderedDict(sorted(dict(
+                apiVersion = 1,
+                error = collections.OrderedDict(sorted(dict(
+                    code = 400,  # Bad Request
+                    message = ctx._(u'Bad content-type: {}').format(content_type),
+                    ).iteritems())),
+                method = req.script_name,
+                url = req.url.decode('utf-8'),
+                ).iteritems())),
+            headers = headers,
+            )
+
+    inputs, error = conv.pipe(
+        conv.make_input_to_json(object_pairs_hook = collections.OrderedDict),
+        conv.test_isinstance(dict),
+        conv.not_none,
+        )(req.body, state = ctx)
+    if error is not None:
+        return wsgihelpers.respond_json(ctx,
+            collections.OrderedDict(sorted(dict(
+                apiVersion = 1,
+                error = collections.OrderedDict(sorted(dict(
+                    code = 400,  # Bad Request
+                    errors = [conv.jsonify_value(error)],
+                    message = ctx._(u'Invalid JSON in request POST body'),
+                    ).iteritems())),
+                method = req.script_name,
+                url = req.url.decode('utf-8'),
+                ).iteritems())),
+            headers = headers,
+            )
+
+    data, errors = calculate.make_inputs_to_data(limit_scenarios = False)(inputs, state = ctx)
+    if errors is None:
+        # Scenarios are validated by the job, but variables are validated now.
+        base_tax_benefit_system = model.get_cached_composed_reform(
+            reform_keys = data['base_reforms'],
+            tax_benefit_system = model.tax_benefit_system,
+            ) if data['base_reforms'] is not None else model.tax_benefit_system
+        reform_tax_benefit_system = model.get_cached_composed_reform(
+            reform_keys = data['reforms'],
+            tax_benefit_system = base_tax_benefit_system,
+            ) if data['reforms'] is not None else None
+        data, errors = conv.struct(
+            dict(
+                # Jobs are always computed, and their results are fetched later.
+                stream = conv.test_equals(False, error = ctx._(u'Not supported by jobs')),
+                time = conv.test_equals(False, error = ctx._(u'Not supported by jobs')),
+                validate = conv.test_equals(False, error = ctx._(u'Not supported by jobs')),
+                variables = conv.uniform_sequence(
+                    conv.pipe(
+                        conv.test_in(
+                            base_tax_benefit_system.variables,
+                            error = ctx._(u'Variable does not exist'),
+                            ),
+                        conv.make_validate_variable(
+                            base_tax_benefit_system = base_tax_benefit_system,
+                            reform_tax_benefit_system = reform_tax_benefit_system,
+                            reforms = data['reforms'],
+                            ),
+                        ),
+                    ),
+                ),
+            default = conv.noop,
+            )(data, state = ctx)
+    if errors is not None:
+        return wsgihelpers.respond_json(ctx,
+            collections.OrderedDict(sorted(dict(
+                apiVersion = 1,
+                context = inputs.get('context'),
+                error = collections.OrderedDict(sorted(dict(
+                    code = 400,  # Bad Request
+                    errors = [conv.jsonify_value(errors)],
+                    message = ctx._(u'Bad parameters in request'),
+                    ).iteritems())),
+                method = req.script_name,
+                params = inputs,
+                url = req.url.decode('utf-8'),
+                ).iteritems())),
+            headers = headers,
+            )
+
+    job_id = jobs.store.create(dict(inputs = inputs, lang = ctx.lang), total = len(data['scenarios']))
+    jobs.enqueue(job_id, run_calculate_job, threads_count = conf['jobs_threads'])
+
+    return wsgihelpers.respond_json(ctx,
+        collections.OrderedDict(sorted(dict(
+            apiVersion = 1,
+            context = data['context'],
+            method = req.script_name,
+            url = req.url.decode('utf-8'),
+            value = make_job_json(ctx, jobs.store.get_status(job_id)),
+            ).iteritems())),
+        code = 202,  # Accepted
+        headers = headers,
+        )
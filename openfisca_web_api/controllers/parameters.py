@@ -6,12 +6,13 @@
 
 import collections
 
-from openfisca_core import parameters, periods
+from openfisca_core import periods
 
-from .. import conf, contexts, conv, environment, model, wsgihelpers
+from .. import conf, contexts, conv, environment, http_caching, model, wsgihelpers
 
 
 @wsgihelpers.wsgify
+@http_caching.conditional()
 def api1_parameters(req):
     wsgihelpers.track(req.url.decode('utf-8'))
     ctx = contexts.Ctx(req)
@@ -24,10 +25,7 @@ def api1_parameters(req):
         names = params.getall('name'),
         )
 
-    parameters_name = [
-        parameter_json['name']
-        for parameter_json in model.parameters_json_cache
-        ]
+    parameters_index = model.parameters_index
 
     data, errors = conv.pipe(
         conv.struct(
@@ -41,7 +39,7 @@ def api1_parameters(req):
                     conv.uniform_sequence(
                         conv.pipe(
                             conv.empty_to_none,
-                            conv.test_in(parameters_name, error = u'Parameter does not exist'),
+                            conv.test(lambda name: name in parameters_index, error = u'Parameter does not exist'),
                             ),
                         drop_none_items = True,
                         ),
@@ -70,35 +68,18 @@ def api1_parameters(req):
 
     tax_benefit_system = model.tax_benefit_system
 
-    if data['instant'] is None:
-        if data['names'] is None:
-            parameters_json = model.parameters_json_cache
-        else:
-            parameters_json = [
-                parameter_json
-                for parameter_json in model.parameters_json_cache
-                if parameter_json['name'] in data['names']
-                ]
+    if data['names'] is None:
+        parameters_json = parameters_index.parameters_json
     else:
-        instant = data['instant']
-        parameters_json = []
-        dated_legislation_json = parameters.generate_dated_legislation_json(
-            tax_benefit_system.get_parameters(),
-            instant,
-            )
-        for name in data['names']:
-            name_fragments = name.split('.')
-            parameter_json = dated_legislation_json
-            for name_fragment in name_fragments:
-                parameter_json = parameter_json['children'][name_fragment]
-            parameter_json['name'] = name
-            parameter_json_in_cache = [
-                parameter_json1
-                for parameter_json1 in model.parameters_json_cache
-                if parameter_json1['name'] == name
-                ][0]
-            parameter_json['description'] = parameter_json_in_cache['description']
-            parameters_json.append(parameter_json)
+        parameters_json = list(parameters_index.iter_parameters_json(data['names']))
+
+    if data['instant'] is not None:
+        dated_parameter_json_by_name = parameters_index.get_dated_parameter_json_by_name(tax_benefit_system,
+            data['instant'])
+        parameters_json = [
+            dated_parameter_json_by_name[parameter_json['name']]
+            for parameter_json in parameters_json
+            ]
 
     response_dict = dict(
         apiVersion = 1,
@@ -114,3 +95,84 @@ def api1_parameters(req):
         collections.OrderedDict(sorted(response_dict.iteritems())),
         headers = headers,
         )
+
+
+@wsgihelpers.wsgify
+@http_caching.conditional()
+def api1_parameters_history(req):
+    wsgihelpers.track(req.url.decode('utf-8'))
+    ctx = contexts.Ctx(req)
+    headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
+
+    assert req.method == 'GET', req.method
+    params = req.GET
+    inputs = dict(
+        names = params.getall('name'),
+        start = params.get('start'),
+        stop = params.get('stop'),
+        )
+
+    parameters_index = model.parameters_index
+    str_to_instant_str = conv.pipe(
+        conv.empty_to_none,
+        conv.test_isinstance(basestring),
+        conv.function(lambda str: unicode(periods.instant(str))),
+        )
+
+    data, errors = conv.pipe(
+        conv.struct(
+            dict(
+                names = conv.pipe(
+                    conv.uniform_sequence(
+                        conv.pipe(
+                            conv.empty_to_none,
+                            conv.test(lambda name: name in parameters_index, error = u'Parameter does not exist'),
+                            ),
+                        drop_none_items = True,
+                        ),
+                    conv.empty_to_none,
+                    conv.not_none,
+                    ),
+                start = str_to_instant_str,
+                stop = str_to_instant_str,
+                ),
+            default = 'drop',
+            ),
+        )(inputs, state = ctx)
+
+    if errors is not None:
+        return wsgihelpers.respond_json(ctx,
+            collections.OrderedDict(sorted(dict(
+                apiVersion = 1,
+                error = collections.OrderedDict(sorted(dict(
+                    code = 400,  # Bad Request
+                    errors = [conv.jsonify_value(errors)],
+                    message = ctx._(u'Bad parameters in request'),
+                    ).iteritems())),
+                method = req.script_name,
+                params = inputs,
+                url = req.url.decode('utf-8'),
+                ).iteritems())),
+            headers = headers,
+            )
+
+    parameters_json = [
+        collections.OrderedDict(sorted(dict(
+            parameter_json,
+            values = parameters_index.get_history(parameter_json['name'], start = data['start'], stop = data['stop']),
+            ).iteritems()))
+        for parameter_json in parameters_index.iter_parameters_json(data['names'])
+        ]
+
+    return wsgihelpers.respond_json(ctx,
+        collections.OrderedDict(sorted(dict(
+            apiVersion = 1,
+            country_package_name = conf['country_package'],
+            country_package_version = environment.country_package_version,
+            method = req.script_name,
+            parameters = parameters_json,
+            params = inputs,
+            url = req.url.decode('utf-8'),
+            ).iteritems())),
+        headers = headers,
+        )
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+
+
+"""Sessions controller
+
+Simulations kept alive between requests, for interactive use: each change of inputs recomputes only the values
+depending on them.
+"""
+
+
+import collections
+import copy
+
+from openfisca_core.parameters import ParameterNotFound
+from openfisca_core.taxbenefitsystems import VariableNotFound
+
+from . import calculate
+from .. import admission, contexts, conv, model, sessions, urls, wsgihelpers
+
+
+def N_(message):
+    return message
+
+
+def build_session_value(session, labels, output_format, variables):
+    simulations = [session.simulation]
+    if output_format == 'test_case':
+        return calculate.fill_test_cases_with_values(
+            intermediate_variables = False,
+            scenarios = [session.scenario],
+            simulations = simulations,
+            use_label = labels,
+            variables = variables,
+            )[0]
+    if output_format == 'columns':
+        return calculate.build_output_columns(
+            intermediate_variables = False,
+            simulations = simulations,
+            use_label = labels,
+            variables = variables,
+            )[0]
+    assert output_format == 'variables'
+    return calculate.build_output_variables(
+        simulations = simulations,
+        use_label = labels,
+        variables = variables,
+        )[0]
+
+
+def make_apply_inputs(scenario_json):
+    """Return a converter applying a change of inputs to a scenario and returning the new scenario JSON.
+
+    Changes are given as ``{entity_plural: {member_id: {variable_name: value}}}``, each value replacing the one of the
+    test case (use ``null`` to remove an input).
+    """
+    def apply_inputs(value, state = None):
+        if value is None:
+            return value, None
+        if state is None:
+            state = conv.default_state
+        test_case = scenario_json.get('test_case')
+        if test_case is None:
+            return value, state._(u'Only scenarios with a test case can have their inputs changed')
+        scenario_json_copy = copy.deepcopy(scenario_json)
+        errors = {}
+        for entity_plural, changes_by_member_id in value.iteritems():
+            members = scenario_json_copy['test_case'].get(entity_plural)
+            if not isinstance(members, list) or not isinstance(changes_by_member_id, dict):
+                errors[entity_plural] = state._(u'Unknown entity')
+                continue
+            member_by_id = dict(
+                (member.get('id'), member)
+                for member in members
+                )
+            for member_id, changes in changes_by_member_id.iteritems():
+                member = member_by_id.get(member_id)
+                if member is None or not isinstance(changes, dict):
+                    errors.setdefault(entity_plural, {})[member_id] = state._(u'Unknown member')
+                    continue
+                member.update(changes)
+        return scenario_json_copy, errors or None
+    return apply_inputs
+
+
+def make_inputs_to_data(tax_benefit_system):
+    """Return a converter validating the parameters of a session request, except the scenario and its changes."""
+    return conv.struct(
+        dict(
+            context = conv.test_isinstance(basestring),  # For asynchronous calls
+            inputs = conv.pipe(
+                conv.test_isinstance(dict),
+                conv.uniform_mapping(
+                    conv.noop,
+                    conv.pipe(
+                        conv.test_isinstance(dict),
+                        conv.uniform_mapping(
+                            conv.noop,
+                            conv.pipe(
+                                conv.test_isinstance(dict),
+                                conv.uniform_mapping(
+                                    conv.test_in(tax_benefit_system.variables,
+                                        error = N_(u'Variable does not exist')),
+                                    conv.noop,
+                                    ),
+                                ),
+                            ),
+                        ),
+                    ),
+                ),
+            labels = conv.pipe(  # Return labels (of enumerations) instead of numeric values.
+                conv.test_isinstance((bool, int)),
+                conv.anything_to_bool,
+                conv.default(False),
+                ),
+            output_format = conv.pipe(
+                conv.test_isinstance(basestring),
+                conv.test_in(['columns', 'test_case', 'variables']),
+                conv.default('variables'),
+                ),
+            reforms = conv.make_str_list_to_reforms(),
+            scenario = conv.noop,  # Converted once tax-benefit system is known.
+            variables = conv.pipe(
+                conv.test_isinstance(list),
+                conv.uniform_sequence(
+                    conv.pipe(
+                        conv.test_isinstance(basestring),
+                        conv.empty_to_none,
+                        conv.test_in(tax_benefit_system.variables, error = N_(u'Variable does not exist')),
+                        conv.not_none,
+                        ),
+                    constructor = set,
+                    ),
+                conv.default(set()),
+                ),
+            ),
+        )
+
+
+def respond_error(ctx, code, message, errors = None, headers = [], inputs = None):
+    req = ctx.req
+    return wsgihelpers.respond_json(ctx,
+        collections.OrderedDict(sorted(dict(
+            apiVersion = 1,
+            context = inputs.get('context') if isinstance(inputs, dict) else None,
+            error = collections.OrderedDict(sorted(dict(
+                code = code,
+                errors = [conv.jsonify_value(errors)] if errors is not None else None,
+                message = message,
+                ).iteritems())),
+            method = req.script_name,
+            params = inputs,
+            url = req.url.decode('utf-8'),
+            ).iteritems())),
+        headers = headers,
+        )
+
+
+def respond_session(ctx, session, data, code = None, headers = [], invalidated = None, suggestion = None):
+    req = ctx.req
+    value = build_session_value(session, data['labels'], data['output_format'], data['variables']) \
+        if data['variables'] else None
+    return wsgihelpers.respond_json(ctx,
+        collections.OrderedDict(sorted(dict(
+            apiVersion = 1,
+            context = data['context'],
+            invalidated = invalidated,
+            method = req.script_name,
+            session = collections.OrderedDict([
+                ('id', session.id),
+                ('reforms', session.reforms),
+                ('url', urls.get_full_url(ctx, 'api', 1, 'sessions', session.id)),
+                ]),
+            suggestion = suggestion,
+            url = req.url.decode('utf-8'),
+            value = value,
+            ).iteritems())),
+        code = code,
+        headers = headers,
+        )
+
+
+def calculate_session(ctx, session, variables, headers = [], inputs = None):
+    """Compute the requested variables of a session and return None, or an error response."""
+    try:
+        session.calculate(variables)
+    except ParameterNotFound as exc:
+        return respond_error(ctx, 400, ctx._(u'Bad parameters in request'), errors = dict(scenario = exc.to_json()),
+            headers = headers, inputs = inputs)
+    except (ValueError, VariableNotFound) as exc:
+        return respond_error(ctx, 400, u"{}: {}".format(exc.__class__.__name__, exc.message), headers = headers,
+            inputs = inputs)
+    return None
+
+
+def input_to_json_body(ctx, headers):
+    """Return the JSON body of the request, or an error response."""
+    req = ctx.req
+    content_type = req.content_type
+    if content_type is not None:
+        content_type = content_type.split(';', 1)[0].strip()
+    if content_type != 'application/json':
+        return None, respond_error(ctx, 400, ctx._(u'Bad content-type: {}').format(content_type), headers = headers)
+    inputs, error = conv.pipe(
+        conv.make_input_to_json(object_pairs_hook = collections.OrderedDict),
+        conv.test_isinstance(dict),
+        conv.not_none,
+        )(req.body, state = ctx)
+    if error is not None:
+        return None, respond_error(ctx, 400, ctx._(u'Invalid JSON in request body'), errors = error,
+            headers = headers)
+    return inputs, None
+
+
+@wsgihelpers.wsgify
+def api1_session(req):
+    ctx = contexts.Ctx(req)
+    headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
+
+    session = sessions.store.get(req.urlvars['id'])
+    if session is None:
+        return respond_error(ctx, 404, ctx._(u'Session not found (or expired)'), headers = headers)
+
+    if req.method == 'DELETE':
+        sessions.store.delete(session.id)
+        response = req.response
+        response.status = 204  # No Content
+        response.headers.update(headers)
+        return response
+
+    if req.method == 'GET':
+        memory_usage = session.get_memory_usage()
+        # Store the session again, to postpone its expiration.
+        sessions.store.set(session.id, session, size = memory_usage)
+        return wsgihelpers.respond_json(ctx,
+            collections.OrderedDict(sorted(dict(
+                apiVersion = 1,
+                method = req.script_name,
+                session = collections.OrderedDict([
+                    ('id', session.id),
+                    ('memory_usage', memory_usage),
+                    ('reforms', session.reforms),
+                    ('url', urls.get_full_url(ctx, 'api', 1, 'sessions', session.id)),
+                    ]),
+                url = req.url.decode('utf-8'),
+                value = session.scenario_json,
+                ).iteritems())),
+            headers = headers,
+            )
+
+    assert req.method == 'PATCH', req.method
+    return patch_session(req, session)
+
+
+@admission.admit
+def patch_session(req, session):
+    ctx = contexts.Ctx(req)
+    headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
+
+    inputs, error_response = input_to_json_body(ctx, headers)
+    if error_response is not None:
+        return error_response
+
+    tax_benefit_system = session.scenario.tax_benefit_system
+    # Read, change and write the scenario of the session under its lock, so that concurrent changes are not lost.
+    with session.lock:
+        data, errors = conv.pipe(
+            make_inputs_to_data(tax_benefit_system),
+            conv.struct(
+                dict(
+                    inputs = make_apply_inputs(session.scenario_json),
+                    reforms = conv.test_none(),
+                    scenario = conv.test_none(),
+                    ),
+                default = conv.noop,
+                ),
+            )(inputs, state = ctx)
+        if errors is None and data['inputs'] is not None:
+            scenario, errors = tax_benefit_system.Scenario.make_json_to_instance(
+                repair = False,
+                tax_benefit_system = tax_benefit_system,
+                )(data['inputs'], state = ctx)
+            if errors is not None:
+                errors = dict(inputs = errors)
+        if errors is not None:
+            return respond_error(ctx, 400, ctx._(u'Bad parameters in request'), errors = errors, headers = headers,
+                inputs = inputs)
+
+        invalidated = 0
+        suggestion = None
+        if data['inputs'] is not None:
+            suggestion = scenario.suggest()  # This modifies scenario.test_case!
+            variables_name = set(
+                variable_name
+                for changes_by_member_id in inputs['inputs'].itervalues()
+                for changes in changes_by_member_id.itervalues()
+                for variable_name in changes
+                )
+            try:
+                invalidated = session.update_inputs(scenario, data['inputs'], variables_name)
+            except ValueError as exc:
+                # The session is left unchanged.
+                return respond_error(ctx, 400, ctx._(u'Bad parameters in request'),
+                    errors = dict(inputs = str(exc).decode('utf-8')),
+                    headers = headers, inputs = inputs)
+        error_response = calculate_session(ctx, session, data['variables'], headers = headers, inputs = inputs)
+        if error_response is not None:
+            return error_response
+        response = respond_session(ctx, session, data, headers = headers, invalidated = invalidated,
+            suggestion = suggestion)
+    # Store the session again, to update its size and postpone its expiration.
+    sessions.store.set(session.id, session, size = session.get_memory_usage())
+    return response
+
+
+@wsgihelpers.wsgify
+@admission.admit
+def api1_sessions(req):
+    ctx = contexts.Ctx(req)
+    headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
+
+    assert req.method == 'POST', req.method
+    inputs, error_response = input_to_json_body(ctx, headers)
+    if error_response is not None:
+        return error_response
+
+    data, errors = conv.struct(
+        dict(
+            reforms = conv.make_str_list_to_reforms(),
+            ),
+        default = conv.noop,
+        )(inputs, state = ctx)
+    if errors is None:
+        tax_benefit_system = model.get_cached_composed_reform(
+            reform_keys = data['reforms'],
+            tax_benefit_system = model.tax_benefit_system,
+            ) if data['reforms'] is not None else model.tax_benefit_system
+        data, errors = conv.pipe(
+            make_inputs_to_data(tax_benefit_system),
+            conv.struct(
+                dict(
+                    inputs = conv.test_none(),
+                    scenario = conv.pipe(
+                        conv.test_isinstance(dict),
+                        conv.not_none,
+                        ),
+                    ),
+                default = conv.noop,
+                ),
+            )(inputs, state = ctx)
+    if errors is None:
+        scenario, errors = tax_benefit_system.Scenario.make_json_to_instance(
+            repair = False,
+            tax_benefit_system = tax_benefit_system,
+            )(data['scenario'], state = ctx)
+        if errors is not None:
+            errors = dict(scenario = errors)
+    if errors is not None:
+        return respond_error(ctx, 400, ctx._(u'Bad parameters in request'), errors = errors, headers = headers,
+            inputs = inputs)
+
+    suggestion = scenario.suggest()  # This modifies scenario.test_case!
+    try:
+        session = sessions.Session(scenario, data['scenario'], reforms = data['reforms'])
+    except ValueError as exc:
+        return respond_error(ctx, 400, ctx._(u'Bad parameters in request'),
+            errors = dict(scenario = str(exc).decode('utf-8')),
+            headers = headers, inputs = inputs)
+    with session.lock:
+        error_response = calculate_session(ctx, session, data['variables'], headers = headers, inputs = inputs)
+        if error_response is not None:
+            return error_response
+        response = respond_session(ctx, session, data, code = 201, headers = headers, suggestion = suggestion)
+    sessions.store.set(session.id, session, size = session.get_memory_usage())
+    if session.id not in sessions.store:
+        return respond_error(ctx, 413, ctx._(u'Simulation is too large to be kept in a session'), headers = headers,
+            inputs = inputs)
+    return response
@@ -8,20 +8,226 @@ from __future__ import division
 
 import collections
 import copy
-import os
+import itertools
 
+import numpy as np
 from openfisca_core import decompositions
+from openfisca_core.columns import make_column_from_variable
 from openfisca_core.parameters import ParameterNotFound
 from openfisca_core.taxbenefitsystems import VariableNotFound
 
-from .. import conf, contexts, conv, environment, model, wsgihelpers
+from . import calculate
+from .. import admission, batches, binary, caches, coalescing, contexts, conv, environment, model, workers, wsgihelpers
 
 
 def N_(message):
     return message
 
 
+def calculate_decomposition(simulations_groups, decomposition_json):
+    """Compute a decomposition for the groups of scenarios returned by :func:`new_simulations_groups`.
+
+    Like ``decompositions.calculate``, but each node is computed once per simulation, batched simulations included,
+    and its values are then split per scenario, in the order of the scenarios.
+    """
+    response_json = copy.deepcopy(decomposition_json)  # Use decomposition as a skeleton for response.
+    for node in decompositions.iter_decomposition_nodes(response_json, children_first = True):
+        children = node.get('children')
+        if children:
+            node['values'] = map(lambda *l: sum(l), *(
+                child['values']
+                for child in children
+                ))
+            continue
+        values_by_scenario_index = {}
+        for scenarios_index, simulation, batch in simulations_groups:
+            try:
+                try:
+                    array = simulation.calculate_output(node['code'], simulation.period)
+                except ValueError:
+                    array = simulation.calculate_add(node['code'], simulation.period)
+            except ParameterNotFound as exc:
+                exc.simulation_index = scenarios_index[0]
+                raise
+            holder = simulation.get_holder(node['code'])
+            column = make_column_from_variable(holder.variable)
+            if batch is None:
+                # One value per step of the axes (if any) of the scenario
+                values_by_scenario_index[scenarios_index[0]] = [
+                    column.transform_value_to_json(value)
+                    for value in array.reshape([simulation.steps_count, holder.entity.step_size]).sum(1).tolist()
+                    ]
+            else:
+                for (start, stop), scenario_index in itertools.izip(batch.bounds_by_entity_key[holder.entity.key],
+                        scenarios_index):
+                    values_by_scenario_index[scenario_index] = [
+                        column.transform_value_to_json(value)
+                        for value in array[start:stop].reshape([1, stop - start]).sum(1).tolist()
+                        ]
+        node['values'] = list(itertools.chain.from_iterable(
+            values_by_scenario_index[scenario_index]
+            for scenario_index in sorted(values_by_scenario_index)
+            ))
+    return response_json
+
+
+def concatenate_decompositions_json(decompositions_json):
+    """Merge decompositions computed for consecutive chunks of scenarios into a single decomposition."""
+    response_json = copy.deepcopy(decompositions_json[0])
+    nodes_iterators = [
+        decompositions.iter_decomposition_nodes(decomposition_json)
+        for decomposition_json in decompositions_json[1:]
+        ]
+    for node in decompositions.iter_decomposition_nodes(response_json):
+        for nodes_iterator in nodes_iterators:
+            node['values'].extend(next(nodes_iterator)['values'])
+    return response_json
+
+
+def decomposition_values_to_arrays(decomposition_json):
+    """Return a copy of a computed decomposition, whose values are NumPy arrays."""
+    decomposition_json = copy.deepcopy(decomposition_json)
+    for node in decompositions.iter_decomposition_nodes(decomposition_json):
+        if 'values' in node:  # Ancestors of a selected node have no values.
+            node['values'] = np.array(node['values'])
+    return decomposition_json
+
+
+def get_decomposition_nodes_path(decomposition_json, code = None):
+    """Return the nodes from the root of a decomposition to the node having the given code (the root by default).
+
+    Return None when the decomposition has no such node.
+    """
+    if code is None or decomposition_json['code'] == code:
+        return [decomposition_json]
+    for child_json in decomposition_json.get('children') or []:
+        nodes_path = get_decomposition_nodes_path(child_json, code)
+        if nodes_path is not None:
+            return [decomposition_json] + nodes_path
+    return None
+
+
+def new_simulations_groups(scenarios, batch = False):
+    """Return the simulations computing the scenarios, as ``(scenarios_index, simulation, batch)`` triples.
+
+    With ``batch``, compatible scenarios are merged into a single :class:`batches.SimulationBatch`. Otherwise, and for
+    scenarios that can't be merged, ``batch`` is None and the simulation computes a single scenario.
+    """
+    if batch:
+        scenarios_index_groups = batches.group_scenarios(scenarios)
+    else:
+        scenarios_index_groups = [[scenario_index] for scenario_index in range(len(scenarios))]
+    simulations_groups = []
+    for scenarios_index in scenarios_index_groups:
+        if len(scenarios_index) == 1:
+            simulations_groups.append((scenarios_index, scenarios[scenarios_index[0]].new_simulation(), None))
+        else:
+            simulation_batch = batches.SimulationBatch([scenarios[index] for index in scenarios_index])
+            simulations_groups.append((scenarios_index, simulation_batch.simulation, simulation_batch))
+    return simulations_groups
+
+
+def prune_decomposition_json(nodes_path, node_response_json, depth = None):
+    """Return the response of a decomposition computed only for the last node of ``nodes_path``.
+
+    The ancestors of the node are kept, but without their other children and without values (they weren't computed).
+    Nodes more than ``depth`` levels below the selected node are removed.
+    """
+    if depth is not None:
+        pending_nodes = [(node_response_json, 0)]
+        while pending_nodes:
+            node, level = pending_nodes.pop()
+            if level >= depth:
+                node.pop('children', None)
+            else:
+                pending_nodes.extend((child, level + 1) for child in node.get('children') or [])
+    response_json = node_response_json
+    for ancestor_json in reversed(nodes_path[:-1]):
+        ancestor_response_json = ancestor_json.copy()
+        ancestor_response_json['children'] = [response_json]
+        response_json = ancestor_response_json
+    return response_json
+
+
+def respond(ctx, response_data, media_type = None, headers = []):
+    """Return a JSON response, or a binary one (when ``media_type`` is given) with decomposition values as arrays."""
+    if media_type is None:
+        return wsgihelpers.respond_json(ctx, response_data, headers = headers)
+    response_data = response_data.copy()
+    for name in ('base_value', 'value'):
+        if response_data.get(name) is not None:
+            response_data[name] = decomposition_values_to_arrays(response_data[name])
+    return binary.respond(ctx, response_data, media_type, headers = headers)
+
+
+def simulate_in_workers(runs, lang, batch = False, decomposition_code = None):
+    """Farm the scenarios of each run out to the worker processes.
+
+    ``runs`` is a list of ``(base_reforms, reforms, scenarios)`` triples. Each run is split into as many jobs as there
+    are workers, so that base and reform runs, and chunks of scenarios, are computed in parallel.
+
+    Return a couple ``(responses_json, error)``, where ``responses_json`` is the list of the decompositions of each
+    run, computed only for the node having ``decomposition_code`` (when given).
+    """
+    jobs = []
+    run_index_by_job_index = []
+    for run_index, (base_reforms, reforms, scenarios) in enumerate(runs):
+        scenarios_json = [scenario.to_json() for scenario in scenarios]
+        for start, stop in workers.split_indexes(len(scenarios_json), workers.pool_size):
+            jobs.append(dict(
+                base_reforms = base_reforms,
+                batch = batch,
+                decomposition_code = decomposition_code,
+                first_scenario_index = start,
+                lang = lang,
+                reforms = reforms,
+                scenarios = scenarios_json[start:stop],
+                ))
+            run_index_by_job_index.append(run_index)
+    decompositions_json_by_run = [[] for run in runs]
+    for run_index, result in itertools.izip(run_index_by_job_index, workers.map_jobs(simulate_job, jobs)):
+        error = result.get('error')
+        if error is not None:
+            return None, error
+        decompositions_json_by_run[run_index].append(result['value'])
+    return [
+        concatenate_decompositions_json(decompositions_json)
+        for decompositions_json in decompositions_json_by_run
+        ], None
+
+
+def simulate_job(job):
+    """Compute in a worker process the decomposition of scenarios given as JSON.
+
+    Return a dict containing either a ``value`` or an ``error``, because OpenFisca exceptions can't be pickled.
+    """
+    ctx = contexts.Ctx()
+    ctx.lang = job['lang']
+    try:
+        tax_benefit_system = workers.get_tax_benefit_system(job['base_reforms'], job['reforms'])
+        scenarios = conv.check(conv.uniform_sequence(
+            tax_benefit_system.Scenario.make_json_to_instance(repair = False, tax_benefit_system = tax_benefit_system),
+            ))(job['scenarios'], state = ctx)
+        simulations_groups = new_simulations_groups(scenarios, batch = job['batch'])
+        decomposition_json = model.get_cached_or_new_decomposition_json(tax_benefit_system)
+        node_json = get_decomposition_nodes_path(decomposition_json, job['decomposition_code'])[-1]
+        return dict(value = calculate_decomposition(simulations_groups, node_json))
+    except ParameterNotFound as exc:
+        return dict(error = dict(
+            code = 500,
+            errors = [{"scenarios": {job['first_scenario_index'] + exc.simulation_index: exc.to_json()}}],
+            message = ctx._(u'Internal server error'),
+            ))
+    except (ValueError, VariableNotFound) as exc:
+        return dict(error = dict(
+            code = 400,
+            message = u"{}: {}".format(exc.__class__.__name__, exc.message),
+            ))
+
+
 @wsgihelpers.wsgify
+@coalescing.coalesce
+@admission.admit
 def api1_simulate(req):
     wsgihelpers.track(req.url.decode('utf-8'))
     ctx = contexts.Ctx(req)
@@ -29,27 +235,6 @@ def api1_simulate(req):
 
     assert req.method == 'POST', req.method
 
-    if conf['load_alert']:
-        try:
-            load_average = os.getloadavg()
-        except (AttributeError, OSError):
-            # When load average is not available, always accept request.
-            pass
-        else:
-            if load_average[0] / environment.cpu_count > 1:
-                return wsgihelpers.respond_json(ctx,
-                    collections.OrderedDict(sorted(dict(
-                        apiVersion = 1,
-                        error = collections.OrderedDict(sorted(dict(
-                            code = 503,  # Service Unavailable
-                            message = ctx._(u'Server is overloaded: {} {} {}').format(*load_average),
-                            ).iteritems())),
-                        method = req.script_name,
-                        url = req.url.decode('utf-8'),
-                        ).iteritems())),
-                    headers = headers,
-                    )
-
     content_type = req.content_type
     if content_type is not None:
         content_type = content_type.split(';', 1)[0].strip()
@@ -93,7 +278,28 @@ def api1_simulate(req):
     data, errors = conv.struct(
         dict(
             base_reforms = str_list_to_reforms,
+            batch = conv.pipe(  # Compute compatible scenarios together, in a single simulation.
+                conv.test_isinstance((bool, int)),
+                conv.anything_to_bool,
+                conv.default(False),
+                ),
             context = conv.test_isinstance(basestring),  # For asynchronous calls
+            decomposition = conv.pipe(  # Selection of the part of the decomposition to compute
+                conv.test_isinstance(dict),
+                conv.struct(
+                    dict(
+                        code = conv.pipe(  # Code of the node to compute, with its descendants
+                            conv.test_isinstance(basestring),
+                            conv.empty_to_none,
+                            ),
+                        depth = conv.pipe(  # Number of levels of descendants to return
+                            conv.test_isinstance(int),
+                            conv.test_greater_or_equal(0),
+                            ),
+                        ),
+                    ),
+                conv.default({}),
+                ),
             reforms = str_list_to_reforms,
             scenarios = conv.pipe(
                 conv.test_isinstance(list),
@@ -118,6 +324,37 @@ def api1_simulate(req):
             ),
         )(inputs, state = ctx)
 
+    media_type = binary.get_media_type(req)  # None for JSON responses
+    response_cache_key = None
+    if errors is None and model.response_cache is not None and not data['validate']:
+        response_cache_key = caches.canonical_digest(dict(
+            country_package_version = environment.country_package_version,
+            data = {
+                name: value
+                for name, value in data.iteritems()
+                if name != 'context'  # It doesn't change the computed values.
+                },
+            lang = ctx.lang,  # Suggestions and messages are localized.
+            media_type = media_type,
+            method = 'simulate',
+            ))
+        cached_response_data = model.response_cache.get(response_cache_key)
+        if cached_response_data is not None:
+            headers.append(('Cache-Status', 'openfisca-web-api; hit'))
+            return respond(ctx,
+                collections.OrderedDict(sorted(dict(
+                    apiVersion = 1,
+                    context = data['context'],
+                    method = req.script_name,
+                    params = inputs,
+                    url = req.url.decode('utf-8'),
+                    **cached_response_data
+                    ).iteritems())),
+                headers = headers,
+                media_type = media_type,
+                )
+        headers.append(('Cache-Status', 'openfisca-web-api; fwd=miss'))
+
     if errors is None:
         country_tax_benefit_system = model.tax_benefit_system
         base_tax_benefit_system = model.get_cached_composed_reform(
@@ -129,6 +366,19 @@ def api1_simulate(req):
                 reform_keys = data['reforms'],
                 tax_benefit_system = base_tax_benefit_system,
                 )
+        decomposition_code = data['decomposition'].get('code')
+        base_nodes_path = get_decomposition_nodes_path(
+            model.get_cached_or_new_decomposition_json(base_tax_benefit_system),
+            decomposition_code,
+            )
+        if data['reforms'] is not None:
+            reform_nodes_path = get_decomposition_nodes_path(
+                model.get_cached_or_new_decomposition_json(reform_tax_benefit_system),
+                decomposition_code,
+                )
+        if base_nodes_path is None or data['reforms'] is not None and reform_nodes_path is None:
+            errors = dict(decomposition = dict(code = ctx._(u'No node with this code in decomposition')))
+    if errors is None:
         try:
             base_scenarios, base_scenarios_errors = conv.uniform_sequence(
                 base_tax_benefit_system.Scenario.make_json_to_cached_or_new_instance(
@@ -144,13 +394,14 @@ def api1_simulate(req):
 
         if errors is None and data['reforms'] is not None:
             try:
-                reform_scenarios, reform_scenarios_errors = conv.uniform_sequence(
-                    reform_tax_benefit_system.Scenario.make_json_to_cached_or_new_instance(
+                # Bind the base scenarios to the reform, instead of converting them again.
+                reform_scenarios, reform_scenarios_errors = \
+                    reform_tax_benefit_system.Scenario.make_json_list_to_bound_or_cached_instances(
+                        base_scenarios = base_scenarios,
                         ctx = ctx,
                         repair = data['validate'],
                         tax_benefit_system = reform_tax_benefit_system,
-                        )
-                    )(data['scenarios'], state = ctx)
+                        )(data['scenarios'], state = ctx)
             except (ValueError, VariableNotFound) as exc:
                 wsgihelpers.handle_error(exc, ctx, headers)
             errors = {'scenarios': reform_scenarios_errors} if reform_scenarios_errors is not None else None
@@ -187,6 +438,11 @@ def api1_simulate(req):
     if not suggestions:
         suggestions = None
 
+    if data['reforms'] is not None and not data['validate']:
+        # Compute the base run from the same repaired test cases as the reform run.
+        for scenario in base_scenarios:
+            scenario.suggest()
+
     if data['validate']:
         # Only a validation is requested. Don't launch simulation
         return wsgihelpers.respond_json(ctx,
@@ -205,42 +461,40 @@ def api1_simulate(req):
             headers = headers,
             )
 
-    decomposition_json = model.get_cached_or_new_decomposition_json(base_tax_benefit_system)
-    try:
-        base_simulations = [scenario.new_simulation() for scenario in base_scenarios]
-    except ValueError as exc:
-        wsgihelpers.handle_error(exc, ctx, headers)
-
-    try:
-        base_response_json = decompositions.calculate(base_simulations, decomposition_json)
-    except ParameterNotFound as exc:
-        return wsgihelpers.respond_json(ctx,
-            collections.OrderedDict(sorted(dict(
-                apiVersion = 1,
-                context = inputs.get('context'),
-                error = collections.OrderedDict(sorted(dict(
-                    code = 500,
-                    errors = [{"scenarios": {exc.simulation_index: exc.to_json()}}],
-                    message = ctx._(u'Internal server error'),
+    if workers.pool is not None:
+        runs = [(data['base_reforms'], None, base_scenarios)]
+        if data['reforms'] is not None:
+            runs.append((data['base_reforms'], data['reforms'], reform_scenarios))
+        responses_json, error = simulate_in_workers(runs, ctx.lang, batch = data['batch'],
+            decomposition_code = decomposition_code)
+        if error is not None:
+            return wsgihelpers.respond_json(ctx,
+                collections.OrderedDict(sorted(dict(
+                    apiVersion = 1,
+                    context = inputs.get('context'),
+                    error = collections.OrderedDict(sorted(error.iteritems())),
+                    method = req.script_name,
+                    params = inputs,
+                    url = req.url.decode('utf-8'),
                     ).iteritems())),
-                method = req.script_name,
-                params = inputs,
-                url = req.url.decode('utf-8'),
-                ).iteritems())),
-            headers = headers,
-            )
-    except ValueError as exc:
-        wsgihelpers.handle_error(exc, ctx, headers)
-
-    if data['reforms'] is not None:
-        reform_decomposition_json = model.get_cached_or_new_decomposition_json(reform_tax_benefit_system)
+                headers = headers,
+                )
+        base_response_json = responses_json[0]
+        if data['reforms'] is not None:
+            reform_response_json = responses_json[1]
+    else:
         try:
-            reform_simulations = [scenario.new_simulation() for scenario in reform_scenarios]
+            base_simulations_groups = new_simulations_groups(base_scenarios, batch = data['batch'])
         except ValueError as exc:
             wsgihelpers.handle_error(exc, ctx, headers)
 
+        results_reuse = calculate.make_results_reuse(base_scenarios, reform_scenarios, False) \
+            if data['reforms'] is not None else None
+        if results_reuse is not None:
+            for scenarios_index, simulation, simulation_batch in base_simulations_groups:
+                results_reuse.start(scenarios_index[0], simulation)
         try:
-            reform_response_json = decompositions.calculate(reform_simulations, reform_decomposition_json)
+            base_response_json = calculate_decomposition(base_simulations_groups, base_nodes_path[-1])
         except ParameterNotFound as exc:
             return wsgihelpers.respond_json(ctx,
                 collections.OrderedDict(sorted(dict(
@@ -259,6 +513,50 @@ def api1_simulate(req):
                 )
         except ValueError as exc:
             wsgihelpers.handle_error(exc, ctx, headers)
+        finally:
+            if results_reuse is not None:
+                for scenarios_index, simulation, simulation_batch in base_simulations_groups:
+                    results_reuse.stop(scenarios_index[0], simulation)
+
+        if data['reforms'] is not None:
+            try:
+                reform_simulations_groups = new_simulations_groups(reform_scenarios, batch = data['batch'])
+            except ValueError as exc:
+                wsgihelpers.handle_error(exc, ctx, headers)
+
+            if results_reuse is not None:
+                for scenarios_index, simulation, simulation_batch in reform_simulations_groups:
+                    results_reuse.start(scenarios_index[0], simulation)
+            try:
+                reform_response_json = calculate_decomposition(reform_simulations_groups, reform_nodes_path[-1])
+            except ParameterNotFound as exc:
+                return wsgihelpers.respond_json(ctx,
+                    collections.OrderedDict(sorted(dict(
+                        apiVersion = 1,
+                        context = inputs.get('context'),
+                        error = collections.OrderedDict(sorted(dict(
+                            code = 500,
+                            errors = [{"scenarios": {exc.simulation_index: exc.to_json()}}],
+                            message = ctx._(u'Internal server error'),
+                            ).iteritems())),
+                        method = req.script_name,
+                        params = inputs,
+                        url = req.url.decode('utf-8'),
+                        ).iteritems())),
+                    headers = headers,
+                    )
+            except ValueError as exc:
+                wsgihelpers.handle_error(exc, ctx, headers)
+            finally:
+                if results_reuse is not None:
+                    for scenarios_index, simulation, simulation_batch in reform_simulations_groups:
+                        results_reuse.stop(scenarios_index[0], simulation)
+
+    base_response_json = prune_decomposition_json(base_nodes_path, base_response_json,
+        depth = data['decomposition'].get('depth'))
+    if data['reforms'] is not None:
+        reform_response_json = prune_decomposition_json(reform_nodes_path, reform_response_json,
+            depth = data['decomposition'].get('depth'))
 
     simulations_variables_json = None
     tracebacks_json = None
@@ -276,7 +574,20 @@ def api1_simulate(req):
         )
     if data['reforms'] is not None:
         response_data['base_value'] = base_response_json
-    return wsgihelpers.respond_json(ctx,
+    response = respond(
+        ctx,
         collections.OrderedDict(sorted(response_data.iteritems())),
         headers = headers,
+        media_type = media_type,
         )
+    if response_cache_key is not None:
+        model.response_cache.set(
+            response_cache_key,
+            dict(
+                base_value = response_data.get('base_value'),
+                suggestions = suggestions,
+                value = response_data['value'],
+                ),
+            size = len(response.body),
+            )
+    return response
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+
+"""Status controller"""
+
+
+import collections
+
+from .. import admission, coalescing, contexts, jobs, model, sessions, workers, wsgihelpers
+
+
+@wsgihelpers.wsgify
+def api1_status(req):
+    ctx = contexts.Ctx(req)
+    headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
+
+    assert req.method == 'GET', req.method
+    dated_parameters_cache = model.parameters_index.dated_parameter_json_by_name_cache \
+        if model.parameters_index is not None else None
+
+    return wsgihelpers.respond_json(ctx,
+        collections.OrderedDict(sorted(dict(
+            apiVersion = 1,
+            method = req.script_name,
+            url = req.url.decode('utf-8'),
+            value = collections.OrderedDict(sorted(dict(
+                admission = admission.controller.to_json() if admission.controller is not None else None,
+                calculate_workers = workers.pool_size,
+                coalescing = coalescing.single_flight.to_json() if coalescing.single_flight is not None else None,
+                dated_parameters_cache = dated_parameters_cache.to_json() if dated_parameters_cache is not None else None,
+                formula_cache = model.formula_cache.to_json() if model.formula_cache is not None else None,
+                jobs_queue_size = jobs.queue.qsize(),
+                response_cache = model.response_cache.to_json() if model.response_cache is not None else None,
+                sessions = sessions.store.to_json() if sessions.store is not None else None,
+                ).iteritems())),
+            ).iteritems())),
+        headers = headers,
+        )
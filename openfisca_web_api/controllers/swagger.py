@@ -9,7 +9,7 @@ from openfisca_core import columns
 
 from . import formula
 from .formula import default_period
-from .. import contexts, model, wsgihelpers
+from .. import contexts, http_caching, model, wsgihelpers
 from enum import Enum
 
 PACKAGE_VERSION = pkg_resources.get_distribution('OpenFisca-Web-API').version
@@ -17,6 +17,7 @@ SWAGGER_BASE_PATH = '/api/2/formula'
 
 
 @wsgihelpers.wsgify
+@http_caching.conditional()
 def api1_swagger(req):
     wsgihelpers.track(req.url.decode('utf-8'))
     ctx = contexts.Ctx(req)
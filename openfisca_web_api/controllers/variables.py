@@ -9,10 +9,11 @@ import datetime
 
 from openfisca_core import periods, simulations, columns
 
-from .. import conf, contexts, conv, environment, model, wsgihelpers
+from .. import conf, contexts, conv, environment, http_caching, model, wsgihelpers
 
 
 @wsgihelpers.wsgify
+@http_caching.conditional()
 def api1_variables(req):
     wsgihelpers.track(req.url.decode('utf-8'))
     ctx = contexts.Ctx(req)
@@ -3,20 +3,24 @@
 """Environment configuration"""
 
 import collections
+import copy
 import datetime
 import importlib
+import itertools
 import logging
 import multiprocessing
 import os
 
 import pkg_resources
 import sys
-import weakref
+import tempfile
 
 from biryani import strings
 from openfisca_core import periods
+from openfisca_core.parameters import ParameterNode
 
-from . import conf, conv, model, wsgihelpers
+from . import (admission, caches, coalescing, conf, conv, http_caching, jobs, model, parameters_index, sessions, workers,
+    wsgihelpers)
 
 log = logging.getLogger(__name__)
 
@@ -29,10 +33,6 @@ api_package_version = None
 cpu_count = None
 
 
-class ValueAndError(list):  # Can't be a tuple subclass, because WeakValueDictionary doesn't work with (sub)tuples.
-    pass
-
-
 def get_relative_file_path(absolute_file_path):
     '''
     Example:
@@ -55,14 +55,78 @@ def load_environment(global_conf, app_conf):
         {
             'app_conf': conv.set_value(app_conf),
             'app_dir': conv.set_value(app_dir),
+            'calculate_workers': conv.pipe(  # Number of processes computing simulations, 0 to compute them in requests
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(0),
+                ),
+            'coalescing': conv.pipe(conv.guess_bool, conv.default(False)),  # Share responses of identical requests
+            'coalescing_dir': conv.empty_to_none,  # Directory of lock files, to also coalesce requests between processes
+            'compute_max_concurrency': conv.pipe(  # Number of requests computing at the same time, 0 = no limit
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(0),
+                ),
+            'compute_queue_max_size': conv.pipe(  # Number of requests waiting to compute, the next ones are rejected
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(100),
+                ),
+            'compute_queue_timeout': conv.pipe(  # in seconds
+                conv.anything_to_float,
+                conv.test_greater_or_equal(0),
+                conv.default(30),
+                ),
             'country_package': conv.pipe(
                 conv.make_input_to_slug(separator = u'_'),
                 conv.not_none,
                 ),
+            'dated_parameters_cache_max_bytes': conv.pipe(  # Approximate size of the instants kept in cache
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(50 * 1024 * 1024),
+                ),
+            'dated_parameters_cache_max_entries': conv.pipe(  # Number of instants of /api/1/parameters kept in cache
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(100),
+                ),
             'debug': conv.pipe(conv.guess_bool, conv.default(False)),
+            'formula_cache_max_bytes': conv.pipe(
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(10 * 1024 * 1024),
+                ),
+            'formula_cache_max_entries': conv.pipe(  # 0 disables the cache of the values computed by /api/2/formula
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(10000),
+                ),
+            'formula_cache_ttl': conv.pipe(  # in seconds
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(3600),
+                ),
             'global_conf': conv.set_value(global_conf),
+            'http_cache': conv.pipe(conv.guess_bool, conv.default(True)),  # ETags & conditional GET requests
+            'http_cache_max_age': conv.pipe(  # in seconds, Cache-Control max-age of the cacheable GET responses
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(0),
+                ),
             'i18n_dir': conv.default(os.path.join(app_dir, 'i18n')),
-            'load_alert': conv.pipe(conv.guess_bool, conv.default(False)),
+            'jobs_dir': conv.default(os.path.join(tempfile.gettempdir(), 'openfisca-web-api-jobs')),
+            'jobs_threads': conv.pipe(  # Number of threads running the asynchronous jobs of each process
+                conv.anything_to_int,
+                conv.test_greater_or_equal(1),
+                conv.default(1),
+                ),
+            'jobs_ttl': conv.pipe(  # in seconds, since the last update of a job
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(24 * 3600),
+                ),
+            'load_alert': conv.pipe(conv.guess_bool, conv.default(False)),  # Deprecated: use compute_max_concurrency
             'log_level': conv.pipe(
                 conv.default('WARNING'),
                 conv.function(lambda log_level: getattr(logging, log_level.upper())),
@@ -70,6 +134,41 @@ def load_environment(global_conf, app_conf):
             'package_name': conv.default('openfisca-web-api'),
             'realm': conv.default(u'OpenFisca Web API'),
             'reforms': conv.ini_str_to_list,  # Another validation is done below.
+            'response_cache_max_bytes': conv.pipe(
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(100 * 1024 * 1024),
+                ),
+            'response_cache_max_entries': conv.pipe(  # 0 disables the cache of calculate & simulate responses
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(1000),
+                ),
+            'response_cache_ttl': conv.pipe(  # in seconds
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(3600),
+                ),
+            'scenario_cache_max_entries': conv.pipe(  # Number of parsed scenarios kept in cache
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(1000),
+                ),
+            'sessions_max_bytes': conv.pipe(  # Sum of the memory used by the simulations of the sessions
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(500 * 1024 * 1024),
+                ),
+            'sessions_max_entries': conv.pipe(
+                conv.anything_to_int,
+                conv.test_greater_or_equal(1),
+                conv.default(100),
+                ),
+            'sessions_ttl': conv.pipe(  # in seconds, since the last use of a session
+                conv.anything_to_int,
+                conv.test_greater_or_equal(0),
+                conv.default(1800),
+                ),
             'extensions': conv.ini_str_to_list,
             },
         default = 'drop',
@@ -99,23 +198,94 @@ def load_environment(global_conf, app_conf):
             tax_benefit_system.load_extension(extension)
 
     class Scenario(tax_benefit_system.Scenario):
-        instance_and_error_couple_cache = {} if conf['debug'] else weakref.WeakValueDictionary()  # class attribute
+        instance_and_error_couple_cache = caches.LRUCache(  # class attribute
+            max_entries = conf['scenario_cache_max_entries'],
+            )
 
         @classmethod
         def make_json_to_cached_or_new_instance(cls, ctx, repair, tax_benefit_system):
             def json_to_cached_or_new_instance(value, state = None):
-                key = (unicode(ctx.lang), unicode(value), repair, tax_benefit_system)
+                key = (
+                    caches.canonical_digest(value),
+                    unicode(ctx.lang),
+                    repair,
+                    getattr(tax_benefit_system, 'full_key', None),
+                    )
                 instance_and_error_couple = cls.instance_and_error_couple_cache.get(key)
                 if instance_and_error_couple is None:
                     instance_and_error_couple = cls.make_json_to_instance(repair, tax_benefit_system)(
                         value, state = state or conv.default_state)
-                    # Note: Call to ValueAndError() is needed below, otherwise it raises TypeError: cannot create
-                    # weak reference to 'tuple' object.
-                    cls.instance_and_error_couple_cache[key] = ValueAndError(instance_and_error_couple)
-                return instance_and_error_couple
+                    cls.instance_and_error_couple_cache.set(key, instance_and_error_couple)
+                instance, error = instance_and_error_couple
+                if error is None:
+                    # Hand out a copy, because the test case of a scenario is modified by scenario.suggest().
+                    instance = copy.copy(instance)
+                    instance.test_case = copy.deepcopy(instance.test_case)
+                return instance, error
 
             return json_to_cached_or_new_instance
 
+        @classmethod
+        def make_json_list_to_bound_or_cached_instances(cls, base_scenarios, ctx, repair, tax_benefit_system):
+            """Return a converter binding ``base_scenarios`` (converted from the same JSON list) to another tax-benefit
+            system, converting again only the scenarios for which the systems are not compatible.
+            """
+            json_to_cached_or_new_instance = cls.make_json_to_cached_or_new_instance(ctx, repair, tax_benefit_system)
+
+            def json_list_to_bound_or_cached_instances(value, state = None):
+                if value is None:
+                    return value, None
+                instances = []
+                errors = {}
+                for index, (instance_json, base_scenario) in enumerate(itertools.izip(value, base_scenarios)):
+                    instance = base_scenario.bind(tax_benefit_system)
+                    if instance is None:
+                        instance, error = json_to_cached_or_new_instance(instance_json, state = state)
+                        if error is not None:
+                            errors[index] = error
+                    instances.append(instance)
+                return instances, errors or None
+
+            return json_list_to_bound_or_cached_instances
+
+        def bind(self, tax_benefit_system):
+            """Return a copy of the scenario using another tax-benefit system, without converting it again.
+
+            Return None when the scenario uses a variable that is converted differently by the other system.
+            """
+            base_tax_benefit_system = self.tax_benefit_system
+            if tax_benefit_system.entities is not base_tax_benefit_system.entities:
+                return None
+            variables_name = set()
+            if self.test_case is not None:
+                for entity_members in self.test_case.itervalues():
+                    for entity_member in entity_members:
+                        variables_name.update(entity_member)
+            if self.input_variables is not None:
+                variables_name.update(self.input_variables)
+            if self.axes is not None:
+                variables_name.update(
+                    axis['name']
+                    for parallel_axes in self.axes
+                    for axis in parallel_axes
+                    )
+            for variable_name in variables_name:
+                base_variable = base_tax_benefit_system.variables.get(variable_name)
+                if base_variable is None:
+                    continue  # ID or role
+                variable = tax_benefit_system.variables.get(variable_name)
+                if variable is base_variable:
+                    continue
+                if variable is None or any(
+                        getattr(variable, attribute_name, None) != getattr(base_variable, attribute_name, None)
+                        for attribute_name in ('definition_period', 'entity', 'possible_values', 'value_type')
+                        ):
+                    return None
+            instance = copy.copy(self)
+            instance.tax_benefit_system = tax_benefit_system
+            instance.test_case = copy.deepcopy(self.test_case)
+            return instance
+
     tax_benefit_system.Scenario = Scenario
 
     model.tax_benefit_system = tax_benefit_system
@@ -139,6 +309,33 @@ def load_environment(global_conf, app_conf):
             model.reforms[key] = reform
             model.reformed_tbs[full_key] = reformed_tbs
 
+    model.response_cache = caches.LRUCache(
+        max_bytes = conf['response_cache_max_bytes'],
+        max_entries = conf['response_cache_max_entries'],
+        ttl = conf['response_cache_ttl'],
+        ) if conf['response_cache_max_entries'] else None
+    log.debug(u'Index variables for formula requests.')
+    model.variables_index_by_key = {}
+    model.get_cached_variables_index(tax_benefit_system)
+    for reformed_tbs in model.reformed_tbs.itervalues():
+        model.get_cached_variables_index(reformed_tbs)
+
+    # Created again when the tax-benefit system and its reforms are reloaded, so that no stale value is kept.
+    model.formula_cache = caches.LRUCache(
+        max_bytes = conf['formula_cache_max_bytes'],
+        max_entries = conf['formula_cache_max_entries'],
+        ttl = conf['formula_cache_ttl'],
+        ) if conf['formula_cache_max_entries'] else None
+    model.simulation_template_by_key = caches.LRUCache(max_entries = 100)  # By tax-benefit system and period
+
+    jobs.store = jobs.JobStore(conf['jobs_dir'], conf['jobs_ttl'])
+    coalescing.single_flight = coalescing.SingleFlight(dir = conf['coalescing_dir']) if conf['coalescing'] else None
+    sessions.store = caches.LRUCache(
+        max_bytes = conf['sessions_max_bytes'],
+        max_entries = conf['sessions_max_entries'],
+        ttl = conf['sessions_ttl'],
+        )
+
     log.debug(u'Cache default decomposition.')
     if tax_benefit_system.decomposition_file_path is not None:
         # Ignore the returned value, because we just want to pre-compute the cache.
@@ -160,16 +357,31 @@ def load_environment(global_conf, app_conf):
     global country_package_version
     country_package_version = pkg_resources.get_distribution(conf["country_package"]).version
 
+    http_caching.max_age = conf['http_cache_max_age']
+    http_caching.packages_digest = http_caching.get_packages_digest(
+        api_package_version = api_package_version,
+        country_package_version = country_package_version,
+        extensions = conf['extensions'],
+        reforms_key = model.reformed_tbs.keys(),
+        ) if conf['http_cache'] else None
+
     log.debug(u'Cache legislation parmeters')
     legislation = tax_benefit_system.parameters
     parameters = []
+    history_by_name = {}
     walk_legislation(
         legislation,
+        history_by_name = history_by_name,
         descriptions = [],
         parameters = parameters,
         path_fragments = [],
         )
     model.parameters_cache = parameters
+    model.parameters_index = parameters_index.ParametersIndex(parameters,
+        history_by_name = history_by_name,
+        dated_cache_max_bytes = conf['dated_parameters_cache_max_bytes'],
+        dated_cache_max_entries = conf['dated_parameters_cache_max_entries'],
+        )
 
     if not conf['debug']:
         # Do this after tax_benefit_system.get_legislation().
@@ -182,24 +394,36 @@ def load_environment(global_conf, app_conf):
             tax_benefit_system.get_parameters_at_instant(instant)
             instant = instant.offset(1, 'month')
 
-    # Initialize multiprocessing and load_alert
-    if conf['load_alert']:
-        global cpu_count
-        cpu_count = multiprocessing.cpu_count()
+    # Initialize multiprocessing and admission control
+    global cpu_count
+    cpu_count = multiprocessing.cpu_count()
+    max_concurrency = conf['compute_max_concurrency']
+    if not max_concurrency and conf['load_alert']:
+        # load_alert used to reject requests when the load average exceeded the number of CPUs.
+        max_concurrency = conf['calculate_workers'] or cpu_count
+    admission.controller = admission.AdmissionController(
+        max_concurrency = max_concurrency,
+        max_queue_size = conf['compute_queue_max_size'],
+        queue_timeout = conf['compute_queue_timeout'],
+        ) if max_concurrency else None
 
     if conf.get('tracker_url') and conf.get('tracker_idsite'):
         wsgihelpers.init_tracker(conf['tracker_url'], conf['tracker_idsite'])
 
+    # Fork the calculation workers last, so that they share the warmed tax-benefit systems (copy-on-write).
+    if conf['calculate_workers'] and workers.pool is None:
+        workers.start_pool(conf['calculate_workers'])
+
 
-def walk_legislation(node, descriptions, parameters, path_fragments):
-    node_type = type(node).__name__
-    if node_type == 'Node':
+def walk_legislation(node, descriptions, parameters, path_fragments, history_by_name = None):
+    if isinstance(node, ParameterNode):
         for child_name, child in node.children.iteritems():
             walk_legislation(
                 child,
                 descriptions = descriptions + [getattr(node, 'description', None)],
                 parameters = parameters,
                 path_fragments = path_fragments + [child_name],
+                history_by_name = history_by_name,
                 )
     else:
         parameter = {}
@@ -216,3 +440,7 @@ def walk_legislation(node, descriptions, parameters, path_fragments):
 
         parameter = collections.OrderedDict(sorted(parameter.iteritems()))
         parameters.append(parameter)
+
+        if history_by_name is not None:
+            history_by_name[parameter['name']] = parameters_index.breakpoints_to_history(
+                parameters_index.get_breakpoints(node))
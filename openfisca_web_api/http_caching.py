@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+
+"""HTTP caching of the GET responses which only depend on the request and on the loaded packages
+
+The strong ETag of such a response is a digest of the versions of the Web API and of the country package, of the
+loaded reforms and extensions, of the route, of its normalized query and of the headers negotiating the response or
+selecting its reforms. A request whose ``If-None-Match`` header contains this ETag gets a "304 Not Modified" response,
+without calling the controller.
+
+Responses are also given a ``Cache-Control`` header, so that reverse proxies and browsers can keep them for
+``max_age`` seconds.
+"""
+
+
+import datetime
+import functools
+
+import webob
+
+from . import caches, contexts, wsgihelpers
+
+
+# Initialized in environment module
+max_age = None
+packages_digest = None
+
+
+def conditional(dated = False):
+    """Decorate a GET controller, whose responses only depend on the request and on the loaded packages.
+
+    ``dated`` controllers also depend on the current date (for their default period for instance).
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def conditional_func(req, *args, **kwargs):
+            if packages_digest is None or req.method != 'GET':
+                return func(req, *args, **kwargs)
+            etag = get_request_etag(req, dated = dated)
+            if etag in req.if_none_match:
+                ctx = contexts.Ctx(req)
+                headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
+                return webob.Response(headerlist = headers + get_caching_headers(etag), status = 304)
+            response = func(req, *args, **kwargs)
+            # Errors are not cached, nor validated.
+            if response is not None and response.status_int == 200:
+                response.headers.update(get_caching_headers(etag))
+            return response
+        return conditional_func
+    return decorator
+
+
+def get_caching_headers(etag):
+    return [
+        ('Cache-Control', 'public, max-age={}'.format(max_age or 0)),
+        ('ETag', '"{}"'.format(etag)),
+        ('Vary', 'Accept, Accept-Language, Origin, X-OpenFisca-Extensions'),
+        ]
+
+
+def get_request_etag(req, dated = False):
+    """Return the strong ETag of the response to a request, without quotes."""
+    key_json = dict(
+        accept = req.headers.get('Accept'),
+        accept_language = req.headers.get('Accept-Language'),
+        extensions = req.headers.get('X-Openfisca-Extensions'),  # Reforms of /api/2/formula
+        packages = packages_digest,
+        path = req.script_name + req.path_info,
+        query = sorted(req.GET.items(), key = lambda (name, value): name),  # Keep the order of repeated values.
+        )
+    if dated:
+        key_json['date'] = datetime.date.today().isoformat()
+    return caches.canonical_digest(key_json)
+
+
+def get_packages_digest(api_package_version, country_package_version, reforms_key, extensions):
+    """Return a digest of the packages whose changes invalidate the cached responses.
+
+    >>> get_packages_digest('8.0.0', '21.0.0', ['b', 'a'], None) == get_packages_digest('8.0.0', '21.0.0', ['a', 'b'],
+    ...     None)
+    True
+    >>> get_packages_digest('8.0.0', '21.0.0', [], None) == get_packages_digest('8.0.0', '21.1.0', [], None)
+    False
+    """
+    return caches.canonical_digest(dict(
+        api_package_version = api_package_version,
+        country_package_version = country_package_version,
+        extensions = extensions,
+        reforms = sorted(reforms_key),
+        ))
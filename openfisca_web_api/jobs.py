@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+
+"""Asynchronous jobs, stored in the file system
+
+Each job is a directory of the jobs directory, containing:
+
+* ``request.json``: the parameters of the job;
+* ``status.json``: its state (``queued``, ``running``, ``done`` or ``failed``), its progress and its error, if any;
+* ``results.ndjson``: its results, one JSON line per item, appended as soon as they are computed.
+
+Jobs are run by threads of the process which received them. Jobs not updated for more than the TTL are removed.
+"""
+
+
+import json
+import logging
+import os
+import Queue
+import shutil
+import threading
+import time
+import uuid
+
+
+log = logging.getLogger(__name__)
+
+# Initialized in environment module
+store = None
+
+queue = Queue.Queue()
+threads = []
+threads_lock = threading.Lock()
+
+
+def enqueue(job_id, run, threads_count = 1):
+    """Queue a job, to be run in a thread by ``run(job_id)``."""
+    with threads_lock:
+        # Start threads lazily, so that they live in the processes serving requests, not in a forking parent.
+        while len(threads) < threads_count:
+            thread = threading.Thread(name = 'openfisca-web-api-job-{}'.format(len(threads)), target = work)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+    queue.put((job_id, run))
+
+
+def work():
+    while True:
+        job_id, run = queue.get()
+        try:
+            if store.set_status(job_id, state = 'running') is None:
+                log.warning(u'Job {} was removed before running'.format(job_id))
+                continue
+            run(job_id)
+        except Exception as exc:
+            log.exception(u'Job {} failed'.format(job_id))
+            try:
+                store.set_status(job_id,
+                    error = dict(
+                        code = 500,
+                        message = u'{}: {}'.format(exc.__class__.__name__, exc),
+                        ),
+                    state = 'failed',
+                    )
+            except Exception:
+                # Never let an exception end the thread: the other jobs would never run.
+                log.exception(u'Status of job {} could not be updated'.format(job_id))
+        finally:
+            queue.task_done()
+
+
+class JobStore(object):
+    """Jobs directory"""
+
+    def __init__(self, dir, ttl):
+        self.dir = dir
+        self.ttl = ttl
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+
+    def append_results(self, job_id, items):
+        with open(os.path.join(self.dir, job_id, 'results.ndjson'), 'a') as results_file:
+            results_file.write(''.join(
+                json.dumps(item) + '\n'
+                for item in items
+                ))
+
+    def create(self, request_json, total = None):
+        """Store a new job and return its ID."""
+        self.remove_expired()
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.dir, job_id)
+        os.mkdir(job_dir)
+        with open(os.path.join(job_dir, 'request.json'), 'w') as request_file:
+            json.dump(request_json, request_file)
+        open(os.path.join(job_dir, 'results.ndjson'), 'w').close()
+        now = time.time()
+        self.write_status(job_id, dict(
+            created = now,
+            done = 0,
+            id = job_id,
+            state = 'queued',
+            total = total,
+            updated = now,
+            ))
+        return job_id
+
+    def get_status(self, job_id):
+        """Return the status of a job, or None when it doesn't exist (or has expired)."""
+        try:
+            with open(os.path.join(self.dir, job_id, 'status.json')) as status_file:
+                return json.load(status_file)
+        except (IOError, ValueError):
+            return None
+
+    def iter_results_lines(self, job_id, offset = 0, limit = None):
+        """Iterate over the complete lines of the results of a job, skipping the first ``offset`` ones."""
+        count = 0
+        with open(os.path.join(self.dir, job_id, 'results.ndjson')) as results_file:
+            for line_index, line in enumerate(results_file):
+                if not line.endswith('\n'):
+                    break  # Line is being written.
+                if line_index < offset:
+                    continue
+                if limit is not None and count >= limit:
+                    break
+                count += 1
+                yield line
+
+    def load_request(self, job_id):
+        with open(os.path.join(self.dir, job_id, 'request.json')) as request_file:
+            return json.load(request_file)
+
+    def remove_expired(self):
+        expiration_time = time.time() - self.ttl
+        for job_id in os.listdir(self.dir):
+            status_file_path = os.path.join(self.dir, job_id, 'status.json')
+            try:
+                expired = os.path.getmtime(status_file_path) < expiration_time
+            except OSError:
+                continue
+            if expired:
+                shutil.rmtree(os.path.join(self.dir, job_id), ignore_errors = True)
+
+    def set_status(self, job_id, **changes):
+        """Update the status of a job and return it, or return None when the job doesn't exist (or has expired)."""
+        status = self.get_status(job_id)
+        if status is None:
+            return None
+        status.update(changes)
+        status['updated'] = time.time()
+        self.write_status(job_id, status)
+        return status
+
+    def write_status(self, job_id, status):
+        # Write then rename the file, so that readers never see a partial status.
+        status_file_path = os.path.join(self.dir, job_id, 'status.json')
+        temporary_file_path = status_file_path + '.tmp'
+        with open(temporary_file_path, 'w') as status_file:
+            json.dump(status, status_file)
+        os.rename(temporary_file_path, status_file_path)
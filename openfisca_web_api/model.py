@@ -6,6 +6,8 @@ from openfisca_core.reforms import Reform
 
 import logging
 
+from . import reform_diffs, variables_index
+
 
 log = logging.getLogger(__name__)
 
@@ -14,10 +16,16 @@ log = logging.getLogger(__name__)
 reforms = None
 extensions = None
 decomposition_json_by_file_path_cache = {}
+formula_cache = None
 input_variables_and_parameters_by_column_name_cache = {}
 parameters_cache = None
+parameters_index = None
+reform_diff_by_keys = {}
 reformed_tbs = None
+response_cache = None
+simulation_template_by_key = None
 tax_benefit_system = None
+variables_index_by_key = {}
 
 
 def get_cached_composed_reform(reform_keys, tax_benefit_system):
@@ -36,6 +44,25 @@ def get_cached_composed_reform(reform_keys, tax_benefit_system):
     return composed_reform_tbs
 
 
+def get_cached_reform_diff(base_tax_benefit_system, reform_tax_benefit_system):
+    """Return the variables and parameters that a reform changes, compared with the system it is applied to."""
+    keys = (getattr(base_tax_benefit_system, 'full_key', None), reform_tax_benefit_system.full_key)
+    reform_diff = reform_diff_by_keys.get(keys)
+    if reform_diff is None:
+        reform_diff = reform_diff_by_keys[keys] = reform_diffs.ReformDiff(base_tax_benefit_system,
+            reform_tax_benefit_system)
+    return reform_diff
+
+
+def get_cached_variables_index(tax_benefit_system):
+    """Return the index of the converters of the variables of a tax-benefit system, built at its first use."""
+    key = getattr(tax_benefit_system, 'full_key', None)
+    index = variables_index_by_key.get(key)
+    if index is None:
+        index = variables_index_by_key[key] = variables_index.VariablesIndex(tax_benefit_system)
+    return index
+
+
 def get_cached_or_new_decomposition_json(tax_benefit_system):
     xml_file_path = tax_benefit_system.decomposition_file_path
     global decomposition_json_by_file_path_cache
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+
+"""Index of the parameters of the legislation, by name and by name prefix"""
+
+
+import bisect
+import collections
+
+from openfisca_core import periods, taxscales
+from openfisca_core.parameters import Scale
+
+from . import caches
+
+
+SUBTREE_SUFFIX = u'.*'
+
+
+class ParametersIndex(object):
+    """The JSON descriptions of the parameters of the legislation, indexed by name and in a trie of name fragments
+
+    A name ending with ``.*`` designates every parameter of a subtree.
+
+    >>> index = ParametersIndex([{'name': u'a.b.c'}, {'name': u'a.d'}, {'name': u'e'}])
+    >>> u'a.d' in index, u'a' in index, u'a.*' in index, u'a.b.*' in index, u'f.*' in index
+    (True, False, True, True, False)
+    >>> [parameter_json['name'] for parameter_json in index.iter_parameters_json([u'a.*', u'a.d'])]
+    [u'a.b.c', u'a.d']
+    """
+
+    def __init__(self, parameters_json, history_by_name = None, dated_cache_max_bytes = None,
+            dated_cache_max_entries = 100):
+        # name => (starts, values): the JSON of the values of a parameter, with their start and stop instants, sorted
+        # by start
+        self.history_by_name = history_by_name or {}
+        # instant => dated parameter JSON by name, built at the first request of the instant, and shared by the
+        # responses: its items must never be modified.
+        self.dated_parameter_json_by_name_cache = caches.LRUCache(max_bytes = dated_cache_max_bytes,
+            max_entries = dated_cache_max_entries)
+        self.parameter_json_by_name = {}
+        self.parameters_json = parameters_json
+        self.trie = {}  # name fragment => trie of the children, the parameter of a leaf being at key None
+        for parameter_json in parameters_json:
+            name = parameter_json['name']
+            self.parameter_json_by_name[name] = parameter_json
+            node = self.trie
+            for name_fragment in name.split(u'.'):
+                node = node.setdefault(name_fragment, {})
+            node[None] = parameter_json
+
+    def __contains__(self, name):
+        if name.endswith(SUBTREE_SUFFIX):
+            return self.get_subtree(name[:-len(SUBTREE_SUFFIX)]) is not None
+        return name in self.parameter_json_by_name
+
+    def get_dated_parameter_json_by_name(self, tax_benefit_system, instant):
+        """Return the JSON descriptions of the parameters, with their values at an instant, by name.
+
+        The returned JSON is cached, so it must not be modified. Its size in cache is approximated by the size of the
+        representation of the values, the other items being shared with the undated JSON descriptions.
+        """
+        key = str(instant)
+        dated_parameter_json_by_name = self.dated_parameter_json_by_name_cache.get(key)
+        if dated_parameter_json_by_name is None:
+            parameters_at_instant = tax_benefit_system.get_parameters_at_instant(instant)
+            dated_parameter_json_by_name = {}
+            size = 0
+            for parameter_json in self.parameters_json:
+                name = parameter_json['name']
+                value_json = dated_parameter_to_json(get_parameter_at_instant(parameters_at_instant, name))
+                size += len(name) + len(repr(value_json))
+                dated_parameter_json_by_name[name] = collections.OrderedDict(sorted(dict(parameter_json,
+                    **value_json).iteritems()))
+            self.dated_parameter_json_by_name_cache.set(key, dated_parameter_json_by_name, size = size)
+        return dated_parameter_json_by_name
+
+    def get_history(self, name, start = None, stop = None):
+        """Return the successive values of a parameter, which overlap the given range of instants (as strings).
+
+        >>> index = ParametersIndex([{'name': u'a'}], history_by_name = dict(a = breakpoints_to_history([
+        ...     ('2010-01-01', dict(value = 1)),
+        ...     ('2012-01-01', dict(value = 1)),
+        ...     ('2014-01-01', dict(value = 2)),
+        ...     ])))
+        >>> [(value_json['start'], value_json['stop']) for value_json in index.get_history('a', start = '2011-01-01')]
+        [('2010-01-01', '2013-12-31'), ('2014-01-01', None)]
+        >>> index.get_history('a', stop = '2009-12-31')
+        []
+        """
+        starts, values_json = self.history_by_name.get(name, ((), ()))
+        first_index = max(bisect.bisect_right(starts, start) - 1, 0) if start is not None else 0
+        last_index = bisect.bisect_right(starts, stop) if stop is not None else len(starts)
+        return list(values_json[first_index:last_index])
+
+    def get_subtree(self, prefix):
+        """Return the trie of the parameters whose name starts with the given prefix, or None."""
+        node = self.trie
+        for name_fragment in prefix.split(u'.'):
+            node = node.get(name_fragment)
+            if node is None:
+                return None
+        return node
+
+    def iter_parameters_json(self, names):
+        """Iterate over the JSON descriptions of the parameters designated by names or subtrees, without duplicates."""
+        seen_names = set()
+        for name in names:
+            if name.endswith(SUBTREE_SUFFIX):
+                parameters_json = iter_trie_parameters_json(self.get_subtree(name[:-len(SUBTREE_SUFFIX)]) or {})
+            else:
+                parameters_json = [self.parameter_json_by_name[name]]
+            for parameter_json in parameters_json:
+                if parameter_json['name'] not in seen_names:
+                    seen_names.add(parameter_json['name'])
+                    yield parameter_json
+
+
+def iter_trie_parameters_json(trie):
+    """Iterate over the JSON descriptions of the parameters of a trie, sorted by name."""
+    pending_nodes = [trie]
+    while pending_nodes:
+        node = pending_nodes.pop()
+        parameter_json = node.get(None)
+        if parameter_json is not None:
+            yield parameter_json
+        pending_nodes.extend(
+            child
+            for name_fragment, child in sorted(node.iteritems(), reverse = True)
+            if name_fragment is not None
+            )
+
+
+def dated_parameter_to_json(value):
+    """Return the JSON of the value of a parameter (or of a scale) at an instant.
+
+    >>> dated_parameter_to_json(0.5)
+    {'value': 0.5}
+    """
+    if isinstance(value, taxscales.AmountTaxScale):
+        return dict(brackets = [
+            collections.OrderedDict([('amount', amount), ('threshold', threshold)])
+            for amount, threshold in zip(value.amounts, value.thresholds)
+            ])
+    if isinstance(value, taxscales.AbstractRateTaxScale):
+        return dict(brackets = [
+            collections.OrderedDict([('rate', rate), ('threshold', threshold)])
+            for rate, threshold in zip(value.rates, value.thresholds)
+            ])
+    return dict(value = value)
+
+
+def get_parameter_at_instant(parameters_at_instant, name):
+    """Return the value of a parameter at an instant, or None when it is not defined at this instant."""
+    node = parameters_at_instant
+    for name_fragment in name.split('.'):
+        try:
+            node = node[name_fragment]
+        except KeyError:
+            return None
+    return node
+
+
+def breakpoints_to_history(breakpoints):
+    """Return the starts and the JSON of the values of a parameter, from its breakpoints (start, value JSON).
+
+    Consecutive breakpoints with the same value are merged. Each value ends the day before the start of the next one.
+    """
+    starts = []
+    values_json = []
+    for start, value_json in sorted(breakpoints, key = lambda (start, value_json): start):
+        if values_json and all(values_json[-1][key] == value for key, value in value_json.iteritems()):
+            continue
+        if values_json:
+            values_json[-1]['stop'] = str(periods.instant(start).offset(-1, 'day'))
+        starts.append(start)
+        values_json.append(collections.OrderedDict(sorted(dict(value_json, start = start, stop = None).iteritems())))
+    return starts, values_json
+
+
+def get_breakpoints(node):
+    """Return the start instants (as strings) of the successive values of a parameter or of a scale, with their JSON."""
+    if isinstance(node, Scale):
+        starts = sorted(set(
+            value_at_instant.instant_str
+            for bracket in node.brackets
+            for parameter in bracket.children.itervalues()
+            for value_at_instant in parameter.values_list
+            ))
+        return [
+            (start, dated_parameter_to_json(node.get_at_instant(start)))
+            for start in starts
+            ]
+    return [
+        (value_at_instant.instant_str, dict(value = value_at_instant.value))
+        for value_at_instant in node.values_list
+        ]
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+
+"""Profiling of the variables computed by simulations
+
+A :class:`Profiler` gives a :class:`ProfilingTracer` to each profiled simulation. The tracer measures the wall time
+spent in each calculation (including the calculations of its dependencies for cumulative time, excluding them for
+self time), and aggregates it by variable and period.
+"""
+
+
+import collections
+import time
+
+from openfisca_core import tracers
+
+
+class Profiler(object):
+    """Statistics of the calculations of the simulations using its tracers"""
+
+    def __init__(self):
+        # (variable name, period) => [calls count, cumulative time, self time]
+        self.stats_by_variable_period = collections.defaultdict(lambda: [0, 0.0, 0.0])
+
+    def make_tracer(self):
+        return ProfilingTracer(self)
+
+    def to_json(self, limit = None):
+        """Return the statistics of the variables, the most time-consuming (by self time) first.
+
+        >>> profiler = Profiler()
+        >>> tracer = profiler.make_tracer()
+        >>> tracer.record_calculation_start('a', '2014')
+        >>> tracer.record_calculation_start('b', '2014')
+        >>> tracer.record_calculation_end('b', '2014', None)
+        >>> tracer.record_calculation_end('a', '2014', None)
+        >>> sorted((item['variable'], item['period'], item['calls']) for item in profiler.to_json())
+        [('a', '2014', 1), ('b', '2014', 1)]
+        """
+        items = sorted(
+            self.stats_by_variable_period.iteritems(),
+            key = lambda (variable_period, stats): stats[2],
+            reverse = True,
+            )
+        if limit is not None:
+            items = items[:limit]
+        return [
+            collections.OrderedDict([
+                ('variable', variable_name),
+                ('period', period),
+                ('calls', calls_count),  # cache hits included
+                ('cumulative', cumulative_time),
+                ('self', self_time),
+                ])
+            for (variable_name, period), (calls_count, cumulative_time, self_time) in items
+            ]
+
+
+class ProfilingTracer(tracers.Tracer):
+    """A simulation tracer, also measuring the time spent in each calculation"""
+
+    def __init__(self, profiler):
+        super(ProfilingTracer, self).__init__()
+        self.profiler = profiler
+        self.timers = []  # [start time, time spent in dependencies], in the order of self.stack
+
+    def record_calculation_abortion(self, variable_name, period, **parameters):
+        super(ProfilingTracer, self).record_calculation_abortion(variable_name, period, **parameters)
+        start_time, dependencies_time = self.timers.pop()
+        if self.timers:
+            # The time spent is still a part of the calculation of the parent, but not of its self time.
+            self.timers[-1][1] += time.time() - start_time
+
+    def record_calculation_end(self, variable_name, period, result, **parameters):
+        super(ProfilingTracer, self).record_calculation_end(variable_name, period, result, **parameters)
+        start_time, dependencies_time = self.timers.pop()
+        elapsed_time = time.time() - start_time
+        if self.timers:
+            self.timers[-1][1] += elapsed_time
+        stats = self.profiler.stats_by_variable_period[(variable_name, str(period))]
+        stats[0] += 1
+        stats[1] += elapsed_time
+        stats[2] += elapsed_time - dependencies_time
+
+    def record_calculation_start(self, variable_name, period, **parameters):
+        super(ProfilingTracer, self).record_calculation_start(variable_name, period, **parameters)
+        self.timers.append([time.time(), 0.0])
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+
+"""Reuse of the results of a base simulation by the simulation of a reform
+
+A :class:`ReformDiff` lists the variables and the parameter subtrees that a reform changes, compared with the
+tax-benefit system it is applied to.
+
+While a base simulation is computed, its tracer records the dependencies of each calculation and the parameters it
+reads. When the simulation of the same scenario is then computed with the reform, the values of the base simulation
+whose whole dependency closure is untouched by the reform are put in the cache of the reform simulation, just before
+they are requested, instead of being computed again.
+"""
+
+
+import collections
+
+from openfisca_core import tracers
+from openfisca_core.parameters import Parameter, ParameterNode, ParameterNodeAtInstant, Scale
+
+from . import tracer_keys
+
+
+def compose_parameter_name(node_name, child_name):
+    """Return the dotted name of a child of a parameter node.
+
+    >>> compose_parameter_name(u'', u'impot_revenu')
+    u'impot_revenu'
+    >>> compose_parameter_name(u'impot_revenu', u'bareme')
+    u'impot_revenu.bareme'
+    """
+    return u'{}.{}'.format(node_name, child_name) if node_name else child_name
+
+
+def are_related_parameters(name, other_name):
+    """Return whether two parameters are the same, or one of them is a node containing the other.
+
+    >>> are_related_parameters('impot_revenu', 'impot_revenu.bareme')
+    True
+    >>> are_related_parameters('impot_revenu.bareme', 'impot_revenu.bareme_ancien')
+    False
+    """
+    return name == other_name or other_name.startswith(name + u'.') or name.startswith(other_name + u'.')
+
+
+def iter_changed_parameters_name(base_node, node, name = u''):
+    """Yield the names of the parameters (or nodes) of ``base_node`` that differ in ``node``.
+
+    Scales are compared as a whole, because their brackets are read together.
+    """
+    if node is base_node:
+        return
+    if type(node) is not type(base_node):
+        yield name
+    elif isinstance(node, ParameterNode):
+        for child_name in sorted(set(base_node.children) | set(node.children)):
+            base_child = base_node.children.get(child_name)
+            child = node.children.get(child_name)
+            child_full_name = compose_parameter_name(name, child_name)
+            if base_child is None or child is None:
+                yield child_full_name
+            else:
+                for changed_name in iter_changed_parameters_name(base_child, child, child_full_name):
+                    yield changed_name
+    elif isinstance(node, Scale):
+        if len(node.brackets) != len(base_node.brackets) or any(
+                any(True for changed_name in iter_changed_parameters_name(base_bracket, bracket))
+                for base_bracket, bracket in zip(base_node.brackets, node.brackets)
+                ):
+            yield name
+    elif isinstance(node, Parameter):
+        if not node.values_list == base_node.values_list:
+            yield name
+    else:
+        yield name
+
+
+class ReformDiff(object):
+    """The variables and the parameters changed by a reform"""
+
+    def __init__(self, base_tax_benefit_system, reform_tax_benefit_system):
+        base_variables = base_tax_benefit_system.variables
+        variables = reform_tax_benefit_system.variables
+        self.variables_name = set(
+            variable_name
+            for variable_name in set(base_variables) | set(variables)
+            if variables.get(variable_name) is not base_variables.get(variable_name)
+            )
+        self.parameters_name = set(iter_changed_parameters_name(base_tax_benefit_system.parameters,
+            reform_tax_benefit_system.parameters))
+
+    def touches_parameters(self, parameters_name):
+        """Return whether the reform changes one of the given parameters, one of their children or their parent."""
+        for parameter_name in parameters_name:
+            if not parameter_name:
+                # The whole parameters tree has been read.
+                if self.parameters_name:
+                    return True
+                continue
+            if any(
+                    are_related_parameters(parameter_name, changed_parameter_name)
+                    for changed_parameter_name in self.parameters_name
+                    ):
+                return True
+        return False
+
+    def to_json(self):
+        return collections.OrderedDict([
+            ('parameters', sorted(self.parameters_name)),
+            ('variables', sorted(self.variables_name)),
+            ])
+
+
+class RecordingParameterNode(object):
+    """A parameter node at an instant, recording the names of the parameters read through it"""
+
+    def __init__(self, node, name, record):
+        self._node = node
+        self._node_name = name
+        self._record = record
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            # Technical attribute (like "_children"): consider that the whole node is read.
+            self._record(self._node_name)
+            return getattr(self._node, key)
+        return self._wrap(getattr(self._node, key), key)
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return self._wrap(self._node[key], key)
+        # Fancy indexing reads every child of the node.
+        self._record(self._node_name)
+        return self._node[key]
+
+    def __iter__(self):
+        return iter(self._node)
+
+    def __repr__(self):
+        return repr(self._node)
+
+    def _wrap(self, child, child_name):
+        child_full_name = compose_parameter_name(self._node_name, child_name)
+        if isinstance(child, ParameterNodeAtInstant):
+            return RecordingParameterNode(child, child_full_name, self._record)
+        self._record(child_full_name)
+        return child
+
+
+class RecordingTaxBenefitSystem(object):
+    """A tax-benefit system, recording the parameters read by each calculation of a simulation"""
+
+    def __init__(self, simulation):
+        self.parameters_name_by_key = collections.defaultdict(set)
+        self.simulation = simulation
+        self.tax_benefit_system = simulation.tax_benefit_system
+
+    def __getattr__(self, name):
+        return getattr(self.tax_benefit_system, name)
+
+    def get_parameters_at_instant(self, instant):
+        return RecordingParameterNode(self.tax_benefit_system.get_parameters_at_instant(instant), u'',
+            self.record)
+
+    def record(self, parameter_name):
+        stack = self.simulation.tracer.stack
+        if stack:
+            self.parameters_name_by_key[stack[-1]].add(parameter_name)
+
+
+class SeedingTracer(object):
+    """A tracer putting the reusable values of a base simulation in the cache, just before they are requested"""
+
+    def __init__(self, tracer, base_simulation, simulation, untouched_keys):
+        self.base_simulation = base_simulation
+        self.reused_count = 0
+        self.simulation = simulation
+        self.tracer = tracer
+        self.untouched_keys = untouched_keys
+
+    def __getattr__(self, name):
+        return getattr(self.tracer, name)
+
+    def record_calculation_abortion(self, variable_name, period, **parameters):
+        self.tracer.record_calculation_abortion(variable_name, period, **parameters)
+
+    def record_calculation_end(self, variable_name, period, result, **parameters):
+        self.tracer.record_calculation_end(variable_name, period, result, **parameters)
+
+    def record_calculation_start(self, variable_name, period, **parameters):
+        if not parameters.get('extra_params'):
+            key = tracers.Tracer._get_key(variable_name, period)
+            if key in self.untouched_keys:
+                self.untouched_keys.discard(key)
+                holder = self.simulation.get_holder(variable_name)
+                if holder.get_array(period) is None:
+                    array = self.base_simulation.get_holder(variable_name).get_array(period)
+                    if array is not None:
+                        holder.put_in_cache(array, period)
+                        self.reused_count += 1
+        self.tracer.record_calculation_start(variable_name, period, **parameters)
+
+
+class ResultsReuse(object):
+    """The base simulations of a request, whose results can be reused by the reform simulations of the same scenarios
+
+    Each simulation must be given to :meth:`start` before its calculations and to :meth:`stop` after them. Base
+    simulations are recorded, reform simulations reuse the values of the base simulation of the same scenario.
+    """
+
+    def __init__(self, reform_diff, reform_tax_benefit_system):
+        self.base_by_scenario_index = {}  # scenario index => (base simulation, parameters name by key)
+        self.reform_diff = reform_diff
+        self.reform_tax_benefit_system = reform_tax_benefit_system
+        self.reused_count = 0
+
+    def get_untouched_keys(self, trace, parameters_name_by_key):
+        """Return the keys of the calculations of a base simulation whose dependency closure is untouched."""
+        reform_diff = self.reform_diff
+        touched_by_key = {}
+        visiting_keys = set()
+        for root_key in trace:
+            pending_keys = [root_key]
+            while pending_keys:
+                key = pending_keys[-1]
+                if key in touched_by_key:
+                    pending_keys.pop()
+                    continue
+                node = trace.get(key)
+                if node is None:
+                    # Calculation not traced (aborted for instance)
+                    touched_by_key[key] = True
+                    pending_keys.pop()
+                    continue
+                dependencies = node['dependencies']
+                if key not in visiting_keys:
+                    unknown_dependencies = [
+                        dependency
+                        for dependency in dependencies
+                        if dependency not in touched_by_key
+                        ]
+                    if unknown_dependencies:
+                        visiting_keys.add(key)
+                        pending_keys.extend(unknown_dependencies)
+                        continue
+                pending_keys.pop()
+                visiting_keys.discard(key)
+                if tracer_keys.get_key_variable_name(key) in reform_diff.variables_name:
+                    touched = True
+                elif reform_diff.touches_parameters(parameters_name_by_key.get(key, ())):
+                    touched = True
+                else:
+                    # A dependency still unknown belongs to a cycle.
+                    touched = any(touched_by_key.get(dependency, True) for dependency in dependencies)
+                touched_by_key[key] = touched
+        return set(
+            key
+            for key, touched in touched_by_key.iteritems()
+            if not touched
+            )
+
+    def start(self, scenario_index, simulation):
+        if simulation.tax_benefit_system is self.reform_tax_benefit_system:
+            base_simulation, parameters_name_by_key = self.base_by_scenario_index.pop(scenario_index, (None, None))
+            if base_simulation is None or any(
+                    entity.count != simulation.entities[entity_key].count
+                    for entity_key, entity in base_simulation.entities.iteritems()
+                    ):
+                return
+            untouched_keys = self.get_untouched_keys(base_simulation.tracer.trace, parameters_name_by_key)
+            simulation.tracer = SeedingTracer(simulation.tracer if simulation.trace else tracers.Tracer(),
+                base_simulation, simulation, untouched_keys)
+            simulation.trace = True
+        else:
+            if not simulation.trace:
+                simulation.trace = True
+                simulation.tracer = tracers.Tracer()
+            simulation.tax_benefit_system = RecordingTaxBenefitSystem(simulation)
+
+    def stop(self, scenario_index, simulation):
+        if isinstance(simulation.tax_benefit_system, RecordingTaxBenefitSystem):
+            recording_tax_benefit_system = simulation.tax_benefit_system
+            simulation.tax_benefit_system = recording_tax_benefit_system.tax_benefit_system
+            self.base_by_scenario_index[scenario_index] = (simulation,
+                recording_tax_benefit_system.parameters_name_by_key)
+        elif isinstance(simulation.tracer, SeedingTracer):
+            self.reused_count += simulation.tracer.reused_count
+            simulation.tracer = simulation.tracer.tracer
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+
+"""Simulation sessions, kept alive between requests
+
+A session keeps the simulation of a scenario, with its cached holders. When some inputs of the scenario change, only
+the values that depend on them (directly or not) are removed from the cache, so that the next calculation recomputes
+them and nothing else.
+
+Dependencies are recorded by the tracer of the simulation: they are moved to the session after each calculation,
+and the tracer is reset, so that it doesn't retain the computed arrays.
+"""
+
+
+import collections
+import threading
+import uuid
+
+from openfisca_core import tracers
+
+from . import tracer_keys
+
+
+# Initialized in environment module
+store = None  # caches.LRUCache of sessions, by ID
+
+
+class Session(object):
+    """A scenario and its simulation"""
+
+    def __init__(self, scenario, scenario_json, reforms = None):
+        self.dependents_by_key = collections.defaultdict(set)
+        self.id = uuid.uuid4().hex
+        self.lock = threading.Lock()  # Acquire it before using the simulation.
+        self.reforms = reforms
+        self.scenario = scenario
+        self.scenario_json = scenario_json
+        self.simulation = scenario.new_simulation(trace = True)
+
+    def calculate(self, variables):
+        simulation = self.simulation
+        try:
+            for variable_name in variables:
+                simulation.calculate_output(variable_name, simulation.period)
+        finally:
+            for key, node in simulation.tracer.trace.iteritems():
+                for dependency_key in node['dependencies']:
+                    self.dependents_by_key[dependency_key].add(key)
+            simulation.tracer = tracers.Tracer()
+
+    def get_memory_usage(self):
+        return self.simulation.get_memory_usage()['total_nb_bytes']
+
+    def update_inputs(self, scenario, scenario_json, variables_name):
+        """Replace the scenario by a new one, differing only by the values of the given variables.
+
+        Return the number of cached values removed (the new inputs excepted). When the new inputs are invalid, a
+        ``ValueError`` is raised and the session is left unchanged.
+        """
+        # Convert all the new inputs before changing anything.
+        new_simulation = scenario.new_simulation()
+        arrays_by_period_by_variable_name = {}
+        for variable_name in variables_name:
+            new_holder = new_simulation.get_holder(variable_name)
+            arrays_by_period_by_variable_name[variable_name] = [
+                (period, new_holder.get_array(period))
+                for period in sorted(new_holder.get_known_periods())
+                ]
+        old_arrays_by_period_by_variable_name = {}
+        try:
+            for variable_name, arrays_by_period in arrays_by_period_by_variable_name.iteritems():
+                holder = self.simulation.get_holder(variable_name)
+                old_arrays_by_period_by_variable_name[variable_name] = [
+                    (period, holder.get_array(period))
+                    for period in holder.get_known_periods()
+                    ]
+                holder.delete_arrays()
+                for period, array in arrays_by_period:
+                    holder.put_in_cache(array, period)
+        except ValueError:
+            # Restore the previous inputs.
+            for variable_name, old_arrays_by_period in old_arrays_by_period_by_variable_name.iteritems():
+                holder = self.simulation.get_holder(variable_name)
+                holder.delete_arrays()
+                for period, array in old_arrays_by_period:
+                    holder.put_in_cache(array, period)
+            raise
+        self.scenario = scenario
+        self.scenario_json = scenario_json
+
+        # Walk through the dependents of the changed variables.
+        pending_keys = [
+            key
+            for key in self.dependents_by_key
+            if tracer_keys.get_key_variable_name(key) in variables_name
+            ]
+        invalidated_keys = set()
+        while pending_keys:
+            for dependent_key in self.dependents_by_key.get(pending_keys.pop(), ()):
+                if dependent_key not in invalidated_keys \
+                        and tracer_keys.get_key_variable_name(dependent_key) not in variables_name:
+                    invalidated_keys.add(dependent_key)
+                    pending_keys.append(dependent_key)
+        for key in invalidated_keys:
+            self.simulation.get_holder(tracer_keys.get_key_variable_name(key)).delete_arrays(
+                tracer_keys.get_key_period(key))
+        return len(invalidated_keys)
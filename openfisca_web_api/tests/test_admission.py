@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+
+import json
+
+from nose.tools import assert_equal, assert_in
+from webob import Request
+
+from . import common
+from .. import admission
+
+
+def setup_module(module):
+    common.get_or_load_app()
+
+
+def post_calculate():
+    req = Request.blank(
+        '/api/1/calculate',
+        body = json.dumps({
+            'scenarios': [
+                {
+                    'test_case': {
+                        'familles': [{'parents': ['ind0']}],
+                        'foyers_fiscaux': [{'declarants': ['ind0']}],
+                        'individus': [{'id': 'ind0', 'salaire_de_base': 20000}],
+                        'menages': [{'personne_de_reference': 'ind0'}],
+                        },
+                    'period': '2014',
+                    },
+                ],
+            'variables': ['irpp'],
+            }),
+        headers = (('Content-Type', 'application/json'),),
+        method = 'POST',
+        )
+    return req.get_response(common.app)
+
+
+def test_admission_with_full_queue():
+    original_controller = admission.controller
+    admission.controller = controller = admission.AdmissionController(
+        max_concurrency = 1,
+        max_queue_size = 0,
+        queue_timeout = 0,
+        )
+    try:
+        assert controller.acquire()  # Simulate a request being computed.
+        res = post_calculate()
+        assert_equal(res.status_code, 503, res.body)
+        assert_in('Retry-After', res.headers)
+
+        res = Request.blank('/api/1/status').get_response(common.app)
+        assert_equal(res.status_code, 200, res.body)
+        admission_json = json.loads(res.body)['value']['admission']
+        assert_equal(admission_json['in_flight'], 1)
+        assert_equal(admission_json['rejected'], 1)
+
+        controller.release()
+        res = post_calculate()
+        assert_equal(res.status_code, 200, res.body)
+        assert_equal(controller.in_flight, 0)
+    finally:
+        admission.controller = original_controller
+
+
+def test_admission_of_streamed_response():
+    original_controller = admission.controller
+    admission.controller = controller = admission.AdmissionController(
+        max_concurrency = 1,
+        max_queue_size = 0,
+        queue_timeout = 0,
+        )
+    try:
+        req = Request.blank(
+            '/api/1/calculate',
+            body = json.dumps({
+                'scenarios': [
+                    {
+                        'test_case': {
+                            'familles': [{'parents': ['ind0']}],
+                            'foyers_fiscaux': [{'declarants': ['ind0']}],
+                            'individus': [{'id': 'ind0', 'salaire_de_base': 20000}],
+                            'menages': [{'personne_de_reference': 'ind0'}],
+                            },
+                        'period': '2014',
+                        },
+                    ],
+                'stream': True,
+                'variables': ['irpp'],
+                }),
+            headers = (('Content-Type', 'application/json'),),
+            method = 'POST',
+            )
+        res = req.get_response(common.app)
+        assert_equal(res.status_code, 200, res.body)
+        assert_equal(len(res.body.splitlines()), 1)
+        assert_equal(controller.in_flight, 0)
+    finally:
+        admission.controller = original_controller
+
+
+def test_admission_of_formula_sweep():
+    original_controller = admission.controller
+    admission.controller = controller = admission.AdmissionController(
+        max_concurrency = 1,
+        max_queue_size = 0,
+        queue_timeout = 0,
+        )
+    try:
+        assert controller.acquire()  # Simulate a request being computed.
+        res = Request.blank('/api/2/formula/2015-01/salaire_net_a_payer?salaire_de_base=0:6000:200') \
+            .get_response(common.app)
+        assert_equal(res.status_code, 503, res.body)
+
+        # Formulas computed for a single person are not queued.
+        res = Request.blank('/api/2/formula/2015-01/salaire_net_a_payer?salaire_de_base=1300').get_response(common.app)
+        assert_equal(res.status_code, 200, res.body)
+
+        controller.release()
+        res = Request.blank('/api/2/formula/2015-01/salaire_net_a_payer?salaire_de_base=0:6000:200') \
+            .get_response(common.app)
+        assert_equal(res.status_code, 200, res.body)
+        assert_equal(controller.in_flight, 0)
+    finally:
+        admission.controller = original_controller
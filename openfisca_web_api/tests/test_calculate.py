@@ -7,6 +7,8 @@ from nose.tools import assert_equal, assert_in, assert_is_instance, assert_true
 from webob import Request
 
 from . import common
+from .. import binary, contexts, model, workers
+from ..controllers import calculate
 
 
 def setup_module(module):
@@ -921,3 +923,485 @@ def test_calculate_with_wrong_id_type():
     assert_equal(res.status_code, 400, res.body)
     res_body_json = json.loads(res.body)
     assert_in(u'Invalid id in entity', res_body_json['error']['message'], res.body)
+
+
+def test_calculate_with_batch():
+    def make_scenario(salaire_de_base):
+        return {
+            'test_case': {
+                'familles': [
+                    {
+                        'parents': ['ind0', 'ind1'],
+                        },
+                    ],
+                'foyers_fiscaux': [
+                    {
+                        'declarants': ['ind0', 'ind1'],
+                        },
+                    ],
+                'individus': [
+                    {'id': 'ind0', 'salaire_de_base': salaire_de_base},
+                    {'id': 'ind1'},
+                    ],
+                'menages': [
+                    {
+                        'conjoint': 'ind1',
+                        'personne_de_reference': 'ind0',
+                        },
+                    ],
+                },
+            'period': '2014',
+            }
+
+    test_case = {
+        'scenarios': [
+            make_scenario(15000),
+            make_scenario(30000),
+            make_scenario({'2014-01': 1500}),
+            make_scenario(45000),
+            ],
+        'variables': ['irpp', 'revenu_disponible'],
+        }
+    for output_format in ('test_case', 'variables'):
+        test_case['output_format'] = output_format
+        values = []
+        for batch in (False, True):
+            test_case['batch'] = batch
+            req = Request.blank(
+                '/api/1/calculate',
+                body = json.dumps(test_case),
+                headers = (('Content-Type', 'application/json'),),
+                method = 'POST',
+                )
+            res = req.get_response(common.app)
+            assert_equal(res.status_code, 200, res.body)
+            values.append(json.loads(res.body)['value'])
+        assert_equal(values[0], values[1])
+
+
+def test_calculate_with_workers():
+    test_case = {
+        'reforms': ['trannoy_wasmer'],
+        'scenarios': [
+            {
+                'test_case': {
+                    'familles': [
+                        {
+                            'parents': ['ind0'],
+                            },
+                        ],
+                    'foyers_fiscaux': [
+                        {
+                            'declarants': ['ind0'],
+                            },
+                        ],
+                    'individus': [
+                        {'id': 'ind0', 'salaire_de_base': salaire_de_base},
+                        ],
+                    'menages': [
+                        {
+                            'personne_de_reference': 'ind0',
+                            },
+                        ],
+                    },
+                'period': '2013',
+                }
+            for salaire_de_base in (10000, 20000, 30000)
+            ],
+        'variables': ['irpp', 'revenu_disponible'],
+        }
+    responses_json = []
+    try:
+        for calculate_workers in (0, 2):
+            if calculate_workers:
+                workers.start_pool(calculate_workers)
+            model.response_cache.clear()
+            req = Request.blank(
+                '/api/1/calculate',
+                body = json.dumps(test_case),
+                headers = (('Content-Type', 'application/json'),),
+                method = 'POST',
+                )
+            res = req.get_response(common.app)
+            assert_equal(res.status_code, 200, res.body)
+            responses_json.append(json.loads(res.body))
+    finally:
+        workers.stop_pool()
+    assert_equal(len(responses_json[1]['value']), 3)
+    assert_equal(responses_json[0]['value'], responses_json[1]['value'])
+    assert_equal(responses_json[0]['base_value'], responses_json[1]['base_value'])
+
+
+def test_calculate_with_response_cache():
+    test_case = {
+        'scenarios': [
+            {
+                'test_case': {
+                    'familles': [
+                        {
+                            'parents': ['ind0'],
+                            },
+                        ],
+                    'foyers_fiscaux': [
+                        {
+                            'declarants': ['ind0'],
+                            },
+                        ],
+                    'individus': [
+                        {'id': 'ind0', 'salaire_de_base': 25000},
+                        ],
+                    'menages': [
+                        {
+                            'personne_de_reference': 'ind0',
+                            },
+                        ],
+                    },
+                'period': '2014',
+                },
+            ],
+        'variables': ['irpp'],
+        }
+    model.response_cache.clear()
+    responses_json = []
+    for context, cache_status in (('first', 'openfisca-web-api; fwd=miss'), ('second', 'openfisca-web-api; hit')):
+        test_case['context'] = context
+        req = Request.blank(
+            '/api/1/calculate',
+            body = json.dumps(test_case),
+            headers = (('Content-Type', 'application/json'),),
+            method = 'POST',
+            )
+        res = req.get_response(common.app)
+        assert_equal(res.status_code, 200, res.body)
+        assert_equal(res.headers['Cache-Status'], cache_status)
+        response_json = json.loads(res.body)
+        assert_equal(response_json['context'], context)
+        responses_json.append(response_json)
+    assert_equal(responses_json[0]['value'], responses_json[1]['value'])
+
+    # Responses are localized, so they are cached by language.
+    req = Request.blank(
+        '/api/1/calculate',
+        body = json.dumps(test_case),
+        headers = (('Accept-Language', 'fr'), ('Content-Type', 'application/json')),
+        method = 'POST',
+        )
+    res = req.get_response(common.app)
+    assert_equal(res.status_code, 200, res.body)
+    assert_equal(res.headers['Cache-Status'], 'openfisca-web-api; fwd=miss')
+
+
+def test_scenario_cache():
+    tax_benefit_system = model.tax_benefit_system
+    scenario_json = {
+        'test_case': {
+            'individus': [
+                {'id': 'ind0', 'salaire_de_base': 12345},
+                ],
+            },
+        'period': '2014',
+        }
+    ctx = contexts.Ctx()
+    json_to_cached_or_new_instance = tax_benefit_system.Scenario.make_json_to_cached_or_new_instance(
+        ctx = ctx,
+        repair = True,
+        tax_benefit_system = tax_benefit_system,
+        )
+    scenario_cache = tax_benefit_system.Scenario.instance_and_error_couple_cache
+    first_scenario, error = json_to_cached_or_new_instance(scenario_json, state = ctx)
+    assert_equal(error, None)
+    first_scenario.suggest()  # Modifies first_scenario.test_case
+    hits = scenario_cache.hits
+    second_scenario, error = json_to_cached_or_new_instance(scenario_json, state = ctx)
+    assert_equal(error, None)
+    assert_equal(scenario_cache.hits, hits + 1)
+    assert first_scenario is not second_scenario
+    assert first_scenario.test_case is not second_scenario.test_case
+
+
+def test_calculate_with_stream():
+    test_case = {
+        'reforms': ['trannoy_wasmer'],
+        'scenarios': [
+            {
+                'test_case': {
+                    'familles': [
+                        {
+                            'parents': ['ind0'],
+                            },
+                        ],
+                    'foyers_fiscaux': [
+                        {
+                            'declarants': ['ind0'],
+                            },
+                        ],
+                    'individus': [
+                        {'id': 'ind0', 'salaire_de_base': salaire_de_base},
+                        ],
+                    'menages': [
+                        {
+                            'personne_de_reference': 'ind0',
+                            },
+                        ],
+                    },
+                'period': '2013',
+                }
+            for salaire_de_base in (10000, 20000, 30000)
+            ],
+        'variables': ['irpp'],
+        }
+    req = Request.blank(
+        '/api/1/calculate',
+        body = json.dumps(test_case),
+        headers = (('Content-Type', 'application/json'),),
+        method = 'POST',
+        )
+    res = req.get_response(common.app)
+    assert_equal(res.status_code, 200, res.body)
+    response_json = json.loads(res.body)
+
+    for stream_headers, stream in (
+            ((('Accept', 'application/x-ndjson'),), None),
+            ((), True),
+            ):
+        if stream is not None:
+            test_case['stream'] = stream
+        req = Request.blank(
+            '/api/1/calculate',
+            body = json.dumps(test_case),
+            headers = (('Content-Type', 'application/json'),) + stream_headers,
+            method = 'POST',
+            )
+        res = req.get_response(common.app)
+        assert_equal(res.status_code, 200, res.body)
+        assert_equal(res.content_type, 'application/x-ndjson')
+        items = [json.loads(line) for line in res.body.splitlines()]
+        assert_equal([item['scenario_index'] for item in items], [0, 1, 2])
+        assert_equal([item['value'] for item in items], response_json['value'])
+        assert_equal([item['base_value'] for item in items], response_json['base_value'])
+
+
+def test_calculate_with_columns_output_format():
+    test_case = {
+        'scenarios': [
+            {
+                'test_case': {
+                    'familles': [
+                        {
+                            'parents': ['ind0', 'ind1'],
+                            },
+                        ],
+                    'foyers_fiscaux': [
+                        {
+                            'declarants': ['ind0', 'ind1'],
+                            },
+                        ],
+                    'individus': [
+                        {'id': 'ind0', 'salaire_de_base': {'2014-01': salaire_de_base}},
+                        {'id': 'ind1'},
+                        ],
+                    'menages': [
+                        {
+                            'conjoint': 'ind1',
+                            'personne_de_reference': 'ind0',
+                            },
+                        ],
+                    },
+                'period': '2014-01',
+                }
+            for salaire_de_base in (1500, 4500)
+            ],
+        'variables': ['date_naissance', 'salaire_net', 'statut_occupation_logement'],
+        }
+    for batch in (False, True):
+        test_case['batch'] = batch
+        values = {}
+        for output_format in ('columns', 'variables'):
+            test_case['output_format'] = output_format
+            req = Request.blank(
+                '/api/1/calculate',
+                body = json.dumps(test_case),
+                headers = (('Content-Type', 'application/json'),),
+                method = 'POST',
+                )
+            res = req.get_response(common.app)
+            assert_equal(res.status_code, 200, res.body)
+            values[output_format] = json.loads(res.body)['value']
+        for columns_json, variables_json in zip(values['columns'], values['variables']):
+            assert_equal(sorted(columns_json.keys()), ['individus', 'menages'])
+            assert_equal(columns_json['individus']['date_naissance'], variables_json['date_naissance'])
+            assert_equal(columns_json['individus']['salaire_net'], variables_json['salaire_net'])
+            assert_equal(
+                columns_json['menages']['statut_occupation_logement'],
+                variables_json['statut_occupation_logement'],
+                )
+
+
+def test_calculate_with_binary_response():
+    test_case = {
+        'scenarios': [
+            {
+                'test_case': {
+                    'familles': [
+                        {
+                            'parents': ['ind0'],
+                            },
+                        ],
+                    'foyers_fiscaux': [
+                        {
+                            'declarants': ['ind0'],
+                            },
+                        ],
+                    'individus': [
+                        {'id': 'ind0', 'salaire_de_base': salaire_de_base},
+                        ],
+                    'menages': [
+                        {
+                            'personne_de_reference': 'ind0',
+                            },
+                        ],
+                    },
+                'period': '2014',
+                }
+            for salaire_de_base in (15000, 45000)
+            ],
+        'variables': ['irpp', 'revenu_disponible'],
+        }
+    req = Request.blank(
+        '/api/1/calculate',
+        body = json.dumps(dict(test_case, output_format = 'columns')),
+        headers = (('Content-Type', 'application/json'),),
+        method = 'POST',
+        )
+    res = req.get_response(common.app)
+    assert_equal(res.status_code, 200, res.body)
+    value = json.loads(res.body)['value']
+
+    req = Request.blank(
+        '/api/1/calculate',
+        body = json.dumps(test_case),
+        headers = (('Accept', binary.RAW_MEDIA_TYPE), ('Content-Type', 'application/json')),
+        method = 'POST',
+        )
+    res = req.get_response(common.app)
+    assert_equal(res.status_code, 200, res.body)
+    assert_equal(res.content_type, binary.RAW_MEDIA_TYPE)
+    binary_value = binary.decode(res.body)['value']
+    assert_equal(len(binary_value), 2)
+    for columns_json, binary_columns in zip(value, binary_value):
+        for entity_plural, variable_name in (('foyers_fiscaux', 'irpp'), ('menages', 'revenu_disponible')):
+            assert_equal(binary_columns[entity_plural][variable_name]['2014'].tolist(),
+                columns_json[entity_plural][variable_name]['2014'])
+
+
+def test_calculate_with_detailed_time():
+    test_case = {
+        'scenarios': [
+            {
+                'test_case': {
+                    'familles': [{'parents': ['ind0']}],
+                    'foyers_fiscaux': [{'declarants': ['ind0']}],
+                    'individus': [{'id': 'ind0', 'salaire_de_base': 20000}],
+                    'menages': [{'personne_de_reference': 'ind0'}],
+                    },
+                'period': '2014',
+                },
+            ],
+        'time': 'detailed',
+        'variables': ['revenu_disponible'],
+        }
+    req = Request.blank(
+        '/api/1/calculate',
+        body = json.dumps(test_case),
+        headers = (('Content-Type', 'application/json'),),
+        method = 'POST',
+        )
+    res = req.get_response(common.app)
+    assert_equal(res.status_code, 200, res.body)
+    time_json = json.loads(res.body)['time']
+    assert_in('calculate_simulation', time_json)
+    variables_json = time_json['variables']
+    assert_true(0 < len(variables_json) <= 20)
+    assert_equal(
+        [variable_json['self'] for variable_json in variables_json],
+        sorted((variable_json['self'] for variable_json in variables_json), reverse = True),
+        )
+    for variable_json in variables_json:
+        assert_true(variable_json['calls'] >= 1)
+        assert_true(variable_json['cumulative'] >= variable_json['self'])
+
+
+def test_scenario_bound_to_reform():
+    tax_benefit_system = model.tax_benefit_system
+    reform_tax_benefit_system = model.get_cached_composed_reform(['trannoy_wasmer'], tax_benefit_system)
+    ctx = contexts.Ctx()
+    scenario, error = tax_benefit_system.Scenario.make_json_to_cached_or_new_instance(
+        ctx = ctx,
+        repair = False,
+        tax_benefit_system = tax_benefit_system,
+        )({
+            'test_case': {
+                'familles': [{'parents': ['ind0']}],
+                'foyers_fiscaux': [{'declarants': ['ind0']}],
+                'individus': [{'id': 'ind0', 'salaire_de_base': 20000}],
+                'menages': [{'personne_de_reference': 'ind0'}],
+                },
+            'period': '2013',
+            }, state = ctx)
+    assert_equal(error, None)
+    reform_scenario = scenario.bind(reform_tax_benefit_system)
+    assert_true(reform_scenario is not None)
+    assert_true(reform_scenario.tax_benefit_system is reform_tax_benefit_system)
+    assert_true(reform_scenario.test_case is not scenario.test_case)
+    assert_equal(reform_scenario.test_case, scenario.test_case)
+
+
+def test_reform_diff():
+    reform_tax_benefit_system = model.get_cached_composed_reform(['trannoy_wasmer'], model.tax_benefit_system)
+    reform_diff = model.get_cached_reform_diff(model.tax_benefit_system, reform_tax_benefit_system)
+    assert_in('charge_loyer', reform_diff.variables_name)
+    assert_equal(reform_diff.parameters_name, set(['charge_loyer']))
+    assert_true(reform_diff.touches_parameters(['charge_loyer.plaf']))
+    assert_true(not reform_diff.touches_parameters(['impot_revenu.bareme']))
+
+
+def test_calculate_with_reform_reusing_base_results():
+    tax_benefit_system = model.tax_benefit_system
+    reform_tax_benefit_system = model.get_cached_composed_reform(['trannoy_wasmer'], tax_benefit_system)
+    ctx = contexts.Ctx()
+
+    def make_scenarios(tax_benefit_system):
+        scenario, error = tax_benefit_system.Scenario.make_json_to_instance(
+            repair = True,
+            tax_benefit_system = tax_benefit_system,
+            )({
+                'test_case': {
+                    'familles': [{'parents': ['ind0']}],
+                    'foyers_fiscaux': [{'declarants': ['ind0']}],
+                    'individus': [{'id': 'ind0', 'salaire_de_base': 20000}],
+                    'menages': [{'loyer': 6000, 'personne_de_reference': 'ind0'}],
+                    },
+                'period': '2013',
+                }, state = ctx)
+        assert_equal(error, None)
+        scenario.suggest()
+        return [scenario]
+
+    options = dict(
+        batch = False,
+        intermediate_variables = False,
+        output_format = 'variables',
+        use_label = False,
+        variables = ['irpp', 'revenu_disponible'],
+        )
+    reform_value = calculate.calculate_values(make_scenarios(reform_tax_benefit_system), **options)
+    results_reuse = calculate.make_results_reuse(make_scenarios(tax_benefit_system),
+        make_scenarios(reform_tax_benefit_system), False)
+    calculate.calculate_values(make_scenarios(tax_benefit_system), results_reuse = results_reuse, **options)
+    assert_equal(results_reuse.reused_count, 0)
+    assert_equal(
+        calculate.calculate_values(make_scenarios(reform_tax_benefit_system), results_reuse = results_reuse,
+            **options),
+        reform_value,
+        )
+    assert_true(results_reuse.reused_count > 0)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+
+import json
+import shutil
+import tempfile
+import threading
+import time
+
+from nose.tools import assert_equal, assert_in, assert_not_equal, assert_true
+from webob import Request
+
+from . import common
+from .. import coalescing
+
+
+def setup_module(module):
+    common.get_or_load_app()
+
+
+def test_single_flight():
+    single_flight = coalescing.SingleFlight()
+    calls = []
+    results = []
+
+    def compute():
+        calls.append(None)
+        time.sleep(0.2)
+        return len(calls)
+
+    threads = [
+        threading.Thread(target = lambda: results.append(single_flight.do('key', compute)))
+        for index in range(4)
+        ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equal(len(calls), 1)
+    assert_equal(sorted(results), [(1, False), (1, True), (1, True), (1, True)])
+
+
+def test_single_flight_with_unshared_value():
+    single_flight = coalescing.SingleFlight()
+    calls = []
+    results = []
+
+    def compute():
+        calls.append(None)
+        time.sleep(0.2)
+        return None  # An error response, for instance
+
+    threads = [
+        threading.Thread(target = lambda: results.append(single_flight.do('key', compute)))
+        for index in range(3)
+        ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equal(len(calls), 3)
+    assert_equal(results, [(None, False)] * 3)
+    assert_equal(single_flight.coalesced, 0)
+
+
+def test_single_flight_across_processes():
+    dir = tempfile.mkdtemp()
+    try:
+        # Two instances simulate two processes.
+        first_single_flight = coalescing.SingleFlight(dir = dir)
+        second_single_flight = coalescing.SingleFlight(dir = dir)
+        results = []
+
+        def compute():
+            time.sleep(0.2)
+            return 'value'
+
+        first_thread = threading.Thread(target = lambda: results.append(first_single_flight.do('key', compute)))
+        first_thread.start()
+        time.sleep(0.05)
+        results.append(second_single_flight.do('key', lambda: 'other value'))
+        first_thread.join()
+        assert_equal(sorted(results), [('value', False), ('value', True)])
+    finally:
+        shutil.rmtree(dir)
+
+
+def test_coalesced_calculate():
+    original_single_flight = coalescing.single_flight
+    coalescing.single_flight = coalescing.SingleFlight()
+    try:
+        responses = [None] * 3
+
+        def post_calculate(index):
+            req = Request.blank(
+                '/api/1/calculate',
+                body = json.dumps({
+                    'context': 'request {}'.format(index),
+                    'scenarios': [
+                        {
+                            'test_case': {
+                                'familles': [{'parents': ['ind0']}],
+                                'foyers_fiscaux': [{'declarants': ['ind0']}],
+                                'individus': [{'id': 'ind0', 'salaire_de_base': 12345}],
+                                'menages': [{'personne_de_reference': 'ind0'}],
+                                },
+                            'period': '2014',
+                            },
+                        ],
+                    'variables': ['revenu_disponible'],
+                    }),
+                headers = (('Content-Type', 'application/json'),),
+                method = 'POST',
+                )
+            responses[index] = req.get_response(common.app)
+
+        threads = [
+            threading.Thread(target = post_calculate, args = (index,))
+            for index in range(len(responses))
+            ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        values = []
+        for index, response in enumerate(responses):
+            assert_equal(response.status_code, 200, response.body)
+            response_json = json.loads(response.body)
+            assert_equal(response_json['context'], 'request {}'.format(index))
+            assert_equal(response_json['params']['context'], 'request {}'.format(index))
+            assert_true(len(response.headers.getall('Cache-Status')) <= 1)
+            values.append(response_json['value'])
+        assert_equal(values[0], values[1])
+        assert_equal(values[0], values[2])
+        assert_in(coalescing.single_flight.coalesced, (1, 2))
+    finally:
+        coalescing.single_flight = original_single_flight
+
+
+def test_request_key_depends_on_extensions():
+    target = '/api/2/formula/2015-01/salaire_net_a_payer?salaire_de_base=1300'
+    key, context = coalescing.get_request_key_and_context(Request.blank(target))
+    extensions_key, context = coalescing.get_request_key_and_context(
+        Request.blank(target, headers = (('X-Openfisca-Extensions', 'trannoy_wasmer'),)))
+    assert_not_equal(key, extensions_key)
@@ -4,9 +4,10 @@
 import json
 
 from webob import Request
-from nose.tools import assert_equal, assert_in, assert_not_in, assert_is_instance, assert_not_equal
+from nose.tools import assert_equal, assert_in, assert_is, assert_is_instance, assert_is_not, assert_not_equal, assert_not_in
 
 from . import common
+from .. import binary, model
 
 
 TARGET_URL = '/api/2/formula/'
@@ -48,8 +49,8 @@ def test_formula_get_status_code():
     assert_equal(send()['status_code'], 200)
 
 
-def test_formula_post_status_code():
-    assert_equal(send(method = 'POST')['status_code'], 405)
+def test_formula_post_without_body_status_code():
+    assert_equal(send(method = 'POST')['status_code'], 400)
 
 
 def test_formula_put_status_code():
@@ -201,3 +202,105 @@ def test_invalid_period_day_error_message():
     assert_in(VALID_DAY, message)
     assert_in('could not be parsed', message)
     assert_not_in('{', message)  # serialisation failed
+
+
+def test_binary_response():
+    target = TARGET_URL + VALID_PERIOD + '/' + VALID_FORMULA + '+' + VALID_OTHER_FORMULA + '?' + VALID_QUERY_STRING
+    res = Request.blank(target).get_response(common.app)
+    binary_res = Request.blank(target, headers = (('Accept', binary.RAW_MEDIA_TYPE),)).get_response(common.app)
+    assert_equal(binary_res.status_code, 200)
+    assert_equal(binary_res.content_type, binary.RAW_MEDIA_TYPE)
+    values = json.loads(res.body)['values']
+    binary_values = binary.decode(binary_res.body)['values']
+    for formula_name in (VALID_FORMULA, VALID_OTHER_FORMULA):
+        assert_equal(binary_values[formula_name].tolist(), [values[formula_name]])
+
+
+def test_simulation_template_keeps_no_value():
+    value = send(period = VALID_PERIOD, query_string = VALID_QUERY_STRING)['payload']['values'][VALID_FORMULA]
+    assert_not_equal(value, 0)
+    # The template of the period was used by the previous request, but the inputs of that request are not kept.
+    assert_equal(send(period = VALID_PERIOD)['payload']['values'][VALID_FORMULA], 0)
+    assert_equal(send(period = VALID_PERIOD, query_string = VALID_QUERY_STRING)['payload']['values'][VALID_FORMULA],
+        value)
+
+
+def test_formula_cache():
+    target = TARGET_URL + '2015-02/' + VALID_FORMULA + '+' + VALID_OTHER_FORMULA + '?' + VALID_QUERY_STRING
+    res = Request.blank(target).get_response(common.app)
+    cached_res = Request.blank(target).get_response(common.app)
+    assert_equal(cached_res.headers.get('Cache-Status'), 'openfisca-web-api; hit')
+    assert_equal(json.loads(cached_res.body), json.loads(res.body))
+    binary_res = Request.blank(target, headers = (('Accept', binary.RAW_MEDIA_TYPE),)).get_response(common.app)
+    assert_not_in('Cache-Status', binary_res.headers)  # Arrays are cached separately.
+    other_res = Request.blank(target.replace(str(PARAM_VALUE), str(PARAM_VALUE + 1))).get_response(common.app)
+    assert_not_in('Cache-Status', other_res.headers)
+    assert_not_equal(json.loads(other_res.body)['values'], json.loads(res.body)['values'])
+
+
+def send_batch(body, formula = VALID_FORMULA, period = VALID_PERIOD):
+    req = Request.blank(TARGET_URL + period + '/' + formula, method = 'POST', body = json.dumps(body))
+    res = req.get_response(common.app)
+    return {
+        'status_code': res.status_code,
+        'payload': json.loads(res.body)
+        }
+
+
+def test_formula_batch():
+    salaries = [1300, 1400, 0]
+    formulas = VALID_FORMULA + '+' + VALID_OTHER_FORMULA
+    expected_values = {
+        formula_name: [
+            send(formula = formula_name, period = VALID_PERIOD, query_string = '{}={}'.format(INPUT_VARIABLE, salary))[
+                'payload']['values'][formula_name]
+            for salary in salaries
+            ]
+        for formula_name in (VALID_FORMULA, VALID_OTHER_FORMULA)
+        }
+    rows_result = send_batch([{INPUT_VARIABLE: salary} for salary in salaries], formula = formulas)
+    assert_equal(rows_result['status_code'], 200)
+    assert_equal(rows_result['payload']['values'], expected_values)
+    columns_result = send_batch({INPUT_VARIABLE: salaries}, formula = formulas)
+    assert_equal(columns_result['payload']['values'], expected_values)
+    # A missing parameter takes its default value.
+    missing_result = send_batch([{INPUT_VARIABLE: salaries[0]}, {}])
+    assert_equal(missing_result['payload']['values'][VALID_FORMULA], [expected_values[VALID_FORMULA][0], 0])
+
+
+def test_formula_batch_errors():
+    assert_equal(send_batch({INPUT_VARIABLE: [1, 2], DATE_PARAM: [DATE_PARAM_VALUE]})['status_code'], 400)
+    assert_equal(send_batch([])['status_code'], 400)
+    assert_equal(send_batch([{INVALID_FORMULA: 1}])['status_code'], 400)
+    assert_equal(send_batch([{INPUT_VARIABLE: 1}], formula = INVALID_FORMULA)['status_code'], 404)
+    result = send_batch([{'age': 40}, {'age': 1.5}])  # age is an integer.
+    assert_equal(result['status_code'], 400)
+    assert_in("'age' of person 1", result['payload']['error']['message'])
+
+
+def test_formula_sweep():
+    result = send(period = VALID_PERIOD, query_string = '{}=0:2000:3'.format(INPUT_VARIABLE))
+    assert_equal(result['status_code'], 200)
+    assert_equal(result['payload']['params'][INPUT_VARIABLE], [0, 1000, 2000])
+    values = result['payload']['values'][VALID_FORMULA]
+    assert_equal(len(values), 3)
+    for salary, value in zip([0, 1000, 2000], values):
+        query_string = '{}={}'.format(INPUT_VARIABLE, salary)
+        assert_equal(send(period = VALID_PERIOD, query_string = query_string)['payload']['values'][VALID_FORMULA],
+            value)
+
+
+def test_formula_sweep_errors():
+    assert_equal(send(query_string = '{}=0:2000'.format(INPUT_VARIABLE))['status_code'], 400)
+    assert_equal(send(query_string = '{}=0:2000:0'.format(INPUT_VARIABLE))['status_code'], 400)
+    assert_equal(send(query_string = '{}=2015-01-01:2015-02-01:2'.format(DATE_PARAM))['status_code'], 400)
+
+
+def test_variables_index():
+    index = model.get_cached_variables_index(model.tax_benefit_system)
+    assert_is(model.get_cached_variables_index(model.tax_benefit_system), index)
+    assert_in(VALID_FORMULA, index.computable_variables_name)
+    assert_not_in(INPUT_VARIABLE, index.computable_variables_name)
+    assert_in(INPUT_VARIABLE, index.input_to_dated_python_by_name)
+    reform_tax_benefit_system = model.get_cached_composed_reform(['trannoy_wasmer'], model.tax_benefit_system)
+    assert_is_not(model.get_cached_variables_index(reform_tax_benefit_system), index)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+
+from nose.tools import assert_equal, assert_in, assert_not_equal, assert_not_in
+from webob import Request
+
+from . import common
+
+
+def setup_module(module):
+    common.get_or_load_app()
+
+
+def test_conditional_get():
+    res = Request.blank('/api/1/reforms').get_response(common.app)
+    assert_equal(res.status_code, 200)
+    etag = res.headers['ETag']
+    assert_in('max-age=', res.headers['Cache-Control'])
+
+    res = Request.blank('/api/1/reforms', headers = (('If-None-Match', etag),)).get_response(common.app)
+    assert_equal(res.status_code, 304)
+    assert_equal(res.body, '')
+    assert_equal(res.headers['ETag'], etag)
+
+    res = Request.blank('/api/1/reforms', headers = (('If-None-Match', '"other"'),)).get_response(common.app)
+    assert_equal(res.status_code, 200)
+    assert_equal(res.headers['ETag'], etag)
+
+
+def test_etag_depends_on_query():
+    etag = Request.blank('/api/2/entities').get_response(common.app).headers['ETag']
+    reform_etag = Request.blank('/api/2/entities?reform=trannoy_wasmer').get_response(common.app).headers['ETag']
+    assert_not_equal(etag, reform_etag)
+    context_etag = Request.blank('/api/2/entities?context=1').get_response(common.app).headers['ETag']
+    assert_not_equal(etag, context_etag)
+
+
+def test_formula_conditional_get():
+    target = '/api/2/formula/2015-01/salaire_net_a_payer?salaire_de_base=1300'
+    etag = Request.blank(target).get_response(common.app).headers['ETag']
+    res = Request.blank(target, headers = (('If-None-Match', etag),)).get_response(common.app)
+    assert_equal(res.status_code, 304)
+    res = Request.blank(target.replace('1300', '1400'), headers = (('If-None-Match', etag),)).get_response(common.app)
+    assert_equal(res.status_code, 200)
+
+
+def test_formula_etag_depends_on_extensions():
+    target = '/api/2/formula/2015-01/salaire_net_a_payer?salaire_de_base=1300'
+    etag = Request.blank(target).get_response(common.app).headers['ETag']
+    res = Request.blank(target, headers = (('X-Openfisca-Extensions', 'trannoy_wasmer'),)).get_response(common.app)
+    assert_equal(res.status_code, 200)
+    assert_not_equal(res.headers['ETag'], etag)
+    assert_in('X-OpenFisca-Extensions', res.headers['Vary'])
+    res = Request.blank(target, headers = (('If-None-Match', etag), ('X-Openfisca-Extensions', 'trannoy_wasmer'))) \
+        .get_response(common.app)
+    assert_equal(res.status_code, 200)
+
+
+def test_errors_have_no_etag():
+    res = Request.blank('/api/2/formula/2015-01/inexistent').get_response(common.app)
+    assert_equal(res.status_code, 404)
+    assert_not_in('ETag', res.headers)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from nose.tools import assert_equal, assert_in, assert_true
+from webob import Request
+
+from . import common
+from .. import jobs
+
+
+def setup_module(module):
+    common.get_or_load_app()
+
+
+def make_scenario_json(salaire_de_base):
+    return {
+        'test_case': {
+            'familles': [{'parents': ['ind0']}],
+            'foyers_fiscaux': [{'declarants': ['ind0']}],
+            'individus': [{'id': 'ind0', 'salaire_de_base': salaire_de_base}],
+            'menages': [{'personne_de_reference': 'ind0'}],
+            },
+        'period': '2014',
+        }
+
+
+def wait_for_job(job_url, timeout = 120):
+    start_time = time.time()
+    while True:
+        res = Request.blank(job_url).get_response(common.app)
+        assert_equal(res.status_code, 200, res.body)
+        job_json = json.loads(res.body)['value']
+        if job_json['state'] in ('done', 'failed') or time.time() - start_time > timeout:
+            return job_json
+        time.sleep(0.2)
+
+
+def test_job_with_more_than_100_scenarios():
+    req = Request.blank(
+        '/api/1/jobs',
+        body = json.dumps({
+            'batch': True,
+            'scenarios': [
+                make_scenario_json(salaire_de_base)
+                for salaire_de_base in range(0, 150000, 1000)
+                ],
+            'variables': ['revenu_disponible'],
+            }),
+        headers = (('Content-Type', 'application/json'),),
+        method = 'POST',
+        )
+    res = req.get_response(common.app)
+    assert_equal(res.status_code, 202, res.body)
+    job_json = json.loads(res.body)['value']
+    assert_equal(job_json['total'], 150)
+    job_url = '/api/1/jobs/{}'.format(job_json['id'])
+
+    job_json = wait_for_job(job_url)
+    assert_equal(job_json['state'], 'done', job_json)
+    assert_equal(job_json['done'], 150)
+
+    res = Request.blank(job_url + '/results?offset=100').get_response(common.app)
+    assert_equal(res.status_code, 200, res.body)
+    items = json.loads(res.body)['value']
+    assert_equal(len(items), 50)
+    assert_equal([item['scenario_index'] for item in items], range(100, 150))
+    assert_in('revenu_disponible', items[0]['value']['menages'][0])
+
+    res = Request.blank(job_url + '/results', headers = (('Accept', 'application/x-ndjson'),)) \
+        .get_response(common.app)
+    assert_equal(res.status_code, 200)
+    assert_equal(res.content_type, 'application/x-ndjson')
+    lines = res.body.splitlines()
+    assert_equal(len(lines), 150)
+    assert_equal(json.loads(lines[-1])['scenario_index'], 149)
+
+
+def test_job_with_invalid_scenario():
+    req = Request.blank(
+        '/api/1/jobs',
+        body = json.dumps({
+            'scenarios': [make_scenario_json(0), dict(make_scenario_json(0), XXX = 1)],
+            'variables': ['revenu_disponible'],
+            }),
+        headers = (('Content-Type', 'application/json'),),
+        method = 'POST',
+        )
+    res = req.get_response(common.app)
+    assert_equal(res.status_code, 202, res.body)
+    job_json = wait_for_job('/api/1/jobs/{}'.format(json.loads(res.body)['value']['id']))
+    assert_equal(job_json['state'], 'failed', job_json)
+    assert_equal(job_json['error']['code'], 400)
+    assert_in('1', job_json['error']['errors'][0]['scenarios'])
+
+
+def test_job_with_unknown_variable():
+    req = Request.blank(
+        '/api/1/jobs',
+        body = json.dumps({
+            'scenarios': [make_scenario_json(0)],
+            'variables': ['XXX'],
+            }),
+        headers = (('Content-Type', 'application/json'),),
+        method = 'POST',
+        )
+    res = req.get_response(common.app)
+    assert_equal(res.status_code, 400, res.body)
+
+
+def test_job_with_unsupported_options():
+    for option in ('stream', 'time', 'validate'):
+        req = Request.blank(
+            '/api/1/jobs',
+            body = json.dumps({
+                option: True,
+                'scenarios': [make_scenario_json(0)],
+                'variables': ['revenu_disponible'],
+                }),
+            headers = (('Content-Type', 'application/json'),),
+            method = 'POST',
+            )
+        res = req.get_response(common.app)
+        assert_equal(res.status_code, 400, res.body)
+        assert_in(option, json.loads(res.body)['error']['errors'][0])
+
+
+def test_unknown_job():
+    res = Request.blank('/api/1/jobs/{}'.format('0' * 32)).get_response(common.app)
+    assert_equal(res.status_code, 404)
+
+
+def test_jobs_removed_before_or_while_running():
+    original_store = jobs.store
+    dir = tempfile.mkdtemp()
+    jobs.store = jobs.JobStore(dir, 3600)
+    try:
+        calls = []
+
+        def run(job_id):
+            calls.append(job_id)
+
+        def remove_and_fail(job_id):
+            shutil.rmtree(os.path.join(dir, job_id))
+            raise ValueError('Job removed')
+
+        removed_job_id = jobs.store.create({})
+        shutil.rmtree(os.path.join(dir, removed_job_id))
+        jobs.enqueue(removed_job_id, run)
+        jobs.enqueue(jobs.store.create({}), remove_and_fail)
+        job_id = jobs.store.create({})
+        jobs.enqueue(job_id, run)
+        jobs.queue.join()
+        assert_equal(calls, [job_id])
+        assert_equal(jobs.store.get_status(job_id)['state'], 'running')
+        assert_true(all(thread.is_alive() for thread in jobs.threads))
+    finally:
+        jobs.store = original_store
+        shutil.rmtree(dir)
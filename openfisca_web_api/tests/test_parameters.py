@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+
+import json
+
+from nose.tools import assert_equal, assert_greater, assert_in, assert_true
+from webob import Request
+
+from . import common
+
+
+def setup_module(module):
+    common.get_or_load_app()
+
+
+def get_parameters(query_string = ''):
+    res = Request.blank('/api/1/parameters?' + query_string).get_response(common.app)
+    return res.status_code, json.loads(res.body)
+
+
+def test_parameters():
+    status_code, data = get_parameters()
+    assert_equal(status_code, 200)
+    assert_greater(len(data['parameters']), 1000)
+    assert_in('impot_revenu.bareme', [parameter_json['name'] for parameter_json in data['parameters']])
+
+
+def test_parameters_subtree():
+    status_code, data = get_parameters('name=impot_revenu.tspr.abatpro.*&name=impot_revenu.tspr.abatpro.max')
+    assert_equal(status_code, 200)
+    names = [parameter_json['name'] for parameter_json in data['parameters']]
+    assert_in('impot_revenu.tspr.abatpro.max', names)
+    assert_equal(len(names), len(set(names)))
+    assert_true(all(name.startswith('impot_revenu.tspr.abatpro.') for name in names))
+
+
+def test_parameters_at_instant():
+    status_code, data = get_parameters('name=impot_revenu.bareme&name=impot_revenu.tspr.abatpro.max&instant=2015-01-01')
+    assert_equal(status_code, 200)
+    bareme_json, max_json = data['parameters']
+    assert_equal(bareme_json['brackets'][1], dict(rate = 0.14, threshold = 9700.0))
+    assert_in('value', max_json)
+
+
+def test_unknown_parameters():
+    for name in ('impot_revenu', 'inexistent', 'inexistent.*'):
+        status_code, data = get_parameters('name=' + name)
+        assert_equal(status_code, 400)
+
+
+def test_parameters_at_instant_cache():
+    query_string = 'name=impot_revenu.tspr.abatpro.*&instant=2015-01-01'
+    status_code, data = get_parameters(query_string)
+    # Cached values are not modified by responses.
+    assert_equal(get_parameters(query_string), (status_code, data))
+    assert_equal(get_parameters('instant=2015-01-01')[0], 200)
+
+
+def test_parameters_history():
+    res = Request.blank('/api/1/parameters/history?name=impot_revenu.bareme&start=2013-06-01&stop=2015-01-01') \
+        .get_response(common.app)
+    assert_equal(res.status_code, 200)
+    parameter_json, = json.loads(res.body)['parameters']
+    assert_equal(parameter_json['name'], 'impot_revenu.bareme')
+    values_json = parameter_json['values']
+    assert_equal([value_json['start'] for value_json in values_json], ['2013-01-01', '2014-01-01', '2015-01-01'])
+    assert_equal(values_json[0]['stop'], '2013-12-31')
+    status_code, data = get_parameters('name=impot_revenu.bareme&instant=2015-01-01')
+    assert_equal(values_json[-1]['brackets'], data['parameters'][0]['brackets'])
+
+
+def test_parameters_history_errors():
+    assert_equal(Request.blank('/api/1/parameters/history').get_response(common.app).status_code, 400)
+    assert_equal(Request.blank('/api/1/parameters/history?name=inexistent').get_response(common.app).status_code, 400)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+
+import json
+import threading
+
+from nose.tools import assert_equal, assert_greater, assert_less
+from webob import Request
+
+from . import common
+
+
+def setup_module(module):
+    common.get_or_load_app()
+
+
+scenario_json = {
+    'test_case': {
+        'familles': [{'id': 'f0', 'parents': ['ind0']}],
+        'foyers_fiscaux': [{'declarants': ['ind0'], 'id': 'ff0'}],
+        'individus': [
+            {'age': 40, 'id': 'ind0', 'salaire_de_base': 20000},
+            ],
+        'menages': [{'id': 'm0', 'personne_de_reference': 'ind0'}],
+        },
+    'period': '2014',
+    }
+
+
+def create_session(body):
+    req = Request.blank(
+        '/api/1/sessions',
+        body = json.dumps(body),
+        headers = (('Content-Type', 'application/json'),),
+        method = 'POST',
+        )
+    return req.get_response(common.app)
+
+
+def patch_session(session_url, body):
+    req = Request.blank(
+        session_url,
+        body = json.dumps(body),
+        headers = (('Content-Type', 'application/json'),),
+        method = 'PATCH',
+        )
+    return req.get_response(common.app)
+
+
+def test_session():
+    res = create_session({
+        'scenario': scenario_json,
+        'variables': ['revenu_disponible'],
+        })
+    assert_equal(res.status_code, 201, res.body)
+    res_json = json.loads(res.body)
+    session_url = '/api/1/sessions/{}'.format(res_json['session']['id'])
+    revenu_disponible = res_json['value']['revenu_disponible']['2014'][0]
+
+    res = patch_session(session_url, {
+        'inputs': {'individus': {'ind0': {'salaire_de_base': 30000}}},
+        'variables': ['revenu_disponible'],
+        })
+    assert_equal(res.status_code, 200, res.body)
+    res_json = json.loads(res.body)
+    assert_greater(res_json['invalidated'], 0)
+    assert_greater(res_json['value']['revenu_disponible']['2014'][0], revenu_disponible)
+
+    # A new session with the same inputs gives the same results.
+    updated_scenario_json = json.loads(json.dumps(scenario_json))
+    updated_scenario_json['test_case']['individus'][0]['salaire_de_base'] = 30000
+    res = create_session({
+        'scenario': updated_scenario_json,
+        'variables': ['revenu_disponible'],
+        })
+    assert_equal(res.status_code, 201, res.body)
+    assert_equal(json.loads(res.body)['value'], res_json['value'])
+
+    # Changing an input that few variables depend on invalidates less values.
+    res = patch_session(session_url, {
+        'inputs': {'foyers_fiscaux': {'ff0': {'f7uf': 100}}},
+        'variables': ['revenu_disponible'],
+        })
+    assert_equal(res.status_code, 200, res.body)
+    assert_less(json.loads(res.body)['invalidated'], res_json['invalidated'])
+
+    res = Request.blank(session_url).get_response(common.app)
+    assert_equal(res.status_code, 200, res.body)
+    assert_equal(json.loads(res.body)['value']['test_case']['individus'][0]['salaire_de_base'], 30000)
+
+    res = Request.blank(session_url, method = 'DELETE').get_response(common.app)
+    assert_equal(res.status_code, 204)
+    res = Request.blank(session_url).get_response(common.app)
+    assert_equal(res.status_code, 404)
+
+
+def test_session_with_invalid_inputs():
+    res = create_session({
+        'scenario': scenario_json,
+        })
+    assert_equal(res.status_code, 201, res.body)
+    session_url = '/api/1/sessions/{}'.format(json.loads(res.body)['session']['id'])
+
+    res = patch_session(session_url, {
+        'inputs': {'individus': {'XXX': {'salaire_de_base': 30000}}},
+        })
+    assert_equal(res.status_code, 400, res.body)
+
+    res = patch_session(session_url, {
+        'inputs': {'individus': {'ind0': {'XXX': 30000}}},
+        })
+    assert_equal(res.status_code, 400, res.body)
+
+    res = patch_session(session_url, {
+        'inputs': {'individus': {'ind0': {'handicap': True}}},  # Monthly variable given for a year
+        })
+    assert_equal(res.status_code, 400, res.body)
+
+
+def test_session_with_invalid_scenario():
+    invalid_scenario_json = json.loads(json.dumps(scenario_json))
+    invalid_scenario_json['test_case']['individus'][0]['handicap'] = True  # Monthly variable given for a year
+    res = create_session({
+        'scenario': invalid_scenario_json,
+        })
+    assert_equal(res.status_code, 400, res.body)
+
+
+def test_concurrent_session_changes():
+    res = create_session({
+        'scenario': scenario_json,
+        })
+    assert_equal(res.status_code, 201, res.body)
+    session_url = '/api/1/sessions/{}'.format(json.loads(res.body)['session']['id'])
+
+    changes = [
+        {'individus': {'ind0': {'salaire_de_base': 30000}}},
+        {'menages': {'m0': {'loyer': 6000}}},
+        ]
+    statuses = []
+    threads = [
+        threading.Thread(target = lambda inputs: statuses.append(patch_session(session_url, {
+            'inputs': inputs,
+            'variables': ['revenu_disponible'],
+            }).status_code), args = (inputs,))
+        for inputs in changes
+        ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equal(statuses, [200, 200])
+
+    # No change is lost.
+    res = Request.blank(session_url).get_response(common.app)
+    assert_equal(res.status_code, 200, res.body)
+    test_case = json.loads(res.body)['value']['test_case']
+    assert_equal(test_case['individus'][0]['salaire_de_base'], 30000)
+    assert_equal(test_case['menages'][0]['loyer'], 6000)
@@ -3,10 +3,12 @@
 
 import json
 
-from nose.tools import assert_equal, assert_in, assert_not_in
+from nose.tools import assert_equal, assert_in, assert_not_in, assert_true
 from webob import Request
 
 from . import common
+from .. import binary, model, workers
+from ..controllers import calculate
 
 
 def setup_module(module):
@@ -155,3 +157,316 @@ def test_simulate_with_wrong_period():
     assert_equal(res.status_code, 400, res.body)
     res_body_json = json.loads(res.body)
     assert_in(u'ValueError: Unable to compute variable', res_body_json['error']['message'], res.body)
+
+
+def test_simulate_with_workers():
+    test_case = {
+        'scenarios': [
+            {
+                'test_case': {
+                    'familles': [
+                        {
+                            'parents': ['ind0'],
+                            },
+                        ],
+                    'foyers_fiscaux': [
+                        {
+                            'declarants': ['ind0'],
+                            },
+                        ],
+                    'individus': [
+                        {'id': 'ind0', 'salaire_de_base': salaire_de_base},
+                        ],
+                    'menages': [
+                        {
+                            'personne_de_reference': 'ind0',
+                            },
+                        ],
+                    },
+                'period': '2014',
+                }
+            for salaire_de_base in (10000, 20000, 30000)
+            ],
+        }
+    responses_json = []
+    try:
+        for calculate_workers in (0, 2):
+            if calculate_workers:
+                workers.start_pool(calculate_workers)
+            model.response_cache.clear()
+            req = Request.blank(
+                '/api/1/simulate',
+                body = json.dumps(test_case),
+                headers = (('Content-Type', 'application/json'),),
+                method = 'POST',
+                )
+            res = req.get_response(common.app)
+            assert_equal(res.status_code, 200, res.body)
+            responses_json.append(json.loads(res.body))
+    finally:
+        workers.stop_pool()
+    assert_equal(len(responses_json[1]['value']['values']), 3)
+    assert_equal(responses_json[0]['value'], responses_json[1]['value'])
+
+
+def test_simulate_with_binary_response():
+    test_case = {
+        'scenarios': [
+            {
+                'test_case': {
+                    'familles': [
+                        {
+                            'parents': ['ind0'],
+                            },
+                        ],
+                    'foyers_fiscaux': [
+                        {
+                            'declarants': ['ind0'],
+                            },
+                        ],
+                    'individus': [
+                        {'id': 'ind0', 'salaire_de_base': 20000},
+                        ],
+                    'menages': [
+                        {
+                            'personne_de_reference': 'ind0',
+                            },
+                        ],
+                    },
+                'period': '2014',
+                },
+            ],
+        }
+    responses_value = []
+    for accept in ('application/json', binary.RAW_MEDIA_TYPE):
+        req = Request.blank(
+            '/api/1/simulate',
+            body = json.dumps(test_case),
+            headers = (('Accept', accept), ('Content-Type', 'application/json')),
+            method = 'POST',
+            )
+        res = req.get_response(common.app)
+        assert_equal(res.status_code, 200, res.body)
+        if accept == binary.RAW_MEDIA_TYPE:
+            assert_equal(res.content_type, binary.RAW_MEDIA_TYPE)
+            responses_value.append(binary.decode(res.body)['value'])
+        else:
+            responses_value.append(json.loads(res.body)['value'])
+    json_value, binary_value = responses_value
+    assert_equal(binary_value['code'], json_value['code'])
+    assert_equal(binary_value['values'].tolist(), json_value['values'])
+
+
+def test_simulate_with_batch():
+    test_case = {
+        'reforms': ['trannoy_wasmer'],
+        'scenarios': [
+            {
+                'test_case': {
+                    'familles': [
+                        {
+                            'parents': ['ind0'],
+                            },
+                        ],
+                    'foyers_fiscaux': [
+                        {
+                            'declarants': ['ind0'],
+                            },
+                        ],
+                    'individus': [
+                        {'id': 'ind0', 'salaire_de_base': salaire_de_base},
+                        ],
+                    'menages': [
+                        {
+                            'loyer': 6000,
+                            'personne_de_reference': 'ind0',
+                            },
+                        ],
+                    },
+                'period': '2013',
+                }
+            for salaire_de_base in (10000, 20000, 30000)
+            ] + [
+            {
+                'axes': [
+                    {
+                        'count': 3,
+                        'max': 30000,
+                        'min': 0,
+                        'name': 'salaire_de_base',
+                        },
+                    ],
+                'test_case': {
+                    'familles': [
+                        {
+                            'parents': ['ind0'],
+                            },
+                        ],
+                    'foyers_fiscaux': [
+                        {
+                            'declarants': ['ind0'],
+                            },
+                        ],
+                    'individus': [
+                        {'id': 'ind0'},
+                        ],
+                    'menages': [
+                        {
+                            'personne_de_reference': 'ind0',
+                            },
+                        ],
+                    },
+                'period': '2013',
+                },
+            ],
+        }
+    responses_json = []
+    for batch in (False, True):
+        test_case['batch'] = batch
+        req = Request.blank(
+            '/api/1/simulate',
+            body = json.dumps(test_case),
+            headers = (('Content-Type', 'application/json'),),
+            method = 'POST',
+            )
+        res = req.get_response(common.app)
+        assert_equal(res.status_code, 200, res.body)
+        responses_json.append(json.loads(res.body))
+    assert_equal(len(responses_json[1]['value']['values']), 6)
+    assert_equal(responses_json[0]['value'], responses_json[1]['value'])
+    assert_equal(responses_json[0]['base_value'], responses_json[1]['base_value'])
+
+
+def test_simulate_with_decomposition_selection():
+    test_case = {
+        'scenarios': [
+            {
+                'test_case': {
+                    'familles': [
+                        {
+                            'parents': ['ind0'],
+                            },
+                        ],
+                    'foyers_fiscaux': [
+                        {
+                            'declarants': ['ind0'],
+                            },
+                        ],
+                    'individus': [
+                        {'id': 'ind0', 'salaire_de_base': 10000},
+                        ],
+                    'menages': [
+                        {
+                            'loyer': 6000,
+                            'personne_de_reference': 'ind0',
+                            },
+                        ],
+                    },
+                'period': '2014',
+                },
+            ],
+        }
+    responses_json = []
+    for decomposition in (None, {'code': 'prestations_sociales', 'depth': 1}):
+        if decomposition is not None:
+            test_case['decomposition'] = decomposition
+        req = Request.blank(
+            '/api/1/simulate',
+            body = json.dumps(test_case),
+            headers = (('Content-Type', 'application/json'),),
+            method = 'POST',
+            )
+        res = req.get_response(common.app)
+        assert_equal(res.status_code, 200, res.body)
+        responses_json.append(json.loads(res.body))
+    full_value, pruned_value = [response_json['value'] for response_json in responses_json]
+    assert_equal(pruned_value['code'], full_value['code'])
+    assert_not_in('values', pruned_value)
+    assert_equal(len(pruned_value['children']), 1)
+    node_json = pruned_value['children'][0]
+    assert_equal(node_json['code'], 'prestations_sociales')
+    full_node_json = [
+        child_json
+        for child_json in full_value['children']
+        if child_json['code'] == 'prestations_sociales'
+        ][0]
+    assert_equal(node_json['values'], full_node_json['values'])
+    assert_equal(
+        [child_json['code'] for child_json in node_json['children']],
+        [child_json['code'] for child_json in full_node_json['children']],
+        )
+    assert_true(all('children' not in child_json for child_json in node_json['children']))
+
+    test_case['decomposition'] = {'code': 'XXX'}
+    req = Request.blank(
+        '/api/1/simulate',
+        body = json.dumps(test_case),
+        headers = (('Content-Type', 'application/json'),),
+        method = 'POST',
+        )
+    res = req.get_response(common.app)
+    assert_equal(res.status_code, 400, res.body)
+
+
+def test_simulate_with_reform_and_results_reuse():
+    # trannoy_wasmer changes formulas, plf2015 only changes parameters.
+    for reform_key in ('plf2015', 'trannoy_wasmer'):
+        check_simulate_with_reform_and_results_reuse(reform_key)
+
+
+def check_simulate_with_reform_and_results_reuse(reform_key):
+    # The child has no birth date: suggest() must repair the base run the same way as the reform run, otherwise the
+    # values reused from the base run are computed for an adult.
+    test_case = {
+        'reforms': [reform_key],
+        'scenarios': [
+            {
+                'test_case': {
+                    'familles': [
+                        {
+                            'enfants': ['ind1'],
+                            'parents': ['ind0'],
+                            },
+                        ],
+                    'foyers_fiscaux': [
+                        {
+                            'declarants': ['ind0'],
+                            'personnes_a_charge': ['ind1'],
+                            },
+                        ],
+                    'individus': [
+                        {'id': 'ind0', 'salaire_de_base': 15000},
+                        {'id': 'ind1'},
+                        ],
+                    'menages': [
+                        {
+                            'enfants': ['ind1'],
+                            'loyer': 6000,
+                            'personne_de_reference': 'ind0',
+                            },
+                        ],
+                    },
+                'period': '2014',
+                },
+            ],
+        }
+    responses_json = []
+    make_results_reuse = calculate.make_results_reuse
+    try:
+        for reuse in (True, False):
+            if not reuse:
+                calculate.make_results_reuse = lambda *args: None
+            model.response_cache.clear()
+            req = Request.blank(
+                '/api/1/simulate',
+                body = json.dumps(test_case),
+                headers = (('Content-Type', 'application/json'),),
+                method = 'POST',
+                )
+            res = req.get_response(common.app)
+            assert_equal(res.status_code, 200, res.body)
+            responses_json.append(json.loads(res.body))
+    finally:
+        calculate.make_results_reuse = make_results_reuse
+    assert_equal(responses_json[0]['value'], responses_json[1]['value'])
+    assert_equal(responses_json[0]['base_value'], responses_json[1]['base_value'])
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+
+"""Keys of the calculations recorded by the tracers of simulations, like ``salaire_net<2014-01>``"""
+
+
+def get_key_period(key):
+    """Return the period of a tracer key.
+
+    >>> get_key_period('salaire_net<2014-01>')
+    '2014-01'
+    """
+    return key.split('<', 2)[1].rstrip('>')
+
+
+def get_key_variable_name(key):
+    """Return the name of the variable of a tracer key.
+
+    >>> get_key_variable_name('salaire_net<2014-01>')
+    'salaire_net'
+    """
+    return key.split('<', 1)[0]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+
+"""Index of the variables of a tax-benefit system, used to parse and answer the requests of the formula controller
+
+The column of each variable, and its converters, are built once for each tax-benefit system, instead of once for each
+parameter and formula of each request.
+"""
+
+
+from openfisca_core import columns
+
+
+class VariablesIndex(object):
+    """The converters and dtypes of the variables of a tax-benefit system, and the names of its computable variables"""
+
+    def __init__(self, tax_benefit_system):
+        self.computable_variables_name = set()
+        self.dtype_by_name = {}
+        self.input_to_dated_python_by_name = {}  # None when the input needs no conversion
+        self.transform_dated_value_to_json_by_name = {}
+        for name, variable in tax_benefit_system.variables.iteritems():
+            column = columns.make_column_from_variable(variable)
+            self.dtype_by_name[name] = column.dtype
+            # input_to_dated_python is a property building a new converter at each access.
+            self.input_to_dated_python_by_name[name] = column.input_to_dated_python
+            self.transform_dated_value_to_json_by_name[name] = column.transform_dated_value_to_json
+            if not variable.is_input_variable():
+                self.computable_variables_name.add(name)
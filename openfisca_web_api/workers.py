@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+
+"""Pool of worker processes running simulations
+
+The pool is created at the end of ``environment.load_environment``, so that forked workers share the warmed
+tax-benefit systems (``model.tax_benefit_system`` and ``model.reformed_tbs``) with the main process, copy-on-write.
+
+Jobs are module-level functions (so that they can be pickled) receiving and returning JSON-like values only: OpenFisca
+objects (scenarios, simulations, exceptions) are rebuilt inside the workers.
+"""
+
+
+import logging
+import multiprocessing
+
+from . import model
+
+
+log = logging.getLogger(__name__)
+
+# Initialized in environment module
+pool = None
+pool_size = 0
+
+
+def get_tax_benefit_system(base_reforms, reforms):
+    """Return the tax-benefit system identified by the given lists of reform keys (or None)."""
+    tax_benefit_system = model.tax_benefit_system
+    if base_reforms is not None:
+        tax_benefit_system = model.get_cached_composed_reform(
+            reform_keys = base_reforms,
+            tax_benefit_system = tax_benefit_system,
+            )
+    if reforms is not None:
+        tax_benefit_system = model.get_cached_composed_reform(
+            reform_keys = reforms,
+            tax_benefit_system = tax_benefit_system,
+            )
+    return tax_benefit_system
+
+
+def imap_jobs(function, jobs):
+    """Run ``function`` on each job in the pool and iterate over the results, in the order of the jobs."""
+    assert pool is not None
+    return pool.imap(function, jobs)
+
+
+def map_jobs(function, jobs):
+    """Run ``function`` on each job in the pool and return the results, in the order of the jobs."""
+    assert pool is not None
+    return pool.map(function, jobs, chunksize = 1)
+
+
+def split_indexes(items_count, chunks_count):
+    """Split ``range(items_count)`` into at most ``chunks_count`` contiguous ``(start, stop)`` couples.
+
+    >>> split_indexes(5, 2)
+    [(0, 3), (3, 5)]
+    >>> split_indexes(2, 4)
+    [(0, 1), (1, 2)]
+    """
+    chunks_count = max(min(chunks_count, items_count), 1)
+    chunk_size, remainder = divmod(items_count, chunks_count)
+    bounds = []
+    start = 0
+    for chunk_index in range(chunks_count):
+        stop = start + chunk_size + (1 if chunk_index < remainder else 0)
+        bounds.append((start, stop))
+        start = stop
+    return bounds
+
+
+def start_pool(processes):
+    global pool, pool_size
+    assert pool is None
+    log.info(u'Fork {} calculation worker processes.'.format(processes))
+    pool = multiprocessing.Pool(processes)
+    pool_size = processes
+
+
+def stop_pool():
+    global pool, pool_size
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+        pool = None
+        pool_size = 0
@@ -121,10 +121,42 @@ def respond_json(ctx, data, code = None, headers = [], json_dumps_default = None
         text = json.dumps(data)
     else:
         text = json.dumps(data, default = json_dumps_default)
-    text = unicode(text)
     if jsonp:
-        text = u'{0}({1})'.format(jsonp, text)
-    response.text = text
+        response.text = u'{0}({1})'.format(jsonp, text)
+    else:
+        # Avoid copying the (ASCII-only) JSON text into a unicode string before encoding it again.
+        response.body = text.encode('utf-8') if isinstance(text, unicode) else text
+    return response
+
+
+def respond_ndjson(ctx, items, headers = []):
+    """Return a streamed response containing one JSON document per line (cf http://ndjson.org/).
+
+    ``items`` is an iterable, consumed while the response body is sent. None properties of mapping items are removed.
+    """
+    def iter_lines():
+        for item in items:
+            if isinstance(item, collections.Mapping):
+                item = type(item)(
+                    (name, value)
+                    for name, value in item.iteritems()
+                    if value is not None
+                    )
+            yield json.dumps(item) + '\n'
+
+    response = ctx.req.response
+    response.content_type = 'application/x-ndjson'
+    response.headers.update(headers)
+    response.app_iter = iter_lines()
+    return response
+
+
+def respond_ndjson_lines(ctx, lines, headers = []):
+    """Return a streamed NDJSON response made of already serialized lines (ending with a newline)."""
+    response = ctx.req.response
+    response.content_type = 'application/x-ndjson'
+    response.headers.update(headers)
+    response.app_iter = lines
     return response
 
 
@@ -7,7 +7,7 @@ from setuptools import setup, find_packages
 
 setup(
     name = 'OpenFisca-Web-API',
-    version = '8.2.0',
+    version = '8.27.0',
     author = 'OpenFisca Team',
     author_email = 'contact@openfisca.fr',
     classifiers = [
@@ -42,6 +42,9 @@ setup(
         'paste.app_factory': 'main = openfisca_web_api.application:make_app',
         },
     extras_require = {
+        'msgpack': [
+            'msgpack >= 0.5.2',
+            ],
         'paster': [
             'PasteScript',
             ],